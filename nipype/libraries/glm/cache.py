@@ -0,0 +1,148 @@
+import os
+import fcntl
+import hashlib
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+# Persistent caches used to avoid recomputing things nipype would otherwise redo
+# on every rerun (or for every subject that happens to share identical inputs).
+# Everything lives under a single directory, which defaults to ~/.cache/hcp_glm
+# but can be pointed at shared lab storage with the HCP_GLM_CACHE environment
+# variable so that all jobs on the cluster reuse the same entries.
+DEFAULT_CACHE_DIR = os.getenv('HCP_GLM_CACHE',
+                              os.path.join(os.path.expanduser('~'), '.cache', 'hcp_glm'))
+
+
+def hash_bytes(*items):
+    '''
+    sha1 hex digest over a sequence of bytes or str items. Items are length
+    prefixed so that ('ab', 'c') and ('a', 'bc') hash differently.
+    '''
+    h = hashlib.sha1()
+    for item in items:
+        if isinstance(item, str):
+            item = item.encode('utf-8')
+        h.update(b'%d:' % len(item))
+        h.update(item)
+    return h.hexdigest()
+
+
+def hash_file(path, chunk_size=1 << 20):
+    # sha1 over the file contents, read in chunks so large images don't need to fit in memory
+    h = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def hash_stat(path):
+    '''
+    sha1 over the absolute path, size and mtime of path. For inputs that are never
+    modified in place, like the read only HCP archive, this identifies the
+    contents without reading them, which matters for 4D runs on network storage.
+    '''
+    st = os.stat(path)
+    return hash_bytes(os.path.abspath(path), str(st.st_size), str(st.st_mtime_ns))
+
+
+class DiskCache:
+    '''
+    A directory of files named by content hash with a size cap and least recently
+    used eviction.
+
+    Entries are stored as <cache_dir>/<namespace>/<key><ext>. Reads bump the
+    entry's mtime, so mtime order is LRU order and nothing else needs to be kept
+    on disk. Writes go through a temporary file and os.replace so that concurrent
+    MultiProc workers or SLURM jobs never see a partial entry. Eviction is best
+    effort: if another process removes an entry first we just move on.
+
+    cache_dir - root directory for all caches. Defaults to DEFAULT_CACHE_DIR
+    namespace - subdirectory for this kind of entry (e.g. 'vifs')
+    max_bytes - size cap for the namespace. None disables eviction
+    '''
+    def __init__(self, namespace, cache_dir=None, max_bytes=None):
+        self.cache_dir = os.path.join(cache_dir or DEFAULT_CACHE_DIR, namespace)
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def path(self, key, ext=''):
+        return os.path.join(self.cache_dir, key + ext)
+
+    def get(self, key, ext=''):
+        # returns the path to the cached entry or None on a miss
+        path = self.path(key, ext)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, src, ext='', move=False):
+        '''
+        stores the file src under key and returns the path of the stored entry.
+        With move=True src is moved into the cache rather than copied.
+        '''
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp_')
+        os.close(fd)
+        try:
+            if move:
+                shutil.move(src, tmp)
+            else:
+                shutil.copyfile(src, tmp)
+            os.replace(tmp, self.path(key, ext))
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+        self.evict()
+        return self.path(key, ext)
+
+    @contextmanager
+    def lock(self, key):
+        '''
+        holds an exclusive lock on key, so that of several workers missing the same
+        entry one builds it while the others wait and then find it stored:
+
+            with cache.lock(key):
+                path = cache.get(key, ext)
+                if path is None:
+                    ...build it...
+                    path = cache.put(key, built, ext)
+
+        The lock is a POSIX record lock, which holds across the processes of a
+        MultiProc run and across nodes on NFS. Keys share the lock files
+        .lock_<key[:2]>, so a namespace never has more than 256 of them. Two keys
+        sharing one only means their builds run one after the other.
+        '''
+        with open(os.path.join(self.cache_dir, '.lock_' + key[:2]), 'a') as f:
+            fcntl.lockf(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(f, fcntl.LOCK_UN)
+
+    def evict(self):
+        if self.max_bytes is None:
+            return
+
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.startswith(('.tmp_', '.lock_')) or not entry.is_file():
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -1,511 +1,595 @@
-def trial_events(subject_id, task, direction):
-    # subject_id: e.g. 100307
-    # task: e.g. EMOTION. Must match one of the task conditions below
-    # directoin: LR|RL. determines which eprime and HCP block deisgn data to use for constructing the design
-    # 
-    # this function returns single trials for all events in chronological order. Unlike the version in
-    # the traditional single trial analysis, there are no confound regressors. These need to be configured
-    # in subjecteventinfo if you want them
+import os
 
-    import pandas as pd
+# E-Prime *_TAB.txt exports have a few hundred columns, but event extraction only needs
+# the stimulus timing and block labels
+def _is_eprime_event_column(column):
+    return column == 'BlockType' or column.endswith(('.OnsetTime', '.OffsetTime',
+                                                     '.StartTime', '.FinishTime'))
+
+
+def _save_eprime_columns(df, filename, source):
     import numpy as np
-    from glob import glob
-    
-    print("Subject ID: %s\n" % str(subject_id))
-    output = []
 
-    data_dir = '/dartfs/rc/lab/D/DBIC/DBIC/archive/HCP/HCP1200/'
-    eprime_path = glob(data_dir + \
+    # numeric columns keep their dtype. String columns (BlockType) are stored as
+    # unicode with a separate missing value mask, so no pickling is needed to load them
+    arrays = {'__source__': np.array(source), '__mtime__': np.array(os.path.getmtime(source))}
+    for column in df.columns:
+        values = df[column]
+        if values.dtype.kind in 'biuf':
+            arrays[column] = values.to_numpy()
+        else:
+            arrays['__na__' + column] = values.isna().to_numpy()
+            arrays['__str__' + column] = values.fillna('').astype(str).to_numpy(dtype=str)
+    with open(filename, 'wb') as file:
+        np.savez(file, **arrays)
+
+
+def _load_eprime_columns(filename):
+    import numpy as np
+    import pandas as pd
+
+    with np.load(filename, allow_pickle=False) as table:
+        columns = {}
+        for name in table.files:
+            if name.startswith('__str__'):
+                column = name[len('__str__'):]
+                values = table[name].astype(object)
+                values[table['__na__' + column]] = np.nan
+                columns[column] = values
+            elif not name.startswith('__'):
+                columns[name] = table[name]
+        return str(table['__source__']), float(table['__mtime__']), pd.DataFrame(columns)
+
+
+def read_eprime(subject_id, task, direction,
+                data_dir='/dartfs/rc/lab/D/DBIC/DBIC/archive/HCP/HCP1200/',
+                use_cache=True, revalidate=True, cache_dir=None):
+    '''
+    returns the event timing columns of a run's E-Prime *_TAB.txt as a DataFrame.
+
+    Parsed columns are kept in the 'eprime' namespace of glm.cache, one .npz per
+    run, together with the path and mtime of the file they came from. Once a run is
+    cached neither the glob over the run directory nor the csv parse are repeated,
+    including across the trial and block pipelines and reruns. The glob itself is
+    answered from the file index in HCP_FILE_INDEX if there is one. With revalidate=True
+    the source file is stat'ed and reparsed if its mtime changed. revalidate=False
+    doesn't touch data_dir at all for cached runs.
+    '''
+    import pandas as pd
+    from glm.fileindex import indexed_glob
+
+    cache = None
+    if use_cache:
+        from glm.cache import DiskCache, hash_bytes
+
+        cache = DiskCache('eprime', cache_dir=cache_dir)
+        key = hash_bytes(os.path.abspath(data_dir), str(subject_id), task, direction)
+
+        cached = cache.get(key, '.npz')
+        if cached is not None:
+            try:
+                source, mtime, df = _load_eprime_columns(cached)
+                if not revalidate or os.path.getmtime(source) == mtime:
+                    return df
+            except (OSError, ValueError, KeyError):
+                # source moved or the entry is unreadable: fall through and reparse
+                pass
+
+    eprime_path = indexed_glob(data_dir + \
                        '/%s/MNINonLinear/Results/tfMRI_%s_%s/%s_run*_TAB.txt' % \
                        (subject_id, task, direction, task))
-    assert(len(eprime_path) == 1,
-        '%d eprime files found for subject %s' % (len(eprime_path), subject_id))
-    df = pd.read_csv(eprime_path[0], delimiter='\t', na_values=[''])
-
-
-    # trial specific variables
-    if task == 'EMOTION':
-        # get trial onsets and durations
-        onsets = df['StimSlide.OnsetTime'] - df['SyncSlide.OnsetTime'][0]
-        onsets = [onset for onset in onsets.tolist() if not np.isnan(onset)]
-
-        # includes ITI per Barch 2013 definition of a 'trial'
-        #dur = [3 for i in range(0,len(onsets))]
-
-        # no ITI
-        dur = [2.0 for i in range(0,len(onsets))]
-    elif task == 'GAMBLING':
-        onsets = df['QuestionMark.OnsetTime'] - df['SyncSlide.OnsetTime'][0]
-        onsets = [onset for onset in onsets.tolist() if not np.isnan(onset)]
-
-        # incorporates ?, reveal, and ITI per the definition of a 'trial' from Barch 2013
-        #dur = [3.5 for i in range(0,len(onsets))]
-
-        # incorporates ? and reveal, but not ITI
-        dur = [2.5 for i in range(0,len(onsets))]
-    elif task == 'SOCIAL':
-        time0 = df['CountDownSlide.OnsetTime'][0]
-        onsets = np.array(df['MovieSlide.OnsetTime'] - time0)
-
-
-        onset_ind = np.where(np.isfinite(onsets))[0]
-
-        # this includes response periods, matching Barch 2013 block design
-        #fix_onsets = np.array(df['FixationBlock.OnsetTime'] - time0)
-        #dur = fix_onsets[onset_ind + 1] - onsets[onset_ind]
-        #dur = [d/1000 for d in dur]
-
-        # this version separates out response periods
-        resp_onsets = np.array(df['ResponseSlide.OnsetTime'] - time0)
-        dur = resp_onsets[onset_ind] - onsets[onset_ind]
-        dur = [d/1000 for d in dur]
-
-        onsets = onsets[np.isfinite(onsets)].tolist()
-    elif task == 'LANGUAGE':
-        # we haven't updated these to be single trials
-        
-        onsets = np.nanmax([df['PresentStoryFile.OnsetTime'],
-                            df['PresentMathFile.OnsetTime']], axis=0) - df['GetReady.FinishTime'][0]
-
-        offsets = np.nanmax([df['PresentStoryFile.OffsetTime'],
-                             df['PresentMathFile.OffsetTime']], axis=0) - df['GetReady.FinishTime'][0]
-
-        # this includes response periods and ratings, matching Barch 2013 block designs
-        #resp_offsets = np.array(df['ResponsePeriod.OffsetTime'] - df['GetReady.FinishTime'][0])
-        #resp_offsets = resp_offsets[np.isfinite(resp_offsets)].tolist()
-        #dur = (resp_offsets - onsets[np.isfinite(onsets)])/1000
-
-        # this does not include response periods or questions
-        dur = (offsets[np.isfinite(onsets)] - onsets[np.isfinite(onsets)])/1000
-        dur = dur.tolist()
-
-        onsets = onsets[np.isfinite(onsets)].tolist()
-        # drop final onsets since they are not not part of the scan and blow up VIFs
-        onsets = onsets[:12]
-        dur = dur[:12]
-
-    elif task == 'RELATIONAL':
-        # durations differ for relational and control trials, so we need to be able to
-        # disambiguate them
-        blocktype = np.array(df['BlockType'])
-
-        onsets = np.nanmax([df['RelationalSlide.OnsetTime'],
-                              df['ControlSlide.OnsetTime']], axis=0) - df['SyncSlide.OnsetTime'][0]
-
-        blocktype = blocktype[np.isfinite(onsets)].tolist()
-        onsets = onsets[np.isfinite(onsets)].tolist()
-
-        # counting ITIs like in Barch 2013
-        #dur = [4.0 if block == 'Relational' else 3.2 for block in blocktype]
-
-        # this does not count ITIs
-        dur = [3.5 if block == 'Relational' else 2.8 for block in blocktype]
-    elif task == 'MOTOR':
-        # each onset corresponds to a single motor sequence. 
-        # A single finger tap, a single toe squeeze, etc. The VIFs for this are huge and likely unusable
-        if 'SyncSlide.OnsetTime' in df.keys():
-            time0 = df['SyncSlide.OnsetTime'][0]
-        elif 'CountDownSlide.OnsetTime' in df.keys():
-            time0 = df['CountDownSlide.OnsetTime'][0]
-        else:
-            raise ValueError('No scan onset time could be found for subject %s %s_%s' % (subject_id, task, direction))
+    if len(eprime_path) != 1:
+        raise ValueError('%d eprime files found for subject %s %s_%s' %
+                         (len(eprime_path), subject_id, task, direction))
+    df = pd.read_csv(eprime_path[0], delimiter='\t', na_values=[''],
+                     usecols=_is_eprime_event_column)
+
+    if cache is not None:
+        import tempfile
+
+        fd, tmp = tempfile.mkstemp(dir=cache.cache_dir, prefix='.tmp_')
+        os.close(fd)
+        try:
+            _save_eprime_columns(df, tmp, eprime_path[0])
+            cache.put(key, tmp, '.npz', move=True)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    return df
+
+
+# Returns (names, onsets, dur) for a run under one of the event models ('trial',
+# 'block' or 'hcp'). If a cohort event database is available (db, or else the
+# HCP_EVENT_DB environment variable) the events are read from it, otherwise or
+# for runs it doesn't contain they are computed by the event function as usual.
+def lookup_events(subject_id, task, direction, model, db=None):
+    from glm.eventdb import query_events, _event_function
+
+    db = db or os.getenv('HCP_EVENT_DB')
+    if db and os.path.exists(db):
+        events = query_events(db, subject_id, task, direction, model)
+        if events is not None:
+            return events
+
+    return _event_function(model)(subject_id, task, direction)
+
+
+# Task event specifications
+#
+# Each HCP task is described once per event model by a dict of:
+#
+#   time0     - candidate columns for scan onset. The first one present in the E-Prime
+#               file is used and its first row is subtracted from all times
+#   onsets    - onset columns. Several columns are combined by taking the row wise
+#               maximum that is not NaN (e.g. RelationalSlide or ControlSlide)
+#   shift     - constant (in ms) added to onsets
+#   stride    - keep every stride-th onset (e.g. first trial of every block), or a dict
+#               of BlockType -> number of rows to skip after an onset of that type
+#   limit     - keep at most this many onsets
+#   duration  - how to get durations (in s) for the kept onsets. One of
+#                 ('const', value)
+#                 ('blocktype', {BlockType: value}, default)
+#                 ('offset', columns)       offset columns in the same rows
+#                 ('next_row', columns)     offset columns in the following rows
+#                 ('next_offset', options)  the k-th onset ends at the (k+skip)-th valid
+#                                           offset. options has 'columns', 'skip' and
+#                                           optionally 'end' (a column whose first row is
+#                                           appended as last offset) and 'override'
+#                                           (column, start, step) to replace offsets
+#                                           [start::step] with another column's values
+#   max_duration - sanity check on durations
+#   confounds - list of extra events with 'name', 'onsets', 'rows' ('own': rows where
+#               these onsets are valid, 'task': the rows of the kept task onsets) and
+#               'duration'. Confounds follow the task events in the design
+#
+# Durations are computed in exactly the same order of operations as the per task code
+# this replaced, so the designs are bit for bit identical.
+
+TASK_SPECS = {
+    'trial': {
+        'EMOTION': dict(time0=['SyncSlide.OnsetTime'],
+                        onsets=['StimSlide.OnsetTime'],
+                        # no ITI (Barch 2013 defines a 'trial' as 3s including the ITI)
+                        duration=('const', 2.0)),
+        'GAMBLING': dict(time0=['SyncSlide.OnsetTime'],
+                         onsets=['QuestionMark.OnsetTime'],
+                         # incorporates ? and reveal, but not ITI (3.5s in Barch 2013)
+                         duration=('const', 2.5)),
+        'SOCIAL': dict(time0=['CountDownSlide.OnsetTime'],
+                       onsets=['MovieSlide.OnsetTime'],
+                       # this version separates out response periods
+                       duration=('offset', ['ResponseSlide.OnsetTime'])),
+        'LANGUAGE': dict(time0=['GetReady.FinishTime'],
+                         # we haven't updated these to be single trials
+                         onsets=['PresentStoryFile.OnsetTime', 'PresentMathFile.OnsetTime'],
+                         # this does not include response periods or questions
+                         duration=('offset', ['PresentStoryFile.OffsetTime', 'PresentMathFile.OffsetTime']),
+                         # drop final onsets since they are not not part of the scan and blow up VIFs
+                         limit=12),
+        'RELATIONAL': dict(time0=['SyncSlide.OnsetTime'],
+                           onsets=['RelationalSlide.OnsetTime', 'ControlSlide.OnsetTime'],
+                           # durations differ for relational and control trials. This does
+                           # not count ITIs (4.0 and 3.2 in Barch 2013)
+                           duration=('blocktype', {'Relational': 3.5}, 2.8)),
+        'MOTOR': dict(time0=['SyncSlide.OnsetTime', 'CountDownSlide.OnsetTime'],
+                      # each onset corresponds to a single motor sequence. A single finger
+                      # tap, a single toe squeeze, etc. The VIFs for this are huge and likely unusable
+                      onsets=['CrossLeft.OnsetTime', 'CrossRight.OnsetTime', 'CrossCenter.OnsetTime'],
+                      duration=('const', 1.2)),
+        'WM': dict(time0=['SyncSlide.OnsetTime'],
+                   onsets=['Stim.OnsetTime'],
+                   # incorporates image but not ITI (2.5s in Barch 2013)
+                   duration=('const', 2.0)),
+    },
+    'block': {
+        'EMOTION': dict(time0=['SyncSlide.OnsetTime'],
+                        onsets=['StimSlide.OnsetTime'],
+                        stride=6,
+                        # includes ITI per Barch 2013 definition of a 'trial'
+                        duration=('next_offset', dict(columns=['face.OnsetTime', 'shape.OnsetTime'],
+                                                      end='ExpInstrucFeelFreeToRest.StartTime',
+                                                      skip=1))),
+        'GAMBLING': dict(time0=['SyncSlide.OnsetTime'],
+                         onsets=['QuestionMark.OnsetTime'],
+                         stride=8,
+                         # incorporates ?, reveal, and ITI per the definition of a 'trial' from Barch 2013
+                         duration=('next_offset', dict(columns=['FifteenSecFixation.OnsetTime'], skip=0))),
+        'SOCIAL': dict(time0=['CountDownSlide.OnsetTime'],
+                       onsets=['MovieSlide.OnsetTime'],
+                       # this version separates out response periods
+                       duration=('offset', ['ResponseSlide.OnsetTime']),
+                       confounds=[dict(name='Task-Response',
+                                       onsets=['ResponseSlide.OnsetTime'],
+                                       rows='task',
+                                       duration=('next_row', ['FixationBlock.OnsetTime']))]),
+        'LANGUAGE': dict(time0=['GetReady.FinishTime'],
+                         onsets=['PresentStoryFile.OnsetTime', 'PresentMathFile.OnsetTime'],
+                         # this does not include response periods or questions
+                         duration=('offset', ['PresentStoryFile.OffsetTime', 'PresentMathFile.OffsetTime']),
+                         # drop final onsets since they are not not part of the scan and blow up VIFs
+                         limit=12,
+                         # additional confounds. when excluding response periods or questions from single trials
+                         confounds=[dict(name='Task-Math-Question',
+                                         onsets=['PresentMathOptions.OnsetTime'],
+                                         rows='own',
+                                         duration=('offset', ['PresentMathOptions.OffsetTime'])),
+                                    dict(name='Task-Story-Question',
+                                         onsets=['ThatWasAbout.OnsetTime'],
+                                         rows='own',
+                                         duration=('offset', ['ThatWasAbout.OffsetTime'])),
+                                    dict(name='Task-Response',
+                                         onsets=['ResponsePeriod.OnsetTime'],
+                                         rows='own',
+                                         duration=('offset', ['ResponsePeriod.OffsetTime']))]),
+        'RELATIONAL': dict(time0=['SyncSlide.OnsetTime'],
+                           onsets=['RelationalSlide.OnsetTime', 'ControlSlide.OnsetTime'],
+                           stride={'Relational': 4, 'Control': 5},
+                           # counting ITIs like in Barch 2013
+                           duration=('const', 18.)),
+        'MOTOR': dict(time0=['SyncSlide.OnsetTime', 'CountDownSlide.OnsetTime'],
+                      onsets=['RightHandCue.OnsetTime', 'LeftHandCue.OnsetTime', 'RightFootCue.OnsetTime',
+                              'LeftFootCue.OnsetTime', 'TongueCue.OnsetTime'],
+                      shift=3000,
+                      duration=('const', 12.)),
+        'WM': dict(time0=['SyncSlide.OnsetTime'],
+                   onsets=['Stim.OnsetTime'],
+                   stride=10,
+                   # includes ITI per Barch 2013 definition of a 'trial'. Every second block is
+                   # followed by 15s of fixation, so we need to overwrite some offsets accordingly
+                   duration=('next_offset', dict(columns=['Cue2Back.OnsetTime', 'CueTarget.OnsetTime'],
+                                                 end='ExpInstrucFeelFreeToRest.StartTime',
+                                                 skip=1,
+                                                 override=('Fix15sec.OnsetTime', 2, 2))),
+                   max_duration=30),
+    },
+}
+
+# HCP provided EV files (MNINonLinear/Results/tfMRI_<task>_<direction>/EVs/<file>)
+# for each condition of the hcp event model
+HCP_EV_SPECS = {
+    'EMOTION': [('Task-Faces', 'fear.txt'), ('Task-Shapes', 'neut.txt')],
+    'GAMBLING': [('Task-Punish', 'loss.txt'), ('Task-Reward', 'win.txt')],
+    'SOCIAL': [('Task-Random', 'rnd.txt'), ('Task-TOM', 'mental.txt')],
+    'LANGUAGE': [('Task-Math', 'math.txt'), ('Task-Story', 'story.txt')],
+    'RELATIONAL': [('Task-Match', 'match.txt'), ('Task-Rel', 'relation.txt')],
+    'MOTOR': [('Task-Cue', 'cue.txt'), ('Task-LF', 'lf.txt'), ('Task-LH', 'lh.txt'),
+              ('Task-RF', 'rf.txt'), ('Task-RH', 'rh.txt'), ('Task-Tongue', 't.txt')],
+    'WM': [('Task-2bk-Body', '2bk_body.txt'), ('Task-2bk-Face', '2bk_faces.txt'),
+           ('Task-2bk-Place', '2bk_places.txt'), ('Task-2bk-Tool', '2bk_tools.txt'),
+           ('Task-0bk-Body', '0bk_body.txt'), ('Task-0bk-Face', '0bk_faces.txt'),
+           ('Task-0bk-Place', '0bk_places.txt'), ('Task-0bk-Tool', '0bk_tools.txt')],
+}
+
+
+def _spec_columns(spec):
+    # every E-Prime column a spec reads, other than time0
+    columns = list(spec['onsets'])
+    rules = [spec['duration']] + [confound['duration'] for confound in spec.get('confounds', [])]
+    for confound in spec.get('confounds', []):
+        columns += confound['onsets']
+    for rule in rules:
+        if rule[0] in ('offset', 'next_row'):
+            columns += rule[1]
+        elif rule[0] == 'next_offset':
+            columns += rule[1]['columns']
+            if rule[1].get('end'):
+                columns.append(rule[1]['end'])
+            if rule[1].get('override'):
+                columns.append(rule[1]['override'][0])
+    if isinstance(spec.get('stride'), dict) or spec['duration'][0] == 'blocktype':
+        columns.append('BlockType')
+    return list(dict.fromkeys(columns))
+
+
+def _gather(values, rows):
+    import numpy as np
+    return np.take_along_axis(values, rows, axis=1)
 
-        onsets = np.nanmax([df['CrossLeft.OnsetTime'],
-                              df['CrossRight.OnsetTime'],
-                              df['CrossCenter.OnsetTime']], axis=0) - time0
 
-        onsets = onsets[np.isfinite(onsets)].tolist()
-        dur = [1.2 for i in range(0,len(onsets))]
-    elif task == 'WM':
-        onsets = df['Stim.OnsetTime'] - df['SyncSlide.OnsetTime'][0]
-        onsets = [onset for onset in onsets.tolist() if not np.isnan(onset)]
+def _compact(mask):
+    '''
+    for a runs x rows mask, returns the indices of the True entries of each run moved
+    to the front (in order) and the number of True entries per run
+    '''
+    import numpy as np
+    return np.argsort(~mask, axis=1, kind='stable'), mask.sum(axis=1)
 
-        # includes ITI per Barch 2013 definition of a 'trial'
-        #dur = [2.5 for i in range(0,len(onsets))]
 
-        # incorporates image but not ITI
-        dur = [2.0 for i in range(0,len(onsets))]
-    else:
-        raise ValueError('{0} is not a supported task'.format(task))
+def extract_events(dfs, task, model, runs=None, errors='raise'):
+    '''
+    Runs the spec for task under model ('trial' or 'block') on a batch of E-Prime
+    DataFrames (see read_eprime) at once. All runs are stacked into runs x rows
+    arrays padded with NaN so that every step is a single array operation across
+    the batch.
 
-    assert(len(onsets) < 100, 
-        '%d single trials found, which is not supported by our indexing scheme.' % len(onsets))
+    runs   - labels for error messages, e.g. (subject_id, task, direction) tuples
+    errors - 'raise' raises on the first run that fails. 'return' puts the exception
+             in that run's place in the output instead
 
-    # we need a list of lists, with one list per task
-    # in order for subsequent code to work correctly, we must have trials first
-    onsets = [[onset/1000] for onset in onsets]
-    dur = [[d] for d in dur]
-    names = ['Task-%02d' % i for i in range(0,len(onsets))]
-    
-    return names, onsets, dur
-    
-    
-    
-def block_events(subject_id, task, direction):
-    import pandas as pd
+    returns a list with a (names, onsets, dur) tuple per DataFrame
+    '''
     import numpy as np
-    from glob import glob
-    
-    from nipype.interfaces.base import Bunch
-    from copy import deepcopy
-    print("Subject ID: %s\n" % str(subject_id))
-    output = []
 
-    data_dir = '/dartfs/rc/lab/D/DBIC/DBIC/archive/HCP/HCP1200/'
-    eprime_path = glob(data_dir + \
-                       '/%s/MNINonLinear/Results/tfMRI_%s_%s/%s_run*_TAB.txt' % \
-                       (subject_id, task, direction, task))
-    assert(len(eprime_path) == 1,
-        '%d eprime files found for subject %s' % (len(eprime_path), subject_id))
-    df = pd.read_csv(eprime_path[0], delimiter='\t', na_values=[''])
-
-    # these variables will store task irrelevant events like cues or response periods
-    # as needed
-    confound_names = []
-    confound_onsets = []
-    confound_dur = []
-
-    # task specific variables
-    if task == 'EMOTION':
-        onsets = df['StimSlide.OnsetTime'] - df['SyncSlide.OnsetTime'][0]
-        onsets = [onset for onset in onsets.tolist() if not np.isnan(onset)]
-        onsets = onsets[::6]
-
-        offsets = np.nanmax([df['face.OnsetTime'],
-                             df['shape.OnsetTime']], axis=0) - df['SyncSlide.OnsetTime'][0]
-        offsets = [offset for offset in offsets.tolist() if not np.isnan(offset)]
-        offsets = offsets + [df['ExpInstrucFeelFreeToRest.StartTime'][0] - df['SyncSlide.OnsetTime'][0]]
-
-        # includes ITI per Barch 2013 definition of a 'trial'
-        dur = [(off - on)/1000. for on,off in zip(onsets, offsets[1:])]
-    elif task == 'GAMBLING':
-        onsets = df['QuestionMark.OnsetTime'] - df['SyncSlide.OnsetTime'][0]
-        onsets = [onset for onset in onsets.tolist() if not np.isnan(onset)]
-        onsets = onsets[::8]
-
-        offsets = df['FifteenSecFixation.OnsetTime'] - df['SyncSlide.OnsetTime'][0]
-        offsets = [offset for offset in offsets.tolist() if not np.isnan(offset)]
-
-        # incorporates ?, reveal, and ITI per the definition of a 'trial' from Barch 2013
-        dur = [(off - on)/1000. for on,off in zip(onsets,offsets)]
-    elif task == 'SOCIAL':
-        time0 = df['CountDownSlide.OnsetTime'][0]
-        onsets = np.array(df['MovieSlide.OnsetTime'] - time0)
-
-        resp_onsets = np.array(df['ResponseSlide.OnsetTime'] - time0)
-        fix_onsets = np.array(df['FixationBlock.OnsetTime'] - time0)
-
-        onset_ind = np.where(np.isfinite(onsets))[0]
-
-        # this includes response periods, matching Barch 2013 block design
-        #dur = fix_onsets[onset_ind + 1] - onsets[onset_ind]
-        #dur = [d/1000 for d in dur]
-
-        # this version separates out response periods
-        dur = resp_onsets[onset_ind] - onsets[onset_ind]
-        dur = [d/1000 for d in dur]
-
-        confound_names.append('Task-Response')
-        confound_onsets.append(resp_onsets[onset_ind].tolist())
-        resp_dur = fix_onsets[onset_ind + 1] - resp_onsets[onset_ind]
-        resp_dur = resp_dur/1000.
-        confound_dur.append(resp_dur.tolist())
-
-        onsets = onsets[np.isfinite(onsets)].tolist()
-    elif task == 'LANGUAGE':
-        onsets = np.nanmax([df['PresentStoryFile.OnsetTime'],
-                            df['PresentMathFile.OnsetTime']], axis=0) - df['GetReady.FinishTime'][0]
-
-        offsets = np.nanmax([df['PresentStoryFile.OffsetTime'],
-                             df['PresentMathFile.OffsetTime']], axis=0) - df['GetReady.FinishTime'][0]
-
-        math_q_onsets = np.array(df['PresentMathOptions.OnsetTime'] - df['GetReady.FinishTime'][0])
-        math_q_offsets = np.array(df['PresentMathOptions.OffsetTime'] - df['GetReady.FinishTime'][0])
-        math_q_dur = (math_q_offsets - math_q_onsets)/1000
-        math_q_dur = math_q_dur[np.isfinite(math_q_onsets)].tolist()
-        math_q_onsets = math_q_onsets[np.isfinite(math_q_onsets)].tolist()
-
-        story_q_onsets = np.array(df['ThatWasAbout.OnsetTime'] - df['GetReady.FinishTime'][0])
-        story_q_offsets = np.array(df['ThatWasAbout.OffsetTime'] - df['GetReady.FinishTime'][0])
-        story_q_dur = (story_q_offsets - story_q_onsets)/1000
-        story_q_dur = story_q_dur[np.isfinite(story_q_onsets)].tolist()
-        story_q_onsets = story_q_onsets[np.isfinite(story_q_onsets)].tolist()
-
-        resp_onsets = np.array(df['ResponsePeriod.OnsetTime'] - df['GetReady.FinishTime'][0])
-        resp_offsets = np.array(df['ResponsePeriod.OffsetTime'] - df['GetReady.FinishTime'][0])
-        resp_dur = (resp_offsets - resp_onsets)/1000
-        resp_dur = resp_dur[np.isfinite(resp_onsets)].tolist()
-        resp_offsets = resp_offsets[np.isfinite(resp_onsets)].tolist()
-        resp_onsets = resp_onsets[np.isfinite(resp_onsets)].tolist()
-
-        # this includes response periods and ratings, matching Barch 2013 block designs
-        # dur = (resp_offsets - onsets[np.isfinite(onsets)])/1000
-
-        # this does not include response periods or questions
-        dur = (offsets[np.isfinite(onsets)] - onsets[np.isfinite(onsets)])/1000
-        dur = dur.tolist()
-
-        # additional confounds. when excluding response periods or questions from single trials
-        confound_names.append('Task-Math-Question')
-        confound_onsets.append(math_q_onsets)
-        confound_dur.append(math_q_dur)
-
-        confound_names.append('Task-Story-Question')
-        confound_onsets.append(story_q_onsets)
-        confound_dur.append(story_q_dur)
-
-        confound_names.append('Task-Response')
-        confound_onsets.append(resp_onsets)
-        confound_dur.append(resp_dur)
-
-        onsets = onsets[np.isfinite(onsets)].tolist()
-        # drop final onsets since they are not not part of the scan and blow up VIFs
-        onsets = onsets[:12]
-        dur = dur[:12]
-
-    elif task == 'RELATIONAL':
-        # durations differ for relational and control trials, so we need to be able to
-        # disambiguate them
-        blocktype = np.array(df['BlockType'])
-
-        onsets0 = np.nanmax([df['RelationalSlide.OnsetTime'],
-                             df['ControlSlide.OnsetTime']], axis=0) - df['SyncSlide.OnsetTime'][0]
-
-        blocktype = blocktype[np.isfinite(onsets0)].tolist()
-        onsets0 = onsets0[np.isfinite(onsets0)].tolist()
-
-        i = 0
-        onsets = []
-        while i < len(onsets0):
-            if blocktype[i] == 'Relational':
-                onsets.append(onsets0[i])
-                i = i+4
-            elif blocktype[i] == 'Control':
-                onsets.append(onsets0[i])
-                i = i+5
-            else:
-                raise ValueError('Unexpected blocktype for %s %s %s' % (subject_id, task, direction))
-
-        # counting ITIs like in Barch 2013
-        dur = [18. for onset in onsets]
-    elif task == 'MOTOR':
-        # each onset corresponds to a single motor sequence. 
-        # A single finger tap, a single toe squeeze, etc. The VIFs for this are huge and likely unusable
-        if 'SyncSlide.OnsetTime' in df.keys():
-            time0 = df['SyncSlide.OnsetTime'][0]
-        elif 'CountDownSlide.OnsetTime' in df.keys():
-            time0 = df['CountDownSlide.OnsetTime'][0]
+    if task not in TASK_SPECS.get(model, {}):
+        raise ValueError('{0} is not a supported task'.format(task))
+    spec = TASK_SPECS[model][task]
+    runs = runs if runs is not None else list(range(len(dfs)))
+
+    results = [None] * len(dfs)
+
+    def fail(i, error):
+        if errors == 'raise':
+            raise error
+        results[i] = error
+
+    # runs missing a column fail the same way indexing the DataFrame would
+    good = []
+    time0_columns = []
+    for i, df in enumerate(dfs):
+        time0 = [column for column in spec['time0'] if column in df.columns]
+        missing = [column for column in _spec_columns(spec) if column not in df.columns]
+        if not time0:
+            fail(i, ValueError('No scan onset time could be found for %s' % (runs[i],)))
+        elif missing:
+            fail(i, KeyError(missing[0]))
+        else:
+            good.append(i)
+            time0_columns.append(time0[0])
+
+    if not good:
+        return results
+
+    n_runs = len(good)
+    # one extra padding row so that 'next_row' can always look one row ahead
+    n_rows = max(len(dfs[i]) for i in good) + 1
+    row_index = np.arange(n_rows)[None, :]
+
+    def stack(columns):
+        # runs x rows array of the row wise nanmax over columns
+        out = np.full((n_runs, n_rows), np.nan)
+        for j, i in enumerate(good):
+            values = dfs[i][columns].to_numpy(dtype=np.float64)
+            out[j, :len(values)] = np.fmax.reduce(values, axis=1)
+        return out
+
+    time0 = np.array([dfs[i][column].to_numpy(dtype=np.float64)[0]
+                      for i, column in zip(good, time0_columns)])
+
+    def relative(columns):
+        return stack(columns) - time0[:, None]
+
+    onsets_full = relative(spec['onsets'])
+    if 'shift' in spec:
+        onsets_full = onsets_full + spec['shift']
+
+    rows, n_onsets = _compact(np.isfinite(onsets_full))
+    valid = row_index < n_onsets[:, None]
+
+    blocktype = None
+    if 'BlockType' in _spec_columns(spec):
+        blocktype = np.full((n_runs, n_rows), np.nan, dtype=object)
+        for j, i in enumerate(good):
+            blocktype[j, :len(dfs[i])] = dfs[i]['BlockType'].to_numpy(dtype=object)
+
+    # runs that already failed in one of the steps below
+    failed = set()
+
+    stride = spec.get('stride')
+    if isinstance(stride, dict):
+        # the number of rows to skip depends on the type of the current block, so this
+        # is a (short) walk per run
+        kept = np.zeros_like(valid)
+        for j in range(n_runs):
+            types = blocktype[j, rows[j, :n_onsets[j]]]
+            k = 0
+            while k < len(types):
+                if types[k] not in stride:
+                    fail(good[j], ValueError('Unexpected blocktype for %s' % (runs[good[j]],)))
+                    failed.add(j)
+                    break
+                kept[j, k] = True
+                k = k + stride[types[k]]
+        rows = _gather(rows, _compact(kept)[0])
+        n_onsets = kept.sum(axis=1)
+    elif stride:
+        kept = valid & (row_index % stride == 0)
+        rows = _gather(rows, _compact(kept)[0])
+        n_onsets = kept.sum(axis=1)
+
+    if 'limit' in spec:
+        n_onsets = np.minimum(n_onsets, spec['limit'])
+
+    def durations(rule, onsets, rows, n):
+        # returns a runs x rows array of durations and the number of durations per run
+        kind = rule[0]
+        if kind == 'const':
+            return np.full(onsets.shape, rule[1]), n
+        if kind == 'blocktype':
+            types = _gather(blocktype, rows)
+            values = np.full(onsets.shape, rule[2])
+            for name, value in rule[1].items():
+                values[types == name] = value
+            return values, n
+        if kind == 'offset':
+            return (_gather(relative(rule[1]), rows) - onsets)/1000, n
+        if kind == 'next_row':
+            return (_gather(relative(rule[1]), np.minimum(rows + 1, n_rows - 1)) - onsets)/1000., n
+        if kind == 'next_offset':
+            options = rule[1]
+            offsets_full = relative(options['columns'])
+            offset_rows, n_offsets = _compact(np.isfinite(offsets_full))
+            offsets = np.concatenate([_gather(offsets_full, offset_rows),
+                                      np.full((n_runs, 1), np.nan)], axis=1)
+            if options.get('end'):
+                end = np.array([dfs[i][options['end']].to_numpy(dtype=np.float64)[0] for i in good])
+                offsets[np.arange(n_runs), n_offsets] = end - time0
+                n_offsets = n_offsets + 1
+            if options.get('override'):
+                column, start, step = options['override']
+                override_full = relative([column])
+                override_rows, n_override = _compact(np.isfinite(override_full))
+                override = _gather(override_full, override_rows)
+                positions = np.arange(offsets.shape[1])[None, :]
+                slots = (positions >= start) & ((positions - start) % step == 0) & \
+                        (positions < n_offsets[:, None])
+                n_slots = slots.sum(axis=1)
+                for j in np.where(n_slots != n_override)[0]:
+                    fail(good[j], ValueError('attempt to assign sequence of size %d to extended slice '
+                                             'of size %d for %s' % (n_override[j], n_slots[j], runs[good[j]])))
+                    failed.add(j)
+                # the k-th slot takes the k-th override value
+                rank = np.clip((positions - start) // step, 0, n_rows - 1)
+                ok = (n_slots == n_override)[:, None] & slots
+                offsets[ok] = _gather(override, np.broadcast_to(rank, offsets.shape))[ok]
+            skip = options['skip']
+            next_offsets = offsets[:, skip:skip + onsets.shape[1]]
+            return (next_offsets - onsets)/1000., np.minimum(n, np.maximum(n_offsets - skip, 0))
+        raise ValueError('Unknown duration rule %s' % kind)
+
+    onsets = _gather(onsets_full, rows)
+    dur, n_dur = durations(spec['duration'], onsets, rows, n_onsets)
+    onsets = onsets/1000.
+
+    confounds = []
+    for confound in spec.get('confounds', []):
+        confound_full = relative(confound['onsets'])
+        if confound['rows'] == 'task':
+            confound_rows, n_confound = rows, n_onsets
+            last_row = np.array([len(dfs[i]) - 1 for i in good])
+            if confound['duration'][0] == 'next_row':
+                for j in range(n_runs):
+                    if n_onsets[j] and rows[j, n_onsets[j] - 1] >= last_row[j]:
+                        fail(good[j], IndexError('%s: no row after the last %s onset' %
+                                                 (runs[good[j]], confound['name'])))
+                        failed.add(j)
         else:
-            raise ValueError('No scan onset time could be found for subject %s %s_%s' % (subject_id, task, direction))
-
-        onsets = np.nanmax([df['RightHandCue.OnsetTime'],
-                            df['LeftHandCue.OnsetTime'],
-                            df['RightFootCue.OnsetTime'], 
-                            df['LeftFootCue.OnsetTime'],
-                            df['TongueCue.OnsetTime']],axis=0) - time0 + 3000
-
-        onsets = onsets[np.isfinite(onsets)].tolist()
-        dur = [12. for i in range(0,len(onsets))]
-    elif task == 'WM':
-        onsets = df['Stim.OnsetTime'] - df['SyncSlide.OnsetTime'][0]
-        onsets = [onset for onset in onsets.tolist() if not np.isnan(onset)]
-        onsets = onsets[::10]
-        
-        offsets = np.nanmax([df['Cue2Back.OnsetTime'],
-                             df['CueTarget.OnsetTime']], axis=0) - df['SyncSlide.OnsetTime'][0]
-        offsets = [offset for offset in offsets.tolist() if not np.isnan(offset)]
-        offsets = offsets + [df['ExpInstrucFeelFreeToRest.StartTime'][0] - df['SyncSlide.OnsetTime'][0]]
-
-        # every second block is followed by 15s of fixation, so we need to overwrite some offsets accordingly
-        offsets2 = df['Fix15sec.OnsetTime'] - df['SyncSlide.OnsetTime'][0]
-        offsets2 = [offset for offset in offsets2.tolist() if not np.isnan(offset)]
-        offsets[2::2] = offsets2
-
-
-        # includes ITI per Barch 2013 definition of a 'trial'
-        dur = [(off - on)/1000. for on,off in zip(onsets, offsets[1:])]
-        assert(max(dur) < 30, 'Could not retrieve sensible directions for %s %s task!' % (direction,task))
-    else:
+            confound_rows, n_confound = _compact(np.isfinite(confound_full))
+        confound_onsets = _gather(confound_full, confound_rows)
+        confound_dur, n_confound_dur = durations(confound['duration'], confound_onsets,
+                                                 confound_rows, n_confound)
+        confounds.append((confound['name'], confound_onsets/1000, n_confound,
+                          confound_dur, n_confound_dur))
+
+    for j, i in enumerate(good):
+        if j in failed:
+            continue
+
+        these_onsets = onsets[j, :n_onsets[j]].tolist()
+        these_dur = dur[j, :n_dur[j]].tolist()
+
+        if len(these_onsets) >= 100:
+            fail(i, ValueError('%d single trials found for %s, which is not supported by our '
+                               'indexing scheme.' % (len(these_onsets), runs[i])))
+            continue
+        if 'max_duration' in spec and not (these_dur and max(these_dur) < spec['max_duration']):
+            fail(i, ValueError('Could not retrieve sensible durations for %s' % (runs[i],)))
+            continue
+
+        # we need a list of lists, with one list per task
+        # in order for subsequent code to work correctly, we must have trials first
+        names = ['Task-%02d' % k for k in range(0, len(these_onsets))]
+        these_onsets = [[onset] for onset in these_onsets]
+        these_dur = [[d] for d in these_dur]
+
+        for name, confound_onsets, n_confound, confound_dur, n_confound_dur in confounds:
+            names.append(name)
+            these_onsets.append(confound_onsets[j, :n_confound[j]].tolist())
+            these_dur.append(confound_dur[j, :n_confound_dur[j]].tolist())
+
+        results[i] = (names, these_onsets, these_dur)
+
+    return results
+
+
+def batch_events(runs, model, errors='return'):
+    '''
+    events for a list of (subject_id, task, direction) runs under the 'trial' or
+    'block' model. Runs are grouped by task and each group goes through
+    extract_events in one batch. Returns a list in the order of runs, see
+    extract_events for errors.
+    '''
+    results = [None] * len(runs)
+    by_task = {}
+    for k, run in enumerate(runs):
+        by_task.setdefault(run[1], []).append(k)
+
+    for task, indices in by_task.items():
+        dfs, ok = [], []
+        for k in indices:
+            try:
+                dfs.append(read_eprime(*runs[k]))
+                ok.append(k)
+            except Exception as e:
+                if errors == 'raise':
+                    raise
+                results[k] = e
+        if task not in TASK_SPECS.get(model, {}):
+            error = ValueError('{0} is not a supported task'.format(task))
+            if errors == 'raise':
+                raise error
+            for k in ok:
+                results[k] = error
+            continue
+        for k, events in zip(ok, extract_events(dfs, task, model, runs=[runs[k] for k in ok],
+                                                errors=errors)):
+            results[k] = events
+
+    return results
+
+
+def trial_events(subject_id, task, direction):
+    # subject_id: e.g. 100307
+    # task: e.g. EMOTION. Must match one of the task conditions in TASK_SPECS
+    # directoin: LR|RL. determines which eprime and HCP block deisgn data to use for constructing the design
+    #
+    # this function returns single trials for all events in chronological order. Unlike the version in
+    # the traditional single trial analysis, there are no confound regressors. These need to be configured
+    # in subjecteventinfo if you want them
+    print("Subject ID: %s\n" % str(subject_id))
+
+    if task not in TASK_SPECS['trial']:
         raise ValueError('{0} is not a supported task'.format(task))
 
-    assert(len(onsets) < 100, 
-        '%d single trials found, which is not supported by our indexing scheme.' % len(onsets))
+    df = read_eprime(subject_id, task, direction)
+    return extract_events([df], task, 'trial', runs=[(subject_id, task, direction)])[0]
 
-    # we need a list of lists, with one list per task
-    onsets = [[onset/1000.] for onset in onsets]
-    dur = [[d] for d in dur]
-    names = ['Task-%02d' % i for i in range(0,len(onsets))]
 
-    if confound_names:
-        names += confound_names
-        onsets += [[onset/1000 for onset in these_onsets]
-                   for these_onsets in confound_onsets]
-        dur += confound_dur
+def block_events(subject_id, task, direction):
+    # as trial_events, but with one event per block and, for some tasks, confound
+    # events (e.g. response periods) after the blocks
+    print("Subject ID: %s\n" % str(subject_id))
+
+    if task not in TASK_SPECS['block']:
+        raise ValueError('{0} is not a supported task'.format(task))
+
+    df = read_eprime(subject_id, task, direction)
+    return extract_events([df], task, 'block', runs=[(subject_id, task, direction)])[0]
+
 
-    return names, onsets, dur
-    
-    
 def hcp_events(subject_id, task, direction):
     import pandas as pd
-    
+
     print("Subject ID: %s\n" % str(subject_id))
-    output = []
-    
+
     data_dir = '/dartfs/rc/lab/D/DBIC/DBIC/archive/HCP/HCP1200/'
-    
-    # task specific variables
-    if task == 'EMOTION':
-        names = ['Task-Faces', 'Task-Shapes']
-
-        fear_path = data_dir + \
-                    '/%s/MNINonLinear/Results/tfMRI_%s_%s/EVs/fear.txt' % \
-                    (subject_id, task, direction)
-        neut_path = data_dir + \
-                    '/%s/MNINonLinear/Results/tfMRI_%s_%s/EVs/neut.txt' % \
-                    (subject_id, task, direction)
-
-        fear_df = pd.read_csv(fear_path, header=None, delimiter='\t', na_values=[''])
-        neut_df = pd.read_csv(neut_path, header=None, delimiter='\t', na_values=[''])
-        
-        onsets = [fear_df[0].tolist(), neut_df[0].tolist()]
-        dur = [fear_df[1].tolist(), neut_df[1].tolist()]
-    elif task == 'GAMBLING':
-        names = ['Task-Punish', 'Task-Reward']
-
-        loss_path = data_dir + \
-                    '/%s/MNINonLinear/Results/tfMRI_%s_%s/EVs/loss.txt' % \
-                    (subject_id, task, direction)
-        win_path = data_dir + \
-                    '/%s/MNINonLinear/Results/tfMRI_%s_%s/EVs/win.txt' % \
-                    (subject_id, task, direction)
-
-        loss_df = pd.read_csv(loss_path, header=None, delimiter='\t', na_values=[''])
-        win_df = pd.read_csv(win_path, header=None, delimiter='\t', na_values=[''])
-        
-        onsets = [loss_df[0].tolist(), win_df[0].tolist()]
-        dur = [loss_df[1].tolist(), win_df[1].tolist()]
-    elif task == 'SOCIAL':
-        names = ['Task-Random', 'Task-TOM']
-
-        rnd_path = data_dir + \
-                    '/%s/MNINonLinear/Results/tfMRI_%s_%s/EVs/rnd.txt' % \
-                    (subject_id, task, direction)
-        tom_path = data_dir + \
-                    '/%s/MNINonLinear/Results/tfMRI_%s_%s/EVs/mental.txt' % \
-                    (subject_id, task, direction)
-
-        rnd_df = pd.read_csv(rnd_path, header=None, delimiter='\t', na_values=[''])
-        tom_df = pd.read_csv(tom_path, header=None, delimiter='\t', na_values=[''])
-        
-        onsets = [rnd_df[0].tolist(), tom_df[0].tolist()]
-        dur = [rnd_df[1].tolist(), tom_df[1].tolist()]
-    elif task == 'LANGUAGE':
-        names = ['Task-Math', 'Task-Story']
-
-        math_path = data_dir + \
-                    '/%s/MNINonLinear/Results/tfMRI_%s_%s/EVs/math.txt' % \
-                    (subject_id, task, direction)
-        story_path = data_dir + \
-                    '/%s/MNINonLinear/Results/tfMRI_%s_%s/EVs/story.txt' % \
-                    (subject_id, task, direction)
-
-        math_df = pd.read_csv(math_path, header=None, delimiter='\t', na_values=[''])
-        story_df = pd.read_csv(story_path, header=None, delimiter='\t', na_values=[''])
-        
-        onsets = [math_df[0].tolist(), story_df[0].tolist()]
-        dur = [math_df[1].tolist(), story_df[1].tolist()]
-    elif task == 'RELATIONAL':
-        names = ['Task-Match', 'Task-Rel']
-
-        match_path = data_dir + \
-                    '/%s/MNINonLinear/Results/tfMRI_%s_%s/EVs/match.txt' % \
-                    (subject_id, task, direction)
-        rel_path = data_dir + \
-                    '/%s/MNINonLinear/Results/tfMRI_%s_%s/EVs/relation.txt' % \
-                    (subject_id, task, direction)
-
-        match_df = pd.read_csv(match_path, header=None, delimiter='\t', na_values=[''])
-        rel_df = pd.read_csv(rel_path, header=None, delimiter='\t', na_values=[''])
-        
-        onsets = [match_df[0].tolist(), rel_df[0].tolist()]
-        dur = [match_df[1].tolist(), rel_df[1].tolist()]
-    elif task == 'MOTOR':
-        names = ['Task-Cue', 'Task-LF', 'Task-LH', 'Task-RF', 'Task-RH', 'Task-Tongue']
-
-        cue_path = data_dir + \
-                    '/%s/MNINonLinear/Results/tfMRI_%s_%s/EVs/cue.txt' % \
-                    (subject_id, task, direction)
-        lf_path = data_dir + \
-                    '/%s/MNINonLinear/Results/tfMRI_%s_%s/EVs/lf.txt' % \
-                    (subject_id, task, direction)
-        lh_path = data_dir + \
-                    '/%s/MNINonLinear/Results/tfMRI_%s_%s/EVs/lh.txt' % \
-                    (subject_id, task, direction)
-        rf_path = data_dir + \
-                    '/%s/MNINonLinear/Results/tfMRI_%s_%s/EVs/rf.txt' % \
-                    (subject_id, task, direction)
-        rh_path = data_dir + \
-                    '/%s/MNINonLinear/Results/tfMRI_%s_%s/EVs/rh.txt' % \
-                    (subject_id, task, direction)
-        t_path = data_dir + \
-                    '/%s/MNINonLinear/Results/tfMRI_%s_%s/EVs/t.txt' % \
-                    (subject_id, task, direction)
-
-        cue_df = pd.read_csv(cue_path, header=None, delimiter='\t', na_values=[''])
-        lf_df = pd.read_csv(lf_path, header=None, delimiter='\t', na_values=[''])
-        lh_df = pd.read_csv(lh_path, header=None, delimiter='\t', na_values=[''])
-        rf_df = pd.read_csv(rf_path, header=None, delimiter='\t', na_values=[''])
-        rh_df = pd.read_csv(rh_path, header=None, delimiter='\t', na_values=[''])
-        t_df = pd.read_csv(t_path, header=None, delimiter='\t', na_values=[''])
-        
-        onsets = [cue_df[0].tolist(), lf_df[0].tolist(), lh_df[0].tolist(), rf_df[0].tolist(), rh_df[0].tolist(), t_df[0].tolist()]
-        dur = [cue_df[1].tolist(), lf_df[1].tolist(), lh_df[1].tolist(), rf_df[1].tolist(), rh_df[1].tolist(), t_df[1].tolist()]
-    elif task == 'WM':
-        names = ['Task-2bk-Body', 'Task-2bk-Face', 'Task-2bk-Place', 'Task-2bk-Tool',
-                 'Task-0bk-Body', 'Task-0bk-Face', 'Task-0bk-Place', 'Task-0bk-Tool']
-
-        bk2_body_path = data_dir + \
-                    '/%s/MNINonLinear/Results/tfMRI_%s_%s/EVs/2bk_body.txt' % \
-                    (subject_id, task, direction)
-        bk2_faces_path = data_dir + \
-                    '/%s/MNINonLinear/Results/tfMRI_%s_%s/EVs/2bk_faces.txt' % \
-                    (subject_id, task, direction)
-        bk2_places_path = data_dir + \
-                    '/%s/MNINonLinear/Results/tfMRI_%s_%s/EVs/2bk_places.txt' % \
-                    (subject_id, task, direction)
-        bk2_tools_path = data_dir + \
-                    '/%s/MNINonLinear/Results/tfMRI_%s_%s/EVs/2bk_tools.txt' % \
-                    (subject_id, task, direction)
-        bk0_body_path = data_dir + \
-                    '/%s/MNINonLinear/Results/tfMRI_%s_%s/EVs/0bk_body.txt' % \
-                    (subject_id, task, direction)
-        bk0_faces_path = data_dir + \
-                    '/%s/MNINonLinear/Results/tfMRI_%s_%s/EVs/0bk_faces.txt' % \
-                    (subject_id, task, direction)
-        bk0_places_path = data_dir + \
-                    '/%s/MNINonLinear/Results/tfMRI_%s_%s/EVs/0bk_places.txt' % \
-                    (subject_id, task, direction)
-        bk0_tools_path = data_dir + \
-                    '/%s/MNINonLinear/Results/tfMRI_%s_%s/EVs/0bk_tools.txt' % \
-                    (subject_id, task, direction)
-
-        bk2_body_df = pd.read_csv(bk2_body_path, header=None, delimiter='\t', na_values=[''])
-        bk2_faces_df = pd.read_csv(bk2_faces_path, header=None, delimiter='\t', na_values=[''])
-        bk2_places_df = pd.read_csv(bk2_places_path, header=None, delimiter='\t', na_values=[''])
-        bk2_tools_df = pd.read_csv(bk2_tools_path, header=None, delimiter='\t', na_values=[''])
-        bk0_body_df = pd.read_csv(bk0_body_path, header=None, delimiter='\t', na_values=[''])
-        bk0_faces_df = pd.read_csv(bk0_faces_path, header=None, delimiter='\t', na_values=[''])
-        bk0_places_df = pd.read_csv(bk0_places_path, header=None, delimiter='\t', na_values=[''])
-        bk0_tools_df = pd.read_csv(bk0_tools_path, header=None, delimiter='\t', na_values=[''])
-        
-        onsets = [bk2_body_df[0].tolist(), bk2_faces_df[0].tolist(), bk2_places_df[0].tolist(), bk2_tools_df[0].tolist(), bk0_body_df[0].tolist(), bk0_faces_df[0].tolist(), bk0_places_df[0].tolist(), bk0_tools_df[0].tolist()]
-        dur = [bk2_body_df[1].tolist(), bk2_faces_df[1].tolist(), bk2_places_df[1].tolist(), bk2_tools_df[1].tolist(), bk0_body_df[1].tolist(), bk0_faces_df[1].tolist(), bk0_places_df[1].tolist(), bk0_tools_df[1].tolist()]
-    else:
+
+    if task not in HCP_EV_SPECS:
         raise ValueError('{0} is not a supported task'.format(task))
 
+    names, onsets, dur = [], [], []
+    for name, ev_file in HCP_EV_SPECS[task]:
+        ev_path = data_dir + \
+                  '/%s/MNINonLinear/Results/tfMRI_%s_%s/EVs/%s' % \
+                  (subject_id, task, direction, ev_file)
+        ev_df = pd.read_csv(ev_path, header=None, delimiter='\t', na_values=[''])
+
+        names.append(name)
+        onsets.append(ev_df[0].tolist())
+        dur.append(ev_df[1].tolist())
+
     return names, onsets, dur
-    
-    
+
 
 def select_trials(contrast_names):
     import re
@@ -0,0 +1,157 @@
+import os
+import json
+import sqlite3
+
+# Cohort event database
+#
+# A single SQLite file with the (names, onsets, dur) of every subject x task x
+# direction under each event model in glm.designs ('trial', 'block' and 'hcp').
+# It is built once with build_event_db (see subjectlevel/hcp_build_event_db.py),
+# after which glm.designs.lookup_events answers from an indexed primary key
+# instead of parsing E-Prime or EV files inside every subjectinfo node.
+#
+# Events are stored as JSON, which round trips python floats exactly, so lookups
+# return the very same tuples the event functions would. Runs whose events could
+# not be extracted are recorded with their error message, so that the lookup can
+# raise the same kind of error without going back to the filesystem.
+
+EVENT_MODELS = ('trial', 'block', 'hcp')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS events (
+    subject_id TEXT NOT NULL,
+    task TEXT NOT NULL,
+    direction TEXT NOT NULL,
+    model TEXT NOT NULL,
+    names TEXT,
+    onsets TEXT,
+    dur TEXT,
+    error TEXT,
+    PRIMARY KEY (subject_id, task, direction, model)
+) WITHOUT ROWID
+'''
+
+# one read only connection per process and database, opened on first use
+_connections = {}
+
+
+def _event_function(model):
+    from glm.designs import trial_events, block_events, hcp_events
+
+    functions = {'trial': trial_events, 'block': block_events, 'hcp': hcp_events}
+    if model not in functions:
+        raise ValueError('%s is not a supported event model. Use one of %s' % (model, EVENT_MODELS))
+    return functions[model]
+
+
+def _item(value):
+    return value.item()
+
+
+def _event_row(subject_id, task, direction, model, events):
+    if isinstance(events, Exception):
+        return (str(subject_id), task, direction, model, None, None, None,
+                '%s: %s' % (type(events).__name__, events))
+    names, onsets, dur = events
+    # numpy scalars are stored as the python numbers .tolist() would give
+    return (str(subject_id), task, direction, model,
+            json.dumps(names), json.dumps(onsets, default=_item), json.dumps(dur, default=_item), None)
+
+
+def _extract_events(jobs):
+    # jobs all share task and model, so E-Prime based models go through one batch
+    from glm.designs import batch_events
+
+    model = jobs[0][3]
+    runs = [job[:3] for job in jobs]
+    if model in ('trial', 'block'):
+        events = batch_events(runs, model, errors='return')
+    else:
+        events = []
+        for run in runs:
+            try:
+                events.append(_event_function(model)(*run))
+            except Exception as e:
+                events.append(e)
+
+    return [_event_row(*job, these_events) for job, these_events in zip(jobs, events)]
+
+
+def find_subjects(data_dir='/dartfs/rc/lab/D/DBIC/DBIC/archive/HCP/HCP1200/'):
+    # HCP subject directories are named by their numeric subject id
+    return sorted(entry.name for entry in os.scandir(data_dir)
+                  if entry.is_dir() and entry.name.isdigit())
+
+
+def build_event_db(db_path, subject_ids, tasks, directions, models=EVENT_MODELS, n_procs=1,
+                   overwrite=False):
+    '''
+    extracts the events of every subject x task x direction x model over a process
+    pool and stores them in the SQLite file db_path. Workers only parse files; all
+    writes happen here, in one transaction per batch, so no locking is needed.
+    Runs already in the database are skipped unless overwrite=True (runs that
+    failed before, e.g. because of a filesystem hiccup, are retried). Returns the
+    number of (run, model) rows written.
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+
+    connection = sqlite3.connect(db_path)
+    connection.execute(SCHEMA)
+
+    jobs = [(str(s), t, d, m) for s in subject_ids for t in tasks for d in directions for m in models]
+    if not overwrite:
+        done = set(connection.execute('SELECT subject_id, task, direction, model FROM events '
+                                     'WHERE error IS NULL'))
+        jobs = [job for job in jobs if job not in done]
+
+    # batches of runs of the same task and model
+    batch_size = 32
+    batches = []
+    for key in sorted({(job[1], job[3]) for job in jobs}):
+        these_jobs = [job for job in jobs if (job[1], job[3]) == key]
+        batches += [these_jobs[k:k + batch_size] for k in range(0, len(these_jobs), batch_size)]
+
+    insert = 'INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
+    if n_procs > 1:
+        with ProcessPoolExecutor(max_workers=n_procs) as pool:
+            for rows in pool.map(_extract_events, batches):
+                with connection:
+                    connection.executemany(insert, rows)
+    else:
+        for batch in batches:
+            with connection:
+                connection.executemany(insert, _extract_events(batch))
+
+    connection.close()
+    return len(jobs)
+
+
+def _connect(db_path):
+    connection = _connections.get(db_path)
+    if connection is None:
+        connection = sqlite3.connect('file:%s?mode=ro' % os.path.abspath(db_path), uri=True,
+                                     check_same_thread=False)
+        _connections[db_path] = connection
+    return connection
+
+
+def query_events(db_path, subject_id, task, direction, model):
+    '''
+    returns (names, onsets, dur) for a run, or None if the run is not in the
+    database. Runs that failed at build time raise a ValueError with the
+    original error message.
+    '''
+    row = _connect(db_path).execute(
+        'SELECT names, onsets, dur, error FROM events '
+        'WHERE subject_id = ? AND task = ? AND direction = ? AND model = ?',
+        (str(subject_id), task, direction, model)).fetchone()
+
+    if row is None:
+        return None
+
+    names, onsets, dur, error = row
+    if error is not None:
+        raise ValueError('Events for %s %s_%s (%s) could not be extracted when %s was built: %s'
+                         % (subject_id, task, direction, model, db_path, error))
+
+    return json.loads(names), json.loads(onsets), json.loads(dur)
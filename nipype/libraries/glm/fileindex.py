@@ -0,0 +1,173 @@
+import os
+import glob
+import fnmatch
+import sqlite3
+
+# Single pass file index of the HCP1200 tree
+#
+# DataGrabber resolves every template with glob, and glob lists (and stats) the
+# directory on every call. On a network filesystem, with several templates per
+# iterable and 1200 subjects, that adds up to hundreds of thousands of metadata
+# requests just to schedule a cohort. build_file_index scans the tree once and
+# stores the listing of every directory in a SQLite file (one row per directory,
+# names joined by newlines). FileIndex.glob then answers glob patterns from that
+# listing with a single indexed lookup per directory.
+#
+# Patterns outside the indexed root, in directories that weren't scanned, or that
+# match nothing in the index fall back to glob.glob, so an index that is missing
+# files added after the scan costs an extra glob rather than a missing input.
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    names TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+) WITHOUT ROWID;
+'''
+
+# open indices per process, by path
+_indices = {}
+
+
+def _scan(root, top):
+    # list every directory under top, as (path relative to root, names) pairs
+    listings = []
+    stack = [top]
+    while stack:
+        path = stack.pop()
+        try:
+            entries = list(os.scandir(path))
+        except OSError:
+            continue
+        listings.append((os.path.relpath(path, root), '\n'.join(sorted(entry.name for entry in entries))))
+        stack += [entry.path for entry in entries if entry.is_dir(follow_symlinks=False)]
+    return listings
+
+
+def build_file_index(index_file, root, prefixes=('MNINonLinear',), subject_ids=None, n_threads=16):
+    '''
+    scans root/<subject_id>/<prefix> for every subject and prefix and writes the
+    listings to index_file. Subjects default to every numeric directory in root.
+    Listing directories is I/O bound, so subjects are scanned by a thread pool.
+    Returns the number of directories indexed.
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    root = os.path.abspath(root)
+    if subject_ids is None:
+        subject_ids = sorted(entry.name for entry in os.scandir(root)
+                             if entry.is_dir() and entry.name.isdigit())
+
+    tops = [os.path.join(root, str(subject_id), prefix) for subject_id in subject_ids for prefix in prefixes]
+
+    tmp = '%s.%d.tmp' % (index_file, os.getpid())
+    connection = sqlite3.connect(tmp)
+    connection.executescript(SCHEMA)
+
+    n_dirs = 0
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        for listings in pool.map(lambda top: _scan(root, top), tops):
+            with connection:
+                connection.executemany('INSERT OR REPLACE INTO dirs VALUES (?, ?)', listings)
+            n_dirs += len(listings)
+
+    with connection:
+        connection.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                               [('root', root), ('prefixes', '\n'.join(prefixes))])
+    connection.close()
+
+    # readers never see a partially written index
+    os.replace(tmp, index_file)
+
+    return n_dirs
+
+
+class FileIndex:
+    '''
+    read only view of an index written by build_file_index
+
+    index_file - path to the index
+    '''
+    def __init__(self, index_file):
+        self.index_file = os.path.abspath(index_file)
+        self.connection = sqlite3.connect('file:%s?mode=ro' % self.index_file, uri=True,
+                                          check_same_thread=False)
+        self.root = self.connection.execute("SELECT value FROM meta WHERE key = 'root'").fetchone()[0]
+
+    def listdir(self, path):
+        # names in the directory path (relative to root), or None if it was not indexed
+        row = self.connection.execute('SELECT names FROM dirs WHERE path = ?', (path,)).fetchone()
+        if row is None:
+            return None
+        return row[0].split('\n') if row[0] else []
+
+    def _dirs(self, pattern):
+        # indexed directories matching a pattern with wildcards, at the same depth
+        depth = pattern.count('/')
+        return [path for (path,) in self.connection.execute('SELECT path FROM dirs WHERE path GLOB ?', (pattern,))
+                if path.count('/') == depth and fnmatch.fnmatchcase(path, pattern)]
+
+    def glob(self, pattern):
+        '''
+        glob.glob(pattern) answered from the index, or None if the pattern isn't
+        covered by it. Like glob, names starting with a dot only match patterns
+        that start with a dot.
+        '''
+        pattern = os.path.abspath(pattern)
+        if os.path.commonpath([pattern, self.root]) != self.root:
+            return None
+
+        dirname, basename = os.path.split(os.path.relpath(pattern, self.root))
+
+        if glob.has_magic(dirname):
+            dirs = self._dirs(dirname)
+        else:
+            dirs = [dirname]
+
+        matches = []
+        covered = False
+        for path in dirs:
+            names = self.listdir(path)
+            if names is None:
+                continue
+            covered = True
+            if glob.has_magic(basename):
+                names = fnmatch.filter(names, basename)
+                if not basename.startswith('.'):
+                    names = [name for name in names if not name.startswith('.')]
+            elif basename not in names:
+                continue
+            else:
+                names = [basename]
+            matches += [os.path.join(self.root, path, name) for name in names]
+
+        if not covered:
+            return None
+
+        return matches
+
+
+def open_index(index_file):
+    # FileIndex for index_file, opened once per process
+    index_file = os.path.abspath(index_file)
+    if index_file not in _indices:
+        _indices[index_file] = FileIndex(index_file)
+    return _indices[index_file]
+
+
+def indexed_glob(pattern, index_file=None):
+    '''
+    drop in replacement for glob.glob that uses the file index in index_file (or
+    the HCP_FILE_INDEX environment variable) when it covers pattern and finds a
+    match, and glob.glob otherwise
+    '''
+    index_file = index_file or os.getenv('HCP_FILE_INDEX')
+    if index_file and os.path.exists(index_file):
+        matches = open_index(index_file).glob(pattern)
+        if matches:
+            return matches
+
+    return glob.glob(pattern)
@@ -0,0 +1,189 @@
+import os
+import csv
+import math
+import re
+
+import numpy as np
+
+from nipype_ext.vifs import batched_vif
+
+# Design-only screening of HCP runs.
+#
+# This builds the convolved task design for each subject x task x direction from
+# the same event functions the subjectlevel pipelines use and computes the VIFs and
+# efficiencies of the contrasts of interest, without touching any imaging data. The
+# result is a manifest with one accept/reject row per run that the hcp_* entry points
+# read (--manifest) to only schedule runs whose designs are usable.
+#
+# The design is an approximation of what FEATModel produces: boxcars convolved with
+# a double gamma HRF (SPM/FSL canonical shape), sampled at the start of each volume
+# and demeaned. It leaves out FEAT's temporal filtering of the EVs and any nuisance
+# regressors (motion, CSF, outliers), which need the imaging data. That is good
+# enough to catch the designs that blow up (e.g. single trial MOTOR), which is what
+# this is for, but the VIFs will not match vifs.csv from the full pipeline exactly.
+
+# number of volumes in each HCP task fMRI run
+HCP_NUM_VOLUMES = {'EMOTION': 176,
+                   'GAMBLING': 253,
+                   'LANGUAGE': 316,
+                   'MOTOR': 284,
+                   'RELATIONAL': 232,
+                   'SOCIAL': 274,
+                   'WM': 405}
+
+# which conditions are screened for each event model. These match the contrasts
+# the corresponding pipelines estimate (select_trials/select_contrasts)
+CONTRAST_PATTERNS = {'trial': r'^Task-\d+$',
+                     'block': r'^Task-\d+$',
+                     'hcp': r'^Task-.*$'}
+
+MANIFEST_FIELDS = ['subject_id', 'task', 'direction', 'status',
+                   'n_contrasts', 'max_vif', 'min_efficiency', 'reason']
+
+
+def double_gamma_hrf(dt, length=32.):
+    # canonical double gamma: gamma(6,1) response minus 1/6 of a gamma(16,1) undershoot
+    t = np.arange(dt, length, dt)
+    def gammapdf(t, shape):
+        return np.exp((shape - 1)*np.log(t) - t - math.lgamma(shape))
+    hrf = gammapdf(t, 6) - gammapdf(t, 16)/6.
+    return np.concatenate([[0.], hrf / hrf.sum()])
+
+
+def build_design(onsets, durations, n_vols, TR, dt=0.05):
+    '''
+    onsets, durations - lists with one list of onsets/durations (in seconds) per
+                        condition, as returned by glm.designs
+    returns an n_vols x n_conditions demeaned design matrix
+    '''
+    n_hires = int(math.ceil(n_vols * TR / dt))
+    hrf = double_gamma_hrf(dt)
+    sample_idx = np.round(np.arange(n_vols) * TR / dt).astype(int)
+
+    X = np.zeros((n_vols, len(onsets)))
+    for i, (these_onsets, these_dur) in enumerate(zip(onsets, durations)):
+        boxcar = np.zeros(n_hires)
+        for onset, dur in zip(these_onsets, these_dur):
+            start = int(round(onset / dt))
+            stop = max(int(round((onset + dur) / dt)), start + 1)
+            boxcar[max(start, 0):max(min(stop, n_hires), 0)] = 1.
+        X[:, i] = np.convolve(boxcar, hrf)[:n_hires][sample_idx]
+
+    return X - X.mean(axis=0)
+
+
+def design_diagnostics(X, names, pattern):
+    '''
+    VIFs and efficiencies of the conditions whose name matches pattern. Each of these
+    conditions is treated as a [0 .. 1 .. 0] contrast, like select_trials does.
+    Efficiency is 1/(c' inv(X'X) c), i.e. inversely proportional to the variance of
+    the contrast estimate.
+    '''
+    is_contrast = np.array([bool(re.match(pattern, name)) for name in names])
+
+    vifs = batched_vif(X)[is_contrast]
+
+    with np.errstate(divide='ignore'):
+        XtX_inv_diag = np.diag(np.linalg.pinv(X.T @ X))
+        efficiency = 1. / XtX_inv_diag[is_contrast]
+
+    return vifs, efficiency
+
+
+def screen_run(subject_id, task, direction, events='trial', TR=0.72,
+               max_vif=10., min_efficiency=None):
+    # returns one manifest row (a dict) for a single run
+    from glm.designs import lookup_events
+
+    row = dict(subject_id=str(subject_id), task=task, direction=direction,
+               status='reject', n_contrasts=0, max_vif='', min_efficiency='', reason='')
+    try:
+        names, onsets, dur = lookup_events(subject_id, task, direction, events)
+        X = build_design(onsets, dur, HCP_NUM_VOLUMES[task], TR)
+        vifs, efficiency = design_diagnostics(X, names, CONTRAST_PATTERNS[events])
+    except Exception as e:
+        row['reason'] = 'error: %s' % str(e).replace('\n', ' ')
+        return row
+
+    row['n_contrasts'] = len(vifs)
+    if len(vifs) == 0:
+        row['reason'] = 'no contrasts of interest'
+        return row
+
+    row['max_vif'] = float(np.max(vifs))
+    row['min_efficiency'] = float(np.min(efficiency))
+
+    reasons = []
+    if not row['max_vif'] <= max_vif:
+        reasons.append('max VIF %.3g > %.3g' % (row['max_vif'], max_vif))
+    if min_efficiency is not None and not row['min_efficiency'] >= min_efficiency:
+        reasons.append('min efficiency %.3g < %.3g' % (row['min_efficiency'], min_efficiency))
+
+    if reasons:
+        row['reason'] = '; '.join(reasons)
+    else:
+        row['status'] = 'accept'
+
+    return row
+
+
+def _screen_run(kwargs):
+    return screen_run(**kwargs)
+
+
+def run_preflight(subject_ids, tasks, directions, manifest, n_procs=1, **kwargs):
+    '''
+    screen every subject x task x direction over a process pool and write the
+    manifest csv. kwargs are passed on to screen_run. Returns the manifest rows.
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+
+    jobs = [dict(subject_id=s, task=t, direction=d, **kwargs)
+            for s in subject_ids for t in tasks for d in directions]
+
+    if n_procs > 1:
+        with ProcessPoolExecutor(max_workers=n_procs) as pool:
+            rows = list(pool.map(_screen_run, jobs, chunksize=max(1, len(jobs) // (4*n_procs))))
+    else:
+        rows = [_screen_run(job) for job in jobs]
+
+    manifest_dir = os.path.dirname(os.path.abspath(manifest))
+    os.makedirs(manifest_dir, exist_ok=True)
+    with open(manifest, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=MANIFEST_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    return rows
+
+
+def read_manifest(manifest):
+    # returns the set of accepted (subject_id, task, direction) tuples
+    with open(manifest, newline='') as file:
+        return {(row['subject_id'], row['task'], row['direction'])
+                for row in csv.DictReader(file) if row['status'] == 'accept'}
+
+
+def accepted_runs(manifest, subject_ids, tasks, directions):
+    # the accepted subset of subject_ids x tasks x directions, in the order nipype would iterate over them
+    accepted = read_manifest(manifest)
+    return [(s, t, d) for s in subject_ids for t in tasks for d in directions
+            if (str(s), t, d) in accepted]
+
+
+def accepted_sessions(manifest, subject_ids, tasks, directions=('LR', 'RL')):
+    # subject_id x task pairs for which all directions were accepted, e.g. for second level models
+    accepted = read_manifest(manifest)
+    return [(s, t) for s in subject_ids for t in tasks
+            if all((str(s), t, d) in accepted for d in directions)]
+
+
+def synchronized_iterables(runs, fields=('subject_id', 'task', 'direction')):
+    '''
+    turns a list of run tuples (from accepted_runs or accepted_sessions) into
+    iterables for an IdentityInterface node. The node must also have
+    synchronize = True so that nipype iterates over the tuples rather than the
+    product of the fields. Working directory names are the same as with product
+    iterables, so datasink substitutions don't need to change.
+    '''
+    return [(field, [run[i] for run in runs]) for i, field in enumerate(fields)]
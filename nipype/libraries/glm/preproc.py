@@ -19,6 +19,11 @@ if package_directory not in sys.path:
     sys.path.insert(0, package_directory)
 
 import nipype_ext.workbench as wb
+from nipype_ext.volume import IntensityNormalization, CSFMask
+from nipype_ext.temporal import TemporalHighpass
+from nipype_ext.cifti import CiftiPreproc, CiftiSmooth
+
+from glm.preprocstore import Stage, stage_workflow
 
 
 # this function was drafted by ChatGPT and modded by BP
@@ -94,6 +99,90 @@ surfintnorm = pe.Node(
 def getinormscale(medianvals):
     return '-mul %.14f' % (10000. / medianvals)
 
+# img2float through volintnorm fused into one in-process node. Numerically the
+# same as the FSL chain, but the run is read once and written once.
+intnorm = pe.Node(
+    interface=IntensityNormalization(),
+    name='intnorm')
+
+
+def _connect_intnorm(preproc, func, native_intnorm, motion=None, normalized=True):
+    '''
+    connects volume intensity normalization of func, a (node, output) pair, either as
+    the FSL chain or as the fused intnorm node. Returns the (node, output) pairs other
+    nodes pick up: the normalized volume, the median, the volume and mask used for
+    spike detection, and the brain mask. With motion, the (node, output) pair of the
+    HCP motion regressors, the intnorm node also detects spikes and the outliers are
+    returned as well. Without normalized only the median and the brain mask are
+    computed.
+    '''
+    func_node, func_out = func
+
+    if motion is not None and not native_intnorm:
+        raise ValueError('native_art detects spikes in the intnorm node and needs native_intnorm')
+
+    if native_intnorm:
+        node = intnorm
+        if not normalized:
+            # only the median and mask are used, so the normalized volume isn't written
+            node = pe.Node(
+                interface=IntensityNormalization(save_normalized=False),
+                name='intnorm')
+
+        preproc.connect([(func_node, node, [(func_out, 'in_file')])])
+
+        volume = {'median': (node, 'median'),
+                  'mask': (node, 'mask_file')}
+        if not normalized:
+            return volume
+
+        # ART sees the scaled rather than the unscaled masked volume. Its intensity
+        # z-scores are scale invariant so only float rounding differs
+        volume.update({'func': (node, 'out_file'),
+                       'art_func': (node, 'out_file'),
+                       'art_mask': (node, 'dilated_mask_file')})
+
+        if motion is not None:
+            motion_node, motion_out = motion
+            preproc.connect([(motion_node, node, [(motion_out, 'motion_file')])])
+            volume['outliers'] = (node, 'outlier_files')
+
+        return volume
+
+    preproc.connect([
+        (func_node, img2float, [(func_out,'in_file')]),
+
+        # find intensity normalization parameters
+        (img2float, getthresh, [('out_file', 'in_file')]),
+        (img2float, threshold, [('out_file', 'in_file')]),
+        (getthresh, threshold, [(('out_stat', getthreshop),'op_string')]),
+
+        (img2float, medianval, [('out_file', 'in_file')]),
+        (threshold, medianval, [('out_file', 'mask_file')]),
+    ])
+
+    volume = {'median': (medianval, 'out_stat'),
+              'mask': (threshold, 'out_file')}
+    if not normalized:
+        return volume
+
+    preproc.connect([
+        # intensity norm volume. Probably superfluous but ensures CSF vector is numerically
+        # the same in surface analysis as volumetric analysis rather than off by a scaling
+        # factor.
+        (threshold, dilatemask, [('out_file', 'in_file')]),
+        (img2float, maskfunc, [('out_file', 'in_file')]),
+        (dilatemask, maskfunc, [('out_file', 'in_file2')]),
+
+        (maskfunc, volintnorm, [('out_file', 'in_file')]),
+        (medianval, volintnorm, [(('out_stat', getinormscale), 'op_string')]),
+    ])
+
+    volume.update({'func': (volintnorm, 'out_file'),
+                   'art_func': (maskfunc, 'out_file'),
+                   'art_mask': (dilatemask, 'out_file')})
+    return volume
+
 
 # extract csf timeseries
 
@@ -110,6 +199,42 @@ resample_csf = pe.Node(fsl.preprocess.ApplyWarp(interp='nn'),
 compute_csf_ts = pe.Node(fsl.utils.ImageMeants(),
     name="compute_csf_ts")
 
+# binarize_csf -> erode_csf -> resample_csf in process. The mask only depends on
+# the subject's segmentation and the functional grid, so it is cached and only
+# built by the first run of each subject.
+csfmask = pe.Node(CSFMask(labels=[4, 43], erode_size=3),
+                  name='csfmask')
+
+
+def _connect_csf(preproc, seg, ref, func, cached_csf):
+    # CSF timeseries of func, with the mask of seg on the grid of ref built per run
+    # by freesurfer and fsl or taken from the csfmask cache. All three are (node,
+    # output) pairs
+    seg_node, seg_out = seg
+    func_node, func_out = func
+
+    if cached_csf:
+        # the raw run has the same grid as the normalized one, so the mask
+        # doesn't have to wait for intensity normalization
+        ref_node, ref_out = ref
+        preproc.connect([
+            (seg_node, csfmask, [(seg_out, 'seg_file')]),
+            (ref_node, csfmask, [(ref_out, 'ref_file')]),
+            (csfmask, compute_csf_ts, [('out_file', 'mask')]),
+            (func_node, compute_csf_ts, [(func_out, 'in_file')]),
+        ])
+        return compute_csf_ts
+
+    preproc.connect([
+        (seg_node, binarize_csf, [(seg_out, 'in_file')]),
+        (binarize_csf,  erode_csf, [('binary_file', 'in_file')]),
+        (erode_csf, resample_csf, [('out_file', 'in_file')]),
+        (func_node, resample_csf, [(func_out, 'ref_file')]),
+        (resample_csf, compute_csf_ts, [('out_file', 'mask')]),
+        (func_node, compute_csf_ts, [(func_out, 'in_file')]),
+    ])
+    return compute_csf_ts
+
 # spike detection
 hcp2mcflirt_motion_params = pe.Node(util.Function(input_names=['motion'],
                                               output_names=['motion'],
@@ -126,6 +251,25 @@ art = pe.Node(
         mask_type='file'),
     name="spikedetection")
 
+
+def _connect_spikes(preproc, motion, func, mask):
+    # outlier timepoints of func within mask, from ArtifactDetect. All three are
+    # (node, output) pairs
+    motion_node, motion_out = motion
+    func_node, func_out = func
+    mask_node, mask_out = mask
+
+    preproc.connect([
+        # find motion spikes. Hard to know if this works, because this data is low motion
+        # so few true positives to detect.
+        (motion_node, hcp2mcflirt_motion_params, [(motion_out, 'motion')]),
+        (hcp2mcflirt_motion_params, art, [('motion','realignment_parameters')]),
+        (func_node, art, [(func_out, 'realigned_files')]),
+        (mask_node, art, [(mask_out, 'mask_file')]),
+    ])
+
+    return art
+
 cifti2nifti = pe.Node(
     interface=wb.CiftiConvertNifti(
         smaller_dims=True),
@@ -141,13 +285,23 @@ meanfunc = pe.Node(
     name='meanfunc')
 
 
-def preproc_vol_motion_csf(hpcutoff, TR):
-    preproc = pe.Workflow(name='preproc')
+def _connect_highpass(preproc, source, source_out, hpcutoff, TR, native_highpass):
+    '''
+    highpass filters source.source_out and adds its temporal mean back, with
+    fslmaths or with the native TemporalHighpass (same filter, one pass, chunks
+    filtered by several threads). Returns the highpass node, whose out_file is
+    the filtered image either way
+    '''
+    if native_highpass:
+        highpass = pe.Node(
+            interface=TemporalHighpass(highpass_sigma=float('%.14f' % (0.5* hpcutoff / TR)),
+                                       num_threads=4),
+            name='highpass',
+            n_procs=4)
+
+        preproc.connect([(source, highpass, [(source_out, 'in_file')])])
 
-    inputnode = pe.Node(
-        interface=util.IdentityInterface(fields=[
-            'func','seg','motion']),
-        name='inputspec')
+        return highpass
 
     # this is a dirty way to add the meanfunc back in. I should pass '-add %s' somehow in a single consolidated command
     # so I don't have to just assume where in_file2 will be dropped
@@ -155,124 +309,235 @@ def preproc_vol_motion_csf(hpcutoff, TR):
         interface=fsl.ImageMaths(suffix='_hpf', op_string='-bptf %.14f -1 -add ' % (0.5* hpcutoff / TR)),
         name='highpass')
 
-
     preproc.connect([
-        (inputnode, img2float, [('func','in_file')]),
-
-        # find intensity normalization parameters
-        (img2float, getthresh, [('out_file', 'in_file')]),
-        (img2float, threshold, [('out_file', 'in_file')]),
-        (getthresh, threshold, [(('out_stat', getthreshop),'op_string')]),
-
-        (img2float, medianval, [('out_file', 'in_file')]),
-        (threshold, medianval, [('out_file', 'mask_file')]),
-
-        # intensity norm volume. Probably superfluous but ensures CSF vector is numerically
-        # the same in surface analysis as volumetric analysis rather than off by a scaling
-        # factor.
-        (threshold, dilatemask, [('out_file', 'in_file')]),
-        (img2float, maskfunc, [('out_file', 'in_file')]),
-        (dilatemask, maskfunc, [('out_file', 'in_file2')]),
-
-        (maskfunc, volintnorm, [('out_file', 'in_file')]),
-        (medianval, volintnorm, [(('out_stat', getinormscale), 'op_string')]),
-
-        # get CSF timeseries
-        (inputnode, binarize_csf, [('seg', 'in_file')]),
-        (binarize_csf,  erode_csf, [('binary_file', 'in_file')]),
-        (erode_csf, resample_csf, [('out_file', 'in_file')]),
-        (volintnorm, resample_csf, [('out_file', 'ref_file')]),
-        (resample_csf, compute_csf_ts, [('out_file', 'mask')]),
-        (volintnorm, compute_csf_ts, [('out_file', 'in_file')]),
-
-        # find motion spikes. Hard to know if this works, because this data is low motion
-        # so few true positives to detect.
-        (inputnode, hcp2mcflirt_motion_params, [('motion', 'motion')]),
-        (hcp2mcflirt_motion_params, art, [('motion','realignment_parameters')]),
-        (maskfunc, art, [('out_file', 'realigned_files')]),
-        (dilatemask, art, [('out_file', 'mask_file')]),
-
-        # highpass filter volume data (save mean, filter then add mean back in)
-        (volintnorm, meanfunc, [('out_file', 'in_file')]),
-        (volintnorm, highpass, [('out_file', 'in_file')]),
+        # save mean, filter then add mean back in
+        (source, meanfunc, [(source_out, 'in_file')]),
+        (source, highpass, [(source_out, 'in_file')]),
         (meanfunc, highpass, [('out_file', 'in_file2')]),
     ])
 
-    return preproc
+    return highpass
 
-def preproc_surf_motion_csf(hpcutoff, TR):
-    preproc = pe.Workflow(name='preproc')
-
-    inputnode = pe.Node(
-        interface=util.IdentityInterface(fields=[
-            'func_vol','func_surf','seg','motion']),
-        name='inputspec')
-
-    # this is a dirty way to add the meanfunc back in. I should pass '-add %s' somehow in a single consolidated command
-    # so I don't have to just assume where in_file2 will be dropped
-    highpass = pe.Node(
-        interface=fsl.ImageMaths(suffix='_hpf', op_string='-bptf %.14f -1 -add ' % (0.5* hpcutoff / TR)),
-        name='highpass')
 
+def _connect_smoothing(preproc, sources, spatialSmoothingSigma, native_smoothing):
+    # surface and volume smoothing of sources['func_surf'] on the subject's
+    # midthickness surfaces. Returns the smoothing node
+    if native_smoothing:
+        # the smoothing matrix is cached per subject, see nipype_ext.cifti
+        surfsmooth = pe.Node(
+            interface=CiftiSmooth(
+                sigma_surf=spatialSmoothingSigma,
+                sigma_vol=spatialSmoothingSigma,
+                num_threads=4),
+            name='surfsmooth',
+            n_procs=4)
+    else:
+        surfsmooth = pe.Node(
+            interface=nipype_wb.CiftiSmooth(
+                direction='COLUMN',
+                sigma_surf=spatialSmoothingSigma,
+                sigma_vol=spatialSmoothingSigma),
+            name='surfsmooth')
 
-    preproc.connect([
-        (inputnode, img2float, [('func_vol','in_file')]),
+    for field, dst in [('func_surf', 'in_file'), ('surf_left', 'left_surf'), ('surf_right', 'right_surf')]:
+        node, out = sources[field]
+        preproc.connect([(node, surfsmooth, [(out, dst)])])
 
-        # find intensity normalization parameters
-        (img2float, getthresh, [('out_file', 'in_file')]),
-        (img2float, threshold, [('out_file', 'in_file')]),
-        (getthresh, threshold, [(('out_stat', getthreshop),'op_string')]),
+    return surfsmooth
 
-        (img2float, medianval, [('out_file', 'in_file')]),
-        (threshold, medianval, [('out_file', 'mask_file')]),
 
-        # intensity norm volume. Probably superfluous but ensures CSF vector is numerically
-        # the same in surface analysis as volumetric analysis rather than off by a scaling
-        # factor.
-        (threshold, dilatemask, [('out_file', 'in_file')]),
-        (img2float, maskfunc, [('out_file', 'in_file')]),
-        (dilatemask, maskfunc, [('out_file', 'in_file2')]),
+def _connect_surface(preproc, template, source, source_out, median_node, median_out,
+                     hpcutoff, TR, native_highpass, native_cifti):
+    '''
+    intensity normalizes and highpass filters the dtseries in source.source_out,
+    either by converting it to nifti for fslmaths (or the native highpass) and back
+    onto template, a (node, output) pair of a dtseries, or with CiftiPreproc on the
+    dtseries itself. Returns the node whose out_file is the preprocessed dtseries
+    '''
+    if native_cifti:
+        ciftipreproc = pe.Node(
+            interface=CiftiPreproc(highpass_sigma=float('%.14f' % (0.5* hpcutoff / TR)),
+                                   num_threads=4),
+            name='ciftipreproc',
+            n_procs=4)
 
-        (maskfunc, volintnorm, [('out_file', 'in_file')]),
-        (medianval, volintnorm, [(('out_stat', getinormscale), 'op_string')]),
+        preproc.connect([
+            (source, ciftipreproc, [(source_out, 'in_file')]),
+            (median_node, ciftipreproc, [(median_out, 'median')]),
+        ])
 
-        # get CSF timeseries
-        (inputnode, binarize_csf, [('seg', 'in_file')]),
-        (binarize_csf,  erode_csf, [('binary_file', 'in_file')]),
-        (erode_csf, resample_csf, [('out_file', 'in_file')]),
-        (volintnorm, resample_csf, [('out_file', 'ref_file')]),
-        (resample_csf, compute_csf_ts, [('out_file', 'mask')]),
-        (volintnorm, compute_csf_ts, [('out_file', 'in_file')]),
+        return ciftipreproc
 
-        # find motion spikes. Hard to know if this works, because this data is low motion
-        # so few true positives to detect.
-        (inputnode, hcp2mcflirt_motion_params, [('motion', 'motion')]),
-        (hcp2mcflirt_motion_params, art, [('motion','realignment_parameters')]),
-        (maskfunc, art, [('out_file', 'realigned_files')]),
-        (dilatemask, art, [('out_file', 'mask_file')]),
+    # highpass filter surface data
+    highpass = _connect_highpass(preproc, surfintnorm, 'out_file', hpcutoff, TR, native_highpass)
 
+    template_node, template_out = template
+    preproc.connect([
         # convert surf to nifti for bandpass filtering
-        (inputnode, cifti2nifti, [('func_surf','cifti_in')]),
+        (source, cifti2nifti, [(source_out,'cifti_in')]),
 
         # intensity normalize surface (already normed to mean, but we need it normed to the
         # median FEAT style)
         (cifti2nifti, surfintnorm, [('out_file','in_file')]),
-        (medianval, surfintnorm, [(('out_stat', getinormscale), 'op_string')]),
-
-        # highpass filter surface data (save mean, filter then add mean back in)
-        (surfintnorm, meanfunc, [('out_file', 'in_file')]),
-        (surfintnorm, highpass, [('out_file', 'in_file')]),
-        (meanfunc, highpass, [('out_file', 'in_file2')]),
+        (median_node, surfintnorm, [((median_out, getinormscale), 'op_string')]),
 
         # convert nifti back to cifti
         (highpass, nifti2cifti, [('out_file','nifti_in')]),
-        (inputnode, nifti2cifti, [('func_surf','cifti_template')])
+        (template_node, nifti2cifti, [(template_out,'cifti_template')])
     ])
 
-    return preproc
-
-
-def preproc_surf_hcp(hpcutoff, TR, spatialSmoothingSigma=None):
+    return nifti2cifti
+
+
+# Stages
+#
+# The factories below are put together from the stages of glm.preprocstore, so
+# that a pipeline given a store reads each stage from it rather than computing it,
+# and pipelines running the same stage on the same run share it. A stage's name,
+# arguments and inputs are what identify it, so two workflows computing the same
+# thing have to describe it the same way here.
+
+def _intnorm_stage(func_field, native_intnorm, native_art=False, partial=False):
+    # intensity normalization of inputspec.func_field, and with native_art spike
+    # detection. With partial only the median and mask are computed unless the
+    # stage is stored, when it is computed in full so other workflows can use it
+    def build(preproc, sources, stored):
+        return _connect_intnorm(preproc, sources[func_field], native_intnorm,
+                                motion=sources['motion'] if native_art else None,
+                                normalized=stored or not partial)
+
+    return Stage('intnorm',
+                 params={'native_intnorm': native_intnorm, 'native_art': native_art},
+                 inputs=[func_field] + (['motion'] if native_art else []),
+                 upstream=[],
+                 outputs=['func', 'median', 'mask', 'art_mask'] + (['outliers'] if native_art else []),
+                 build=build)
+
+
+def _csf_stage(func_field, cached_csf):
+    def build(preproc, sources, stored):
+        return {'csf': (_connect_csf(preproc, sources['seg'], sources[func_field], sources['intnorm.func'],
+                                     cached_csf), 'out_file')}
+
+    return Stage('csf', params={'cached_csf': cached_csf}, inputs=['seg'], upstream=['intnorm'],
+                 outputs=['csf'], build=build)
+
+
+def _spikes_stage():
+    def build(preproc, sources, stored):
+        # a stored intnorm stage only has the normalized volume, which gives
+        # ArtifactDetect the same z-scores as the masked one
+        func = sources.get('intnorm.art_func', sources['intnorm.func'])
+        return {'outliers': (_connect_spikes(preproc, sources['motion'], func, sources['intnorm.art_mask']),
+                             'outlier_files')}
+
+    return Stage('spikes', params={}, inputs=['motion'], upstream=['intnorm'],
+                 outputs=['outliers'], build=build)
+
+
+def _highpass_stage(hpcutoff, TR, native_highpass):
+    def build(preproc, sources, stored):
+        func_node, func_out = sources['intnorm.func']
+        return {'func': (_connect_highpass(preproc, func_node, func_out, hpcutoff, TR, native_highpass),
+                         'out_file')}
+
+    return Stage('highpass', params={'hpcutoff': hpcutoff, 'TR': TR, 'native_highpass': native_highpass},
+                 inputs=[], upstream=['intnorm'], outputs=['func'], build=build)
+
+
+def _surface_stage(hpcutoff, TR, native_highpass, native_cifti,
+                   spatialSmoothingSigma=None, native_smoothing=False):
+    params = {'hpcutoff': hpcutoff, 'TR': TR, 'native_highpass': native_highpass,
+              'native_cifti': native_cifti, 'spatialSmoothingSigma': spatialSmoothingSigma or None}
+    inputs = ['func_surf']
+    if spatialSmoothingSigma:
+        params['native_smoothing'] = native_smoothing
+        inputs += ['surf_left', 'surf_right']
+
+    def build(preproc, sources, stored):
+        source_node, source_out = sources['func_surf']
+        if spatialSmoothingSigma:
+            source_node, source_out = _connect_smoothing(preproc, sources, spatialSmoothingSigma,
+                                                         native_smoothing), 'out_file'
+        median_node, median_out = sources['intnorm.median']
+        return {'func': (_connect_surface(preproc, sources['func_surf'], source_node, source_out,
+                                          median_node, median_out, hpcutoff, TR,
+                                          native_highpass, native_cifti), 'out_file')}
+
+    return Stage('surface', params=params, inputs=inputs, upstream=['intnorm'],
+                 outputs=['func'], build=build)
+
+
+def preproc_vol_motion_csf_stages(hpcutoff, TR, native_intnorm=False,
+                                  native_highpass=False, cached_csf=False, native_art=False):
+    # the stages of preproc_vol_motion_csf
+    return ([_intnorm_stage('func', native_intnorm, native_art),
+             _csf_stage('func', cached_csf)]
+            + ([] if native_art else [_spikes_stage()])
+            + [_highpass_stage(hpcutoff, TR, native_highpass)])
+
+
+def preproc_vol_motion_csf(hpcutoff, TR, native_intnorm=False,
+                           native_highpass=False, cached_csf=False, native_art=False, store=None):
+    '''
+    store - glm.preprocstore store to read every stage from instead of computing
+            it. Fill it first with fill_preproc_store and preproc_vol_motion_csf_stages
+    '''
+    stages = preproc_vol_motion_csf_stages(hpcutoff, TR, native_intnorm=native_intnorm,
+                                           native_highpass=native_highpass, cached_csf=cached_csf,
+                                           native_art=native_art)
+
+    return stage_workflow('preproc', ['func','seg','motion'], stages,
+                          {'func': 'highpass.func',
+                           'outliers': 'intnorm.outliers' if native_art else 'spikes.outliers',
+                           'csf': 'csf.csf',
+                           'motion': 'motion',
+                           'mask': 'intnorm.mask'},
+                          store=store)
+
+
+def preproc_surf_motion_csf_stages(hpcutoff, TR, native_intnorm=False,
+                                   native_highpass=False, native_cifti=False, cached_csf=False,
+                                   native_art=False):
+    # the stages of preproc_surf_motion_csf. The volume stages are the ones
+    # preproc_vol_motion_csf runs on the same volume
+    return ([_intnorm_stage('func_vol', native_intnorm, native_art),
+             _csf_stage('func_vol', cached_csf)]
+            + ([] if native_art else [_spikes_stage()])
+            + [_surface_stage(hpcutoff, TR, native_highpass, native_cifti)])
+
+
+def preproc_surf_motion_csf(hpcutoff, TR, native_intnorm=False,
+                            native_highpass=False, native_cifti=False, cached_csf=False,
+                            native_art=False, store=None):
+    '''
+    store - glm.preprocstore store to read every stage from instead of computing
+            it. Fill it first with fill_preproc_store and preproc_surf_motion_csf_stages
+    '''
+    stages = preproc_surf_motion_csf_stages(hpcutoff, TR, native_intnorm=native_intnorm,
+                                            native_highpass=native_highpass, native_cifti=native_cifti,
+                                            cached_csf=cached_csf, native_art=native_art)
+
+    return stage_workflow('preproc', ['func_vol','func_surf','seg','motion'], stages,
+                          {'func': 'surface.func',
+                           'outliers': 'intnorm.outliers' if native_art else 'spikes.outliers',
+                           'csf': 'csf.csf',
+                           'motion': 'motion',
+                           'mask': 'intnorm.mask'},
+                          store=store)
+
+
+def preproc_surf_hcp_stages(hpcutoff, TR, spatialSmoothingSigma=None, native_intnorm=False,
+                            native_highpass=False, native_cifti=False, native_smoothing=False):
+    # the stages of preproc_surf_hcp. Without smoothing the surface stage is the
+    # one preproc_surf_motion_csf runs
+    return [_intnorm_stage('func_vol', native_intnorm, partial=True),
+            _surface_stage(hpcutoff, TR, native_highpass, native_cifti,
+                           spatialSmoothingSigma=spatialSmoothingSigma, native_smoothing=native_smoothing)]
+
+
+def preproc_surf_hcp(hpcutoff, TR, spatialSmoothingSigma=None, native_intnorm=False,
+                     native_highpass=False, native_cifti=False, native_smoothing=False, store=None):
     '''
     spatialSmoothingSigma - it appears minimally preprocessed hcp data has already had surface smoothing performed,
                             meaning you can't just supply a naive sigma here, you have to account for this prior 2mm
@@ -283,67 +548,16 @@ def preproc_surf_hcp(hpcutoff, TR, spatialSmoothingSigma=None):
 
                             The math was copied from here:
                             https://github.com/Washington-University/HCPpipelines/blob/master/TaskfMRIAnalysis/scripts/TaskfMRILevel1.sh
+    native_smoothing - smooth with a sparse matrix built once per subject (nipype_ext.cifti.CiftiSmooth)
+                       instead of wb_command, which recomputes the kernels for every run
+    store - glm.preprocstore store to read every stage from instead of computing
+            it. Fill it first with fill_preproc_store and preproc_surf_hcp_stages
     '''
-    preproc = pe.Workflow(name='preproc')
-
-    inputnode = pe.Node(
-        interface=util.IdentityInterface(fields=[
-            'func_vol','func_surf','seg','motion','surf_left','surf_right']),
-        name='inputspec')
-
-    # this is a dirty way to add the meanfunc back in. I should pass '-add %s' somehow in a single consolidated command
-    # so I don't have to just assume where in_file2 will be dropped
-    highpass = pe.Node(
-        interface=fsl.ImageMaths(suffix='_hpf', op_string='-bptf %.14f -1 -add ' % (0.5* hpcutoff / TR)),
-        name='highpass')
-
-
-    preproc.connect([
-        (inputnode, img2float, [('func_vol','in_file')]),
-
-        # find intensity normalization parameters
-        (img2float, getthresh, [('out_file', 'in_file')]),
-        (img2float, threshold, [('out_file', 'in_file')]),
-        (getthresh, threshold, [(('out_stat', getthreshop),'op_string')]),
-
-        (img2float, medianval, [('out_file', 'in_file')]),
-        (threshold, medianval, [('out_file', 'mask_file')]),
-
-        # intensity normalize surface (already normed to mean, but we need it normed to the
-        # median FEAT style)
-        (cifti2nifti, surfintnorm, [('out_file','in_file')]),
-        (medianval, surfintnorm, [(('out_stat', getinormscale), 'op_string')]),
-
-        # highpass filter surface data (save mean, filter then add mean back in)
-        (surfintnorm, meanfunc, [('out_file', 'in_file')]),
-        (surfintnorm, highpass, [('out_file', 'in_file')]),
-        (meanfunc, highpass, [('out_file', 'in_file2')]),
-
-        # convert nifti back to cifti
-        (highpass, nifti2cifti, [('out_file','nifti_in')]),
-        (inputnode, nifti2cifti, [('func_surf','cifti_template')])
-    ])
-
-    if not spatialSmoothingSigma:
-        preproc.connect([
-            # convert surf to nifti for bandpass filtering
-            (inputnode, cifti2nifti, [('func_surf','cifti_in')]),
-        ])
-    else:
-        surfsmooth = pe.Node(
-            interface=nipype_wb.CiftiSmooth(
-                direction='COLUMN',
-                sigma_surf=spatialSmoothingSigma,
-                sigma_vol=spatialSmoothingSigma),
-            name='surfsmooth')
-
-        preproc.connect([
-            # convert surf to nifti for bandpass filtering
-            (inputnode, surfsmooth, [('func_surf','in_file')]),
-            (inputnode, surfsmooth, [('surf_left', 'left_surf'),
-                                     ('surf_right', 'right_surf')]),
-            (surfsmooth, cifti2nifti, [('out_file','cifti_in')])
-        ])
-
-    return preproc
-
+    stages = preproc_surf_hcp_stages(hpcutoff, TR, spatialSmoothingSigma=spatialSmoothingSigma,
+                                     native_intnorm=native_intnorm, native_highpass=native_highpass,
+                                     native_cifti=native_cifti, native_smoothing=native_smoothing)
+
+    return stage_workflow('preproc', ['func_vol','func_surf','seg','motion','surf_left','surf_right'], stages,
+                          {'func': 'surface.func',
+                           'mask': 'intnorm.mask'},
+                          store=store)
@@ -0,0 +1,332 @@
+import os
+import json
+import shutil
+import tempfile
+from collections import namedtuple
+
+# Content addressed store of preprocessing stages
+#
+# The subjectlevel pipelines run the same preprocessing stages on the same HCP
+# runs and only differ in how they put them together and in the models they fit
+# afterwards. All of them normalize the volume, the confound pipelines extract the
+# CSF timeseries and spikes from it, and both grayordinate pipelines filter the
+# dtseries the same way unless hcp_glm_grayord smooths it. Each pipeline has its
+# own scratch directory, so nipype can't reuse any of this between them. The
+# store keeps the outputs of each stage of a run under a key made of
+#   - the stage's name and the arguments that change its result
+#   - the HCP files it reads, by path, size and mtime. The archive is read only,
+#     so these identify the contents without reading the 4D runs
+#   - the keys of the stages whose outputs it reads
+# so whatever pipeline computed a stage for a run, every pipeline running the same
+# stage on that run finds it, however else the pipelines differ.
+#
+# The factories in glm.preproc describe their workflows as lists of Stages. Given
+# a store they build a workflow that looks every stage up instead of computing it.
+# fill_preproc_store computes what isn't stored yet beforehand, one stage at a
+# time for the runs missing it, so nipype never schedules a preprocessing node
+# for a stored stage.
+#
+# <store>/<stage>/<key[:2]>/<key>/ holds the stored files under their original
+# names (datasink substitutions keep matching) and manifest.json mapping the
+# stage's outputs to them, or to their values for outputs that aren't files.
+
+# bump when preprocessing changes in a way the stage arguments don't capture
+STORE_VERSION = '2'
+
+# name - what the stage computes. Workflows computing the same thing give it the same name
+# params - json-able arguments that change the stage's result
+# inputs - inputspec fields of the files the stage reads
+# upstream - earlier stages whose outputs it reads
+# outputs - the outputs that are stored
+# build - build(workflow, sources, stored) connects the nodes computing the stage to
+#         workflow and returns a dict of its outputs to (node, output) pairs. sources
+#         maps the inputspec fields and the upstream outputs, as '<stage>.<output>',
+#         to (node, output) pairs. stored is True when the outputs go to a store
+Stage = namedtuple('Stage', ['name', 'params', 'inputs', 'upstream', 'outputs', 'build'])
+
+
+def stage_key(name, params, in_files, upstream_keys):
+    '''
+    name, params - of the stage
+    in_files - files of the stage's inputs, in order (each a file or list of files)
+    upstream_keys - keys of its upstream stages, in order
+    '''
+    from glm.cache import hash_bytes, hash_stat
+
+    items = [STORE_VERSION, name, json.dumps(params, sort_keys=True)]
+    for files in in_files:
+        items += [hash_stat(f) for f in (files if isinstance(files, list) else [files])]
+    return hash_bytes(*(items + list(upstream_keys)))
+
+
+def stage_keys(stages, files):
+    # keys of stages for a run, given the files of its inputspec fields
+    keys = {}
+    for stage in stages:
+        keys[stage.name] = stage_key(stage.name, stage.params, [files[f] for f in stage.inputs],
+                                     [keys[u] for u in stage.upstream])
+    return keys
+
+
+class PreprocStore:
+    '''
+    root - directory of the store. Created if it doesn't exist
+    '''
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, stage, key):
+        return os.path.join(self.root, stage, key[:2], key)
+
+    def get(self, stage, key):
+        # dict of output to stored file (or value), or None if key isn't stored
+        path = self.path(stage, key)
+        try:
+            with open(os.path.join(path, 'manifest.json')) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return None
+
+        stored = dict(manifest['values'])
+        for output, names in manifest['files'].items():
+            stored[output] = ([os.path.join(path, name) for name in names] if isinstance(names, list)
+                              else os.path.join(path, names))
+        return stored
+
+    def put(self, stage, key, outputs):
+        '''
+        stores outputs (dict of output to file, list of files or json-able value)
+        under key and returns what get returns for it. Entries are written to a
+        temporary directory and renamed into place, so concurrent jobs storing the
+        same stage don't see partial entries and the first one to finish wins.
+        '''
+        parent = os.path.dirname(self.path(stage, key))
+        os.makedirs(parent, exist_ok=True)
+
+        tmp = tempfile.mkdtemp(dir=parent, prefix='.tmp_')
+        try:
+            manifest = {'files': {}, 'values': {}}
+            names = set()
+
+            def copy(output, src):
+                name = os.path.basename(src)
+                if name in names:
+                    name = output + '_' + name
+                names.add(name)
+                shutil.copyfile(src, os.path.join(tmp, name))
+                return name
+
+            for output, value in outputs.items():
+                if isinstance(value, str) and os.path.isfile(value):
+                    manifest['files'][output] = copy(output, value)
+                elif isinstance(value, list) and value and all(isinstance(v, str) and os.path.isfile(v)
+                                                              for v in value):
+                    manifest['files'][output] = [copy(output, v) for v in value]
+                else:
+                    manifest['values'][output] = value
+
+            with open(os.path.join(tmp, 'manifest.json'), 'w') as f:
+                json.dump(manifest, f)
+            try:
+                os.rename(tmp, self.path(stage, key))
+            except OSError:
+                if self.get(stage, key) is None:
+                    raise
+        finally:
+            if os.path.exists(tmp):
+                shutil.rmtree(tmp)
+
+        return self.get(stage, key)
+
+
+# Function node bodies. The files of the stage's inputs come in as in_<field>, the
+# keys of its upstream stages as key_<stage> and its outputs as out_<output>
+def _load_stage(store, stage, params, inputs, upstream, outputs, **kwargs):
+    from glm.preprocstore import PreprocStore, stage_key
+
+    key = stage_key(stage, params, [kwargs['in_' + f] for f in inputs], [kwargs['key_' + u] for u in upstream])
+    stored = PreprocStore(store).get(stage, key)
+    if stored is None:
+        raise ValueError('stage %s (%s) of %s is not in %s'
+                         % (stage, key, [kwargs['in_' + f] for f in inputs], store))
+
+    return (key,) + tuple(stored[output] for output in outputs)
+
+
+def _save_stage(store, stage, params, inputs, upstream, outputs, **kwargs):
+    from glm.preprocstore import PreprocStore, stage_key
+
+    key = stage_key(stage, params, [kwargs['in_' + f] for f in inputs], [kwargs['key_' + u] for u in upstream])
+    PreprocStore(store).put(stage, key, {output: kwargs['out_' + output] for output in outputs})
+    return key
+
+
+def _stage_node(stage, store, function, output_names, name):
+    import nipype.pipeline.engine as pe
+    import nipype.interfaces.utility as util
+
+    node = pe.Node(
+        interface=util.Function(input_names=['store', 'stage', 'params', 'inputs', 'upstream', 'outputs']
+                                            + ['in_' + f for f in stage.inputs]
+                                            + ['key_' + u for u in stage.upstream]
+                                            + ['out_' + o for o in stage.outputs if function is _save_stage],
+                                output_names=output_names,
+                                function=function),
+        name=name)
+    node.inputs.store = store
+    node.inputs.stage = stage.name
+    node.inputs.params = stage.params
+    node.inputs.inputs = stage.inputs
+    node.inputs.upstream = stage.upstream
+    node.inputs.outputs = stage.outputs
+    return node
+
+
+def connect_stages(workflow, inputnode, fields, stages, store=None, fill=None):
+    '''
+    connects stages to workflow, reading the inputspec fields from inputnode, and
+    returns a dict of the fields and of the stage outputs, as '<stage>.<output>',
+    to the (node, output) pairs providing them
+
+    store - without a store every stage is computed. With one every stage is
+            looked up in it instead
+    fill - with a store, the name of a stage to compute and save to the store. Only
+           the stages it reads are looked up and the others are left out
+    '''
+    if fill is not None:
+        needed = {fill}
+        for stage in reversed(stages):
+            if stage.name in needed:
+                needed.update(stage.upstream)
+        stages = [stage for stage in stages if stage.name in needed]
+
+    sources = {field: (inputnode, field) for field in fields}
+    keys = {}
+    for stage in stages:
+        if store is None or stage.name == fill:
+            outputs = stage.build(workflow, dict(sources), store is not None)
+        else:
+            lookup = _stage_node(stage, store, _load_stage, ['key'] + stage.outputs, 'store_' + stage.name)
+            outputs = {output: (lookup, output) for output in stage.outputs}
+            keys[stage.name] = (lookup, 'key')
+
+        if store is not None:
+            if stage.name == fill:
+                node = _stage_node(stage, store, _save_stage, ['key'], 'save_' + stage.name)
+                for output in stage.outputs:
+                    src, out = outputs[output]
+                    workflow.connect([(src, node, [(out, 'out_' + output)])])
+            else:
+                node = lookup
+
+            workflow.connect([(inputnode, node, [(f, 'in_' + f) for f in stage.inputs])])
+            for u in stage.upstream:
+                src, out = keys[u]
+                workflow.connect([(src, node, [(out, 'key_' + u)])])
+
+        sources.update({'%s.%s' % (stage.name, output): src for output, src in outputs.items()})
+
+    return sources
+
+
+def stage_workflow(name, fields, stages, outputs, store=None):
+    '''
+    a workflow with an inputspec of fields, computing stages or looking them up in
+    store, and an outputspec of the keys of outputs
+
+    outputs - dict of outputspec field to the stage output ('<stage>.<output>') or
+              inputspec field it passes on
+    '''
+    import nipype.pipeline.engine as pe
+    import nipype.interfaces.utility as util
+
+    workflow = pe.Workflow(name=name)
+
+    inputnode = pe.Node(
+        interface=util.IdentityInterface(fields=fields),
+        name='inputspec')
+
+    outputnode = pe.Node(
+        interface=util.IdentityInterface(fields=list(outputs)),
+        name='outputspec')
+
+    sources = connect_stages(workflow, inputnode, fields, stages, store=store)
+    for field, source in outputs.items():
+        node, out = sources[source]
+        workflow.connect([(node, outputnode, [(out, field)])])
+
+    return workflow
+
+
+def fill_preproc_store(store, stages, datasource, inputs, runs, base_dir, n_procs=1):
+    '''
+    computes the stages that are missing from store for runs, so that a workflow
+    built with the same stages and store can read all of them from it. Stages are
+    filled in order, each for the runs missing it, reading the stages it depends
+    on from the store.
+
+    store - store directory
+    stages - stages of the preproc workflow, e.g. from preproc_vol_motion_csf_stages
+    datasource - the pipeline's datasource node. Its subject_id, task and direction
+                 inputs select a run
+    inputs - (datasource output, inputspec field) pairs feeding the preproc workflow
+    runs - (subject_id, task, direction) tuples the pipeline iterates over
+    base_dir - working directory for the fill workflows
+    n_procs - processes for the fill workflows
+
+    returns a dict of stage name to the runs it was computed for
+    '''
+    from copy import deepcopy
+    import nipype.pipeline.engine as pe
+    import nipype.interfaces.utility as util
+    from glm.preflight import synchronized_iterables
+
+    store = os.path.abspath(store)
+    fields = [field for _, field in inputs]
+
+    # keys of every stage of every run, from the files datasource resolves for it.
+    # Only file metadata is read here
+    keys = {}
+    for run in runs:
+        interface = deepcopy(datasource.interface)
+        interface.inputs.subject_id, interface.inputs.task, interface.inputs.direction = run
+        resolved = interface.run().outputs.get()
+        keys[run] = stage_keys(stages, {field: resolved[src] for src, field in inputs})
+
+    filled = {}
+    for stage in stages:
+        missing = [run for run in runs if PreprocStore(store).get(stage.name, keys[run][stage.name]) is None]
+        filled[stage.name] = missing
+        if not missing:
+            continue
+
+        fill = pe.Workflow(name='preprocstore_' + stage.name, base_dir=base_dir)
+
+        fillsource = pe.Node(
+            interface=util.IdentityInterface(fields=['subject_id', 'task', 'direction']),
+            name='infosource')
+        fillsource.iterables = synchronized_iterables(missing)
+        fillsource.synchronize = True
+
+        filldata = pe.Node(interface=deepcopy(datasource.interface), name=datasource.name)
+
+        preproc = pe.Workflow(name='preproc')
+        inputnode = pe.Node(
+            interface=util.IdentityInterface(fields=fields),
+            name='inputspec')
+        connect_stages(preproc, inputnode, fields, stages, store=store, fill=stage.name)
+
+        fill.connect([
+            (fillsource, filldata, [('subject_id', 'subject_id'),
+                                    ('task', 'task'),
+                                    ('direction', 'direction')]),
+            (filldata, preproc, [(src, 'inputspec.' + field) for src, field in inputs]),
+        ])
+
+        if n_procs and n_procs > 1:
+            fill.run(plugin='MultiProc', plugin_args={'n_procs': n_procs})
+        else:
+            fill.run()
+
+    return filled
@@ -18,6 +18,123 @@ def assemble_csf_motion_confounds_mat(motion, csf):
     return filename
 
 
+# Confound matrices
+#
+# build_confounds reads the motion regressors, CSF timeseries and outlier list of a
+# run once and writes the confound matrix as
+#   confounds.txt - tab separated text, as SpecifyModel takes realignment_parameters
+#   confounds.npy - the same matrix for anything reading it from python
+# with columns, in order,
+#   motion       the columns of Movement_Regressors.txt (parameters and derivatives)
+#   differences  backward differences of the motion columns, 0 at the first
+#                timepoint (derivatives=True)
+#   squares      of the motion columns and differences (squares=True)
+#   csf
+#   spikes       one indicator column per timepoint in the outliers file or with a
+#                framewise displacement above fd_threshold mm
+# The defaults give the matrix assemble_csf_motion_confounds_mat builds. The matrix
+# only depends on the contents of the inputs and the options, so it is kept in the
+# 'confounds' namespace of glm.cache and pipelines computing the same CSF
+# timeseries (the trial and block pipelines) share it.
+CONFOUNDS_VERSION = '1'
+
+
+def framewise_displacement(motion, radius=50):
+    '''
+    Power et al. framewise displacement from HCP motion regressors (translations
+    in mm, rotations in degrees): the summed absolute change of the translations
+    and of the rotations as arc length on a sphere of radius mm. 0 at the first
+    timepoint.
+    '''
+    import numpy as np
+
+    params = np.hstack([motion[:, :3], np.pi / 180 * radius * motion[:, 3:6]])
+    return np.abs(np.diff(params, axis=0, prepend=params[:1])).sum(axis=1)
+
+
+def confound_matrix(motion, csf=None, outliers=None, squares=True, derivatives=False, fd_threshold=None):
+    '''
+    motion - T x k motion regressors
+    csf - T x 1 CSF timeseries or None
+    outliers - 0 based outlier timepoints or None
+
+    returns the T x n confound matrix (see build_confounds)
+    '''
+    import numpy as np
+    from glm.utils import framewise_displacement
+
+    n_vols = motion.shape[0]
+    columns = [motion]
+    if derivatives:
+        columns.append(np.diff(motion, axis=0, prepend=motion[:1]))
+    if squares:
+        columns += [c ** 2 for c in list(columns)]
+    if csf is not None:
+        if len(csf) != n_vols:
+            raise ValueError('CSF timeseries has %d timepoints but the motion regressors have %d'
+                             % (len(csf), n_vols))
+        columns.append(csf.reshape(n_vols, -1))
+
+    spikes = np.asarray(outliers if outliers is not None else [], dtype=int)
+    if fd_threshold is not None:
+        spikes = np.union1d(spikes, np.flatnonzero(framewise_displacement(motion) > fd_threshold))
+    spikes = np.unique(spikes)
+    if spikes.size and (spikes.min() < 0 or spikes.max() >= n_vols):
+        raise ValueError('outlier timepoints %s out of range for %d timepoints' % (spikes, n_vols))
+    indicators = np.zeros((n_vols, spikes.size))
+    indicators[spikes, np.arange(spikes.size)] = 1
+    columns.append(indicators)
+
+    return np.hstack(columns)
+
+
+# Function node body. Returns the paths of confounds.txt and confounds.npy in the
+# node's working directory.
+def build_confounds(motion, csf=None, outliers=None, squares=True, derivatives=False,
+                    fd_threshold=None, use_cache=True, cache_dir=None):
+    import os
+    import numpy as np
+    from glm.utils import CONFOUNDS_VERSION, confound_matrix
+
+    cwd = os.getcwd()
+    txt = os.path.join(cwd, 'confounds.txt')
+    npy = os.path.join(cwd, 'confounds.npy')
+
+    cache = None
+    if use_cache:
+        from glm.cache import DiskCache, hash_bytes, hash_file
+
+        cache = DiskCache('confounds', cache_dir=cache_dir)
+        key = hash_bytes(CONFOUNDS_VERSION,
+                         *[hash_file(f) if f else '' for f in (motion, csf, outliers)],
+                         repr((bool(squares), bool(derivatives), fd_threshold)))
+        cached = cache.get(key, '.npy')
+
+    if cache is not None and cached is not None:
+        matrix = np.load(cached)
+        np.save(npy, matrix)
+    else:
+        # ImageMeants and ArtifactDetect write one value per line, the latter
+        # nothing at all if there are no outliers
+        spikes = None
+        if outliers:
+            with open(outliers) as f:
+                spikes = np.array(f.read().split(), dtype=int)
+        matrix = confound_matrix(
+            np.loadtxt(motion, ndmin=2),
+            csf=np.loadtxt(csf, ndmin=1) if csf else None,
+            outliers=spikes,
+            squares=squares, derivatives=derivatives, fd_threshold=fd_threshold)
+        np.save(npy, matrix)
+        if cache is not None:
+            cache.put(key, npy, '.npy')
+
+    # %.17g round trips float64 exactly
+    np.savetxt(txt, matrix, fmt='%.17g', delimiter='\t')
+
+    return txt, npy
+
+
 # combine VIFs across trials in the order recieved. Select trials of interest
 # based on name matching to 'Task-(\d+)' regular expression.
 def merge_trial_vifs(files):
@@ -25,33 +142,227 @@ def merge_trial_vifs(files):
     import os
     import re
 
-    labels = []
-    vifs = []
-    for filename in files:
-        these_vifs_df=pd.read_csv(filename, sep=',', header=None)
-
-        these_labels = these_vifs_df[0].tolist()
-        these_vifs = these_vifs_df[1].tolist()
-
-        # find trial contrast
-        is_single_trial = [True if re.search('^Task-(\d+)$', label) else False
-                                for label in these_labels]
-
-        these_labels = [label for label,good in zip(these_labels,is_single_trial) if good]
-        labels = labels + these_labels
-
-        these_vifs = [vif for vif,good in zip(these_vifs,is_single_trial) if good]
-        vifs = vifs + these_vifs
+    is_single_trial = re.compile(r'^Task-(\d+)$')
 
-    vifs_df = pd.DataFrame({'trial': labels, 'VIF': vifs})
+    vifs_df = pd.concat([pd.read_csv(filename, sep=',', header=None, names=['trial', 'VIF'],
+                                     dtype={'trial': str})
+                         for filename in files] or [pd.DataFrame(columns=['trial', 'VIF'])],
+                        ignore_index=True)
+    vifs_df = vifs_df[vifs_df['trial'].str.match(is_single_trial)]
 
     # get node specific working directory
     cwd = os.getcwd()
 
-
     filename = os.path.join(cwd, "vifs.csv")
 
     vifs_df.to_csv(filename, sep=',', index=False, header=False)
 
     return filename
 
+
+# Cohort VIF store
+#
+# Rather than leaving one vifs.csv per run scattered across the results tree, the
+# VIFs of every run can also be collected in a single table with columns
+# subject_id, task, direction, trial and VIF. The format follows the extension of
+# the store: .parquet (needs pyarrow) or .npz.
+#
+# Runs finish in parallel across MultiProc workers and SLURM jobs, so appending
+# writes one small fragment per run to <store>.parts/ (rerunning a run just replaces
+# its fragment). compact_cohort_vifs folds the fragments into the store itself under
+# a file lock. load_cohort_vifs reads the store plus any fragments that have not been
+# compacted yet, so it is always up to date, and after compaction it is a single read.
+COHORT_VIF_KEYS = ['subject_id', 'task', 'direction']
+
+
+def _read_vif_table(filename):
+    import numpy as np
+    import pandas as pd
+
+    if filename.endswith('.parquet'):
+        return pd.read_parquet(filename)
+    with np.load(filename, allow_pickle=False) as table:
+        return pd.DataFrame({column: table[column] for column in table.files})
+
+
+def _write_vif_table(df, filename):
+    import os
+    import numpy as np
+
+    # write next to the target and rename so that readers never see a partial table
+    tmp = '%s.%d.tmp' % (filename, os.getpid())
+    if filename.endswith('.parquet'):
+        df.to_parquet(tmp, index=False)
+    else:
+        with open(tmp, 'wb') as file:
+            np.savez(file, **{column: df[column].to_numpy(dtype=(np.float64 if column == 'VIF' else str))
+                              for column in df.columns})
+    os.replace(tmp, filename)
+
+
+# add the VIFs of one run (a vifs.csv as written by VIFCalculation or merge_trial_vifs)
+# to the cohort store. Can be used as a Function node; returns the store path.
+def store_cohort_vifs(vif_file, subject_id, task, direction, store):
+    import os
+    import pandas as pd
+    from glm.utils import _write_vif_table
+
+    if not store.endswith(('.parquet', '.npz')):
+        raise ValueError('Cohort VIF store must be a .parquet or .npz file, got %s' % store)
+
+    vifs_df = pd.read_csv(vif_file, sep=',', header=None, names=['trial', 'VIF'],
+                          dtype={'trial': str})
+    vifs_df.insert(0, 'direction', direction)
+    vifs_df.insert(0, 'task', task)
+    vifs_df.insert(0, 'subject_id', str(subject_id))
+
+    parts_dir = store + '.parts'
+    os.makedirs(parts_dir, exist_ok=True)
+    ext = os.path.splitext(store)[1]
+    _write_vif_table(vifs_df, os.path.join(parts_dir, '%s_%s_%s%s' % (subject_id, task, direction, ext)))
+
+    return store
+
+
+def _cohort_vif_parts(store):
+    import os
+    import glob
+    return sorted(glob.glob(os.path.join(store + '.parts', '*' + os.path.splitext(store)[1])))
+
+
+def _concat_vif_tables(tables):
+    import pandas as pd
+
+    # runs in later tables replace the same runs in earlier ones
+    columns = COHORT_VIF_KEYS + ['trial', 'VIF']
+    kept = []
+    seen = pd.MultiIndex.from_tuples([], names=COHORT_VIF_KEYS)
+    for table in reversed(tables):
+        runs = pd.MultiIndex.from_frame(table[COHORT_VIF_KEYS].astype(str))
+        kept.append(table[~runs.isin(seen)])
+        seen = seen.union(runs.unique())
+
+    return pd.concat(kept[::-1] or [pd.DataFrame(columns=columns)],
+                     ignore_index=True)[columns]
+
+
+def load_cohort_vifs(store, subject_ids=None, tasks=None, directions=None, pattern=None):
+    '''
+    returns the cohort VIF table as a DataFrame, optionally restricted to some
+    subjects, tasks or directions and to trial labels matching the regular
+    expression pattern (e.g. r'^Task-(\d+)$' for single trials only)
+    '''
+    import os
+    import re
+    import numpy as np
+
+    tables = [_read_vif_table(store)] if os.path.exists(store) else []
+    tables += [_read_vif_table(part) for part in _cohort_vif_parts(store)]
+    vifs_df = _concat_vif_tables(tables)
+
+    keep = np.ones(len(vifs_df), dtype=bool)
+    for column, values in [('subject_id', subject_ids), ('task', tasks), ('direction', directions)]:
+        if values is not None:
+            keep &= vifs_df[column].isin([str(v) for v in values]).to_numpy()
+    if pattern is not None:
+        keep &= vifs_df['trial'].str.match(re.compile(pattern)).to_numpy()
+
+    return vifs_df[keep].reset_index(drop=True)
+
+
+def compact_cohort_vifs(store):
+    # fold pending fragments into the store. Returns the number of fragments merged
+    import os
+    import fcntl
+
+    with open(store + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        parts = [(part, os.path.getmtime(part)) for part in _cohort_vif_parts(store)]
+        if not parts:
+            return 0
+
+        tables = [_read_vif_table(store)] if os.path.exists(store) else []
+        tables += [_read_vif_table(part) for part, _ in parts]
+        _write_vif_table(_concat_vif_tables(tables), store)
+
+        # a fragment rewritten while we were merging stays for the next compaction
+        for part, mtime in parts:
+            if os.path.getmtime(part) == mtime:
+                os.remove(part)
+
+    return len(parts)
+
+
+# read an FSL design.mat or design.con file in one pass.
+#
+# The header (/NumWaves, /NumPoints, /NumContrasts, /PPheights, /RequiredEffect and
+# /ContrastNameN) is returned as a dict of ints, lists of floats and, for contrast
+# names, a 'ContrastNames' list in file order. The /Matrix block is parsed straight
+# from the raw bytes into a float64 array of shape (NumPoints or NumContrasts, NumWaves).
+#
+# With sidecar=True the matrix is also saved next to the file as <filename>.npy and
+# later calls load that instead of parsing the text, as long as the sidecar is not
+# older than the file. Failure to write the sidecar (e.g. read only results
+# directories) is not an error.
+def read_fsl_matrix(filename, sidecar=False):
+    import os
+    import numpy as np
+
+    npy = filename + '.npy'
+    use_sidecar = (sidecar and os.path.exists(npy) and
+                   os.path.getmtime(npy) >= os.path.getmtime(filename))
+
+    with open(filename, 'rb') as file:
+        if use_sidecar:
+            # only the header is needed, which is the first few kB at most
+            content = b''
+            for chunk in iter(lambda: file.read(1 << 16), b''):
+                content += chunk
+                if b'/Matrix' in content:
+                    break
+        else:
+            content = file.read()
+
+    head, found, body = content.partition(b'/Matrix')
+    if not found:
+        raise ValueError('%s does not contain a /Matrix section' % filename)
+
+    header = {}
+    contrast_names = {}
+    for line in head.decode('utf-8', errors='replace').splitlines():
+        line = line.strip()
+        if not line.startswith('/'):
+            continue
+        key, *value = line[1:].split(None, 1)
+        value = value[0] if value else ''
+        if key.startswith('ContrastName'):
+            contrast_names[int(key[len('ContrastName'):])] = value.strip()
+        elif key in ('NumWaves', 'NumPoints', 'NumContrasts'):
+            header[key] = int(value)
+        else:
+            header[key] = [float(v) for v in value.split()]
+    if contrast_names:
+        header['ContrastNames'] = [contrast_names[i] for i in sorted(contrast_names)]
+
+    if use_sidecar:
+        return np.load(npy), header
+
+    n_cols = header['NumWaves']
+    matrix = np.fromstring(body, dtype=np.float64, sep=' ')
+    n_rows = header.get('NumPoints', header.get('NumContrasts', matrix.size // max(n_cols, 1)))
+    if matrix.size != n_rows * n_cols:
+        raise ValueError('%s: expected a %d x %d matrix but found %d values' %
+                         (filename, n_rows, n_cols, matrix.size))
+    matrix = matrix.reshape(n_rows, n_cols)
+
+    if sidecar:
+        try:
+            tmp = npy + '.%d.tmp' % os.getpid()
+            with open(tmp, 'wb') as file:
+                np.save(file, matrix)
+            os.replace(tmp, npy)
+        except OSError:
+            pass
+
+    return matrix, header
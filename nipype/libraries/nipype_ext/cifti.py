@@ -0,0 +1,1595 @@
+import os
+
+import numpy as np
+
+from nipype.interfaces.base import BaseInterface, BaseInterfaceInputSpec, traits, File, Directory, TraitedSpec
+from nipype.utils.filemanip import split_filename
+
+from nipype_ext.io import INTERMEDIATE_FORMATS
+
+
+# In process CIFTI operations
+#
+# These read and write CIFTI files with nibabel instead of converting them to
+# fake NIfTIs for fslmaths or handing them to wb_command. dtseries store every
+# grayordinate's timeseries contiguously, so the transposed data block of a memory
+# mapped file is a grayordinates x timepoints array that can be processed in row
+# chunks without reading the whole file.
+
+def open_cifti_output(filename, template, shape=None):
+    '''
+    writes a float32 CIFTI with the header and axes of template (a loaded
+    Cifti2Image) to filename without materializing its data, and returns the data
+    block memory mapped as a (columns x rows) array, i.e. grayordinates x maps
+    '''
+    import nibabel as nib
+
+    shape = template.shape if shape is None else shape
+
+    # a zero strided array writes the header and a zero data block in one pass
+    img = nib.Cifti2Image(np.broadcast_to(np.float32(0), shape), header=template.header,
+                          nifti_header=template.nifti_header)
+    img.set_data_dtype(np.float32)
+    img.to_filename(filename)
+
+    offset = nib.load(filename).dataobj.offset
+    return np.memmap(filename, dtype=img.nifti_header.get_data_dtype(), mode='r+',
+                     offset=offset, shape=shape[::-1])
+
+
+class CiftiPreprocInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc='dtseries to preprocess')
+    median = traits.Float(mandatory=True,
+        desc='median of the volume data. The timeseries are scaled to 10000/median like surfintnorm')
+    highpass_sigma = traits.Float(mandatory=True, desc='highpass sigma in volumes, as passed to fslmaths -bptf')
+    chunk_size = traits.Int(4096, usedefault=True, desc='number of grayordinates filtered at a time')
+    num_threads = traits.Int(1, usedefault=True, desc='number of threads filtering chunks')
+
+class CiftiPreprocOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc='scaled and highpass filtered dtseries')
+
+# native replacement for cifti2nii -> surfintnorm -> meanfunc -> highpass ->
+# nii2cifti. The dtseries is read once through a memory map, scaled and
+# filtered chunk by chunk and written once, with the same arithmetic as the
+# fslmaths chain (see nipype_ext.temporal).
+class CiftiPreproc(BaseInterface):
+    input_spec = CiftiPreprocInputSpec
+    output_spec = CiftiPreprocOutputSpec
+
+    def _run_interface(self, runtime):
+        import nibabel as nib
+        from nipype_ext.temporal import highpass_filter
+
+        img = nib.load(self.inputs.in_file, mmap=True)
+        series = np.asanyarray(img.dataobj).T
+
+        out = open_cifti_output(self._list_outputs()['out_file'], img)
+        # same string round trip as getinormscale
+        scale = float('%.14f' % (10000. / self.inputs.median))
+        highpass_filter(series, self.inputs.highpass_sigma, out=out, scale=scale,
+                        chunk_size=self.inputs.chunk_size, n_threads=self.inputs.num_threads)
+        out.flush()
+        del out
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        # named like the nii2cifti output of the fslmaths chain
+        _, base, ext = split_filename(self.inputs.in_file)
+        base, map_type = os.path.splitext(base)
+        outputs['out_file'] = os.path.abspath(base + '_intnorm_hpf' + map_type + ext)
+        return outputs
+
+
+# Geodesic smoothing as a precomputed operator
+#
+# wb_command -cifti-smoothing weights every surface vertex's neighbours by a
+# gaussian of their geodesic distance on the midthickness surface times their
+# vertex area (GEO_GAUSS_AREA), and every voxel's neighbours within the same
+# subcortical structure by a gaussian of their distance, and normalizes the
+# weights of each output to one. The weights only depend on the surfaces, the
+# brain models of the dtseries and the sigmas, and smoothing is linear, so all of
+# it is one sparse grayordinates x grayordinates matrix. cifti_smoothing_matrix
+# builds it and CiftiSmooth keeps it in the 'surfsmooth' namespace of glm.cache.
+# The first run of a subject builds it under the cache's lock and every other run,
+# concurrent or later, is smoothed with one sparse product.
+#
+# Kernels are truncated at 3 sigma. Geodesic distances are shortest paths along
+# the mesh edges plus, like Workbench's geodesic helper, straight paths across
+# pairs of triangles, so they come close to but aren't exactly Workbench's.
+
+def surface_graph(coords, triangles):
+    '''
+    undirected sparse graph of the mesh edge lengths, with an extra edge between
+    the far vertices of each pair of triangles sharing an edge wherever the
+    straight path between them (with the pair unfolded flat) crosses that edge
+    '''
+    from scipy.sparse import coo_matrix
+
+    coords = np.asarray(coords, dtype=np.float64)
+    n_vertices = len(coords)
+    triangles = np.asarray(triangles, dtype=np.int64)
+
+    # every triangle edge with the vertex opposite it, grouped by edge
+    a = triangles.ravel()
+    b = np.roll(triangles, -1, axis=1).ravel()
+    c = np.roll(triangles, -2, axis=1).ravel()
+    lo, hi = np.minimum(a, b), np.maximum(a, b)
+    order = np.lexsort((hi, lo))
+    lo, hi, c = lo[order], hi[order], c[order]
+
+    # edges shared by two triangles are adjacent after sorting
+    shared = np.flatnonzero((lo[:-1] == lo[1:]) & (hi[:-1] == hi[1:]))
+    p, q = lo[shared], hi[shared]
+    u, v = c[shared], c[shared + 1]
+
+    # unfold: p at the origin, q on the x axis, u above it and v below it
+    axis = coords[q] - coords[p]
+    length = np.linalg.norm(axis, axis=1)
+    axis /= length[:, None]
+    xu = ((coords[u] - coords[p]) * axis).sum(axis=1)
+    xv = ((coords[v] - coords[p]) * axis).sum(axis=1)
+    yu = np.linalg.norm(coords[u] - coords[p] - xu[:, None] * axis, axis=1)
+    yv = -np.linalg.norm(coords[v] - coords[p] - xv[:, None] * axis, axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossing = xu + (xv - xu) * yu / (yu - yv)
+    across = (crossing > 0) & (crossing < length)
+
+    rows = np.concatenate([lo, np.minimum(u, v)[across]])
+    cols = np.concatenate([hi, np.maximum(u, v)[across]])
+    weights = np.concatenate([np.linalg.norm(coords[lo] - coords[hi], axis=1),
+                              np.hypot(xu - xv, yu - yv)[across]])
+
+    # shared edges are listed once per triangle, keep one of each
+    _, first = np.unique(rows * n_vertices + cols, return_index=True)
+    graph = coo_matrix((weights[first], (rows[first], cols[first])), shape=(n_vertices, n_vertices))
+    return (graph + graph.T).tocsr()
+
+
+def vertex_areas(coords, triangles):
+    # a third of the area of every triangle each vertex is part of
+    coords = np.asarray(coords, dtype=np.float64)
+    triangles = np.asarray(triangles, dtype=np.int64)
+    sides = np.cross(coords[triangles[:, 1]] - coords[triangles[:, 0]],
+                     coords[triangles[:, 2]] - coords[triangles[:, 0]])
+    areas = np.linalg.norm(sides, axis=1) / 6.
+    return np.bincount(triangles.ravel(), weights=np.repeat(areas, 3), minlength=len(coords))
+
+
+def surface_smoothing_matrix(coords, triangles, vertices, sigma, chunk_size=256):
+    '''
+    coords, triangles - the surface
+    vertices - surface vertices the cifti has data for (in cifti order)
+    sigma - gaussian sigma in mm
+
+    returns the len(vertices) x len(vertices) GEO_GAUSS_AREA smoothing matrix.
+    Distances are measured on the whole surface, weights only given to vertices
+    with data.
+    '''
+    from scipy.sparse import csr_matrix, vstack
+    from scipy.sparse.csgraph import dijkstra
+
+    vertices = np.asarray(vertices)
+    graph = surface_graph(coords, triangles)
+    areas = vertex_areas(coords, triangles)
+
+    # cifti column of each surface vertex, -1 for vertices without data
+    column = np.full(len(coords), -1)
+    column[vertices] = np.arange(len(vertices))
+
+    rows = []
+    for start in range(0, len(vertices), chunk_size):
+        # dense chunk x n_vertices distances, inf beyond the cutoff
+        dist = dijkstra(graph, directed=False, indices=vertices[start:start + chunk_size], limit=3 * sigma)
+        row, vertex = np.nonzero(np.isfinite(dist) & (column >= 0))
+        weights = np.exp(-0.5 * (dist[row, vertex] / sigma) ** 2) * areas[vertex]
+        rows.append(csr_matrix((weights, (row, column[vertex])), shape=(len(dist), len(vertices))))
+
+    return _normalize_rows(vstack(rows).tocsr())
+
+
+def volume_smoothing_matrix(voxels, affine, sigma):
+    '''
+    voxels - n x 3 voxel indices of one structure
+    affine - voxel to mm affine
+    sigma - gaussian sigma in mm
+
+    returns the n x n smoothing matrix within the structure
+    '''
+    from scipy.sparse import csr_matrix
+    from scipy.spatial import cKDTree
+
+    mm = np.asarray(voxels) @ np.asarray(affine)[:3, :3].T + np.asarray(affine)[:3, 3]
+    tree = cKDTree(mm)
+    pairs = tree.sparse_distance_matrix(tree, 3 * sigma, output_type='ndarray')
+
+    weights = np.exp(-0.5 * (pairs['v'] / sigma) ** 2)
+    return _normalize_rows(csr_matrix((weights, (pairs['i'], pairs['j'])), shape=(len(mm), len(mm))))
+
+
+def _normalize_rows(matrix):
+    # scales every row of a csr matrix to sum to one
+    sums = np.asarray(matrix.sum(axis=1)).ravel()
+    matrix.data /= np.repeat(sums, np.diff(matrix.indptr))
+    return matrix
+
+
+def cifti_smoothing_matrix(brain_models, surfaces, sigma_surf, sigma_vol):
+    '''
+    brain_models - BrainModelAxis of the dtseries
+    surfaces - dict of cifti structure name (e.g. CIFTI_STRUCTURE_CORTEX_LEFT) to
+               (coords, triangles)
+    sigma_surf, sigma_vol - gaussian sigmas in mm. 0 leaves that part unsmoothed
+
+    returns the grayordinates x grayordinates smoothing matrix as float32 csr.
+    Like wb_command -cifti-smoothing without -merged-volume, every volume
+    structure is smoothed on its own.
+    '''
+    from scipy.sparse import block_diag, identity
+
+    blocks = []
+    for name, indices, model in brain_models.iter_structures():
+        n = len(model)
+        if model.volume_mask.any():
+            if sigma_vol > 0:
+                blocks.append(volume_smoothing_matrix(model.voxel[model.volume_mask], model.affine, sigma_vol))
+            else:
+                blocks.append(identity(n, format='csr'))
+        elif sigma_surf > 0:
+            if name not in surfaces:
+                raise ValueError('no surface given for %s' % name)
+            coords, triangles = surfaces[name]
+            blocks.append(surface_smoothing_matrix(coords, triangles, model.vertex[model.surface_mask], sigma_surf))
+        else:
+            blocks.append(identity(n, format='csr'))
+
+    return block_diag(blocks, format='csr', dtype=np.float32)
+
+
+def sparse_apply(matrix, data, out=None, chunk_size=4096, n_threads=1):
+    '''
+    matrix - n x m sparse csr matrix
+    data - m x T array
+    out - n x T float32 array to write into (e.g. a memmap). Defaults to a new array
+
+    returns out = matrix @ data, computed in row chunks across n_threads threads
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    data = np.ascontiguousarray(data, dtype=np.float32)
+    if out is None:
+        out = np.empty((matrix.shape[0], data.shape[1]), dtype=np.float32)
+
+    def apply_chunk(start):
+        out[start:start + chunk_size] = matrix[start:start + chunk_size] @ data
+
+    starts = range(0, matrix.shape[0], chunk_size)
+    if n_threads > 1:
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            list(pool.map(apply_chunk, starts))
+    else:
+        for start in starts:
+            apply_chunk(start)
+
+    return out
+
+
+class CiftiSmoothInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc='dtseries to smooth')
+    sigma_surf = traits.Float(mandatory=True, desc='sigma of the surface kernel in mm')
+    sigma_vol = traits.Float(mandatory=True, desc='sigma of the volume kernel in mm')
+    left_surf = File(exists=True, mandatory=True, desc='left midthickness surface')
+    right_surf = File(exists=True, mandatory=True, desc='right midthickness surface')
+    use_cache = traits.Bool(True, usedefault=True,
+        desc='reuse smoothing matrices built earlier for the same surfaces, brain models and sigmas')
+    cache_dir = Directory(desc='root of the cache. Defaults to glm.cache.DEFAULT_CACHE_DIR')
+    chunk_size = traits.Int(4096, usedefault=True, desc='number of grayordinates smoothed at a time')
+    num_threads = traits.Int(1, usedefault=True, desc='number of threads smoothing chunks')
+
+class CiftiSmoothOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc='smoothed dtseries')
+
+# native, cached replacement for wb_command -cifti-smoothing along columns (see
+# cifti_smoothing_matrix). The output is named like nipype's CiftiSmooth names it.
+class CiftiSmooth(BaseInterface):
+    input_spec = CiftiSmoothInputSpec
+    output_spec = CiftiSmoothOutputSpec
+
+    def _run_interface(self, runtime):
+        import nibabel as nib
+        from scipy.sparse import load_npz, save_npz
+        from nipype.interfaces.base import isdefined
+
+        img = nib.load(self.inputs.in_file, mmap=True)
+        brain_models = img.header.get_axis(1)
+
+        if not self.inputs.use_cache:
+            matrix = self._matrix(brain_models)
+        else:
+            from glm.cache import DiskCache, hash_bytes, hash_stat
+
+            cache = DiskCache('surfsmooth', cache_dir=self.inputs.cache_dir if isdefined(self.inputs.cache_dir) else None)
+            models = [(name, indices.start, indices.stop, model.vertex.tobytes(), model.voxel.tobytes(),
+                       model.affine.tobytes() if model.affine is not None else b'')
+                      for name, indices, model in brain_models.iter_structures()]
+            # the surfaces come from the read only archive, so their path, size and mtime identify them
+            key = hash_bytes(hash_stat(self.inputs.left_surf), hash_stat(self.inputs.right_surf),
+                             repr(models), repr((self.inputs.sigma_surf, self.inputs.sigma_vol)))
+
+            # the runs of a subject start together under MultiProc. The first one to
+            # take the lock builds the matrix and the others wait for it
+            matrix = None
+            cached = cache.get(key, '.npz')
+            if cached is None:
+                with cache.lock(key):
+                    cached = cache.get(key, '.npz')
+                    if cached is None:
+                        matrix = self._matrix(brain_models)
+                        tmp = os.path.abspath('smoothing_matrix.npz')
+                        save_npz(tmp, matrix)
+                        cache.put(key, tmp, '.npz', move=True)
+            if matrix is None:
+                matrix = load_npz(cached)
+
+        out = open_cifti_output(self._list_outputs()['out_file'], img)
+        sparse_apply(matrix, np.asanyarray(img.dataobj).T, out=out,
+                     chunk_size=self.inputs.chunk_size, n_threads=self.inputs.num_threads)
+        out.flush()
+        del out
+
+        return runtime
+
+    def _matrix(self, brain_models):
+        import nibabel as nib
+
+        surfaces = {}
+        for name, filename in [('CIFTI_STRUCTURE_CORTEX_LEFT', self.inputs.left_surf),
+                               ('CIFTI_STRUCTURE_CORTEX_RIGHT', self.inputs.right_surf)]:
+            surf = nib.load(filename)
+            surfaces[name] = (surf.agg_data('pointset'), surf.agg_data('triangle'))
+
+        return cifti_smoothing_matrix(brain_models, surfaces, self.inputs.sigma_surf, self.inputs.sigma_vol)
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        _, base, _ = split_filename(self.inputs.in_file)
+        outputs['out_file'] = os.path.abspath('smoothed_%s.nii' % base)
+        return outputs
+
+
+# Separating dense CIFTIs
+#
+# wb_command -cifti-separate scatters the voxels of a dtseries into a volume
+# (with an ROI and a label volume of the structures) and the vertices of each
+# surface structure into a metric. All of that only needs the brain model axis
+# of the header, and every structure is a contiguous range of columns of the
+# data block, so the parts of a memory mapped dtseries are views that can be
+# used without copying (cifti_structures) or written out a few maps at a time.
+
+# NIfTI extension code Workbench stores label tables under
+CARET_ECODE = 30
+
+def cifti_structures(filename):
+    '''
+    {structure: (BrainModelAxis, maps x grayordinates array)} of the dense CIFTI
+    filename. The arrays are views of the memory mapped data block, so nothing
+    is read until they are used.
+    '''
+    import nibabel as nib
+
+    img = nib.load(filename, mmap=True)
+    data = np.asanyarray(img.dataobj)
+    return {str(name): (model, data[:, indices])
+            for name, indices, model in img.header.get_axis(1).iter_structures()}
+
+
+def write_label_volume(filename, keys, affine, table):
+    '''
+    writes the integer volume keys as a Workbench label volume, with table
+    ({key: name}) as its label table
+    '''
+    import nibabel as nib
+    from xml.sax.saxutils import escape
+
+    rng = np.random.default_rng(0)
+    labels = ['<Label Key="0" Red="0" Green="0" Blue="0" Alpha="0"><![CDATA[???]]></Label>']
+    for key, name in sorted(table.items()):
+        red, green, blue = rng.random(3)
+        labels.append('<Label Key="%d" Red="%.6f" Green="%.6f" Blue="%.6f" Alpha="1">%s</Label>'
+                      % (key, red, green, blue, escape(name)))
+    xml = ('<CaretExtension Version="1.0"><VolumeInformation Index="0"><LabelTable>%s</LabelTable>'
+           '<StudyMetaDataLinkSet></StudyMetaDataLinkSet><VolumeType>Label</VolumeType>'
+           '</VolumeInformation></CaretExtension>' % ''.join(labels))
+
+    img = nib.Nifti1Image(keys.astype(np.int32), affine)
+    img.header.set_intent('label')
+    img.header.extensions.append(nib.nifti1.Nifti1Extension(CARET_ECODE, xml.encode()))
+    img.to_filename(filename)
+
+
+def write_metric(filename, values, structure):
+    # writes maps x vertices values as a metric of structure (a CIFTI structure name)
+    import nibabel as nib
+
+    primary = ''.join(word.capitalize() for word in structure.replace('CIFTI_STRUCTURE_', '').split('_'))
+    darrays = [nib.gifti.GiftiDataArray(np.ascontiguousarray(row, dtype=np.float32),
+                                        intent='NIFTI_INTENT_NONE', datatype='NIFTI_TYPE_FLOAT32')
+               for row in values]
+    nib.save(nib.GiftiImage(meta=nib.gifti.GiftiMetaData({'AnatomicalStructurePrimary': primary}),
+                            darrays=darrays), filename)
+
+
+class CiftiSeparateInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc='dense CIFTI to separate along its columns')
+    volume_all = traits.Bool(False, usedefault=True,
+        desc=('separate all volume structures into a volume file. '
+              'Populates volume_all_out, volume_all_roi_out and volume_all_label_out'))
+    output_type = traits.Enum(*INTERMEDIATE_FORMATS, usedefault=True, desc='format of the volume_all files')
+    metric = traits.List(traits.Str, desc='surface structures to write metrics of, e.g. CORTEX_LEFT')
+    chunk_size = traits.Int(64, usedefault=True, desc='number of maps scattered into the volume at a time')
+    num_threads = traits.Int(1, usedefault=True, desc='number of threads compressing the NIFTI_GZ volume')
+
+class CiftiSeparateOutputSpec(TraitedSpec):
+    volume_all_out = File(exists=True, desc='volume of all voxel data, zero outside the structures')
+    volume_all_roi_out = File(exists=True, desc='roi of the voxels in the dense CIFTI')
+    volume_all_label_out = File(exists=True, desc='label volume of the structures')
+    CORTEX_LEFT_out = File(exists=True, desc='metric of the left cortex')
+    CORTEX_RIGHT_out = File(exists=True, desc='metric of the right cortex')
+
+# native replacement for nipype_ext.workbench.CiftiSeparate (wb_command
+# -cifti-separate along COLUMN) with the same outputs and file names. The data
+# block is read through a memory map and the volume is written through one, a
+# chunk of maps at a time, and compressed afterwards for NIFTI_GZ.
+class CiftiSeparate(BaseInterface):
+    input_spec = CiftiSeparateInputSpec
+    output_spec = CiftiSeparateOutputSpec
+
+    def _run_interface(self, runtime):
+        import nibabel as nib
+        from nibabel.cifti2.cifti2_axes import BrainModelAxis
+        from nipype.interfaces.base import isdefined
+        from nipype_ext.io import compress_nifti
+        from nipype_ext.temporal import open_nifti_output
+
+        structures = cifti_structures(self.inputs.in_file)
+        outputs = self._list_outputs()
+
+        if self.inputs.volume_all:
+            volume = [(name, model, data) for name, (model, data) in structures.items()
+                      if model.volume_mask.all()]
+            if not volume:
+                raise ValueError('%s has no volume structures' % self.inputs.in_file)
+            shape, affine = volume[0][1].volume_shape, volume[0][1].affine
+            n_maps = volume[0][2].shape[0]
+
+            roi = np.zeros(shape, dtype=np.float32)
+            keys = np.zeros(shape, dtype=np.int32)
+            table = {}
+            for key, (name, model, _) in enumerate(volume, 1):
+                roi[tuple(model.voxel.T)] = 1
+                keys[tuple(model.voxel.T)] = key
+                table[key] = name.replace('CIFTI_STRUCTURE_', '')
+            nib.Nifti1Image(roi, affine).to_filename(outputs['volume_all_roi_out'])
+            write_label_volume(outputs['volume_all_label_out'], keys, affine, table)
+
+            # written uncompressed through a memmap, voxels x maps like NIfTI stores it
+            filename = outputs['volume_all_out']
+            if filename.endswith('.gz'):
+                filename = filename[:-3]
+            out = open_nifti_output(filename, nib.Nifti1Image(roi, affine), shape + (n_maps,))
+            chunk = self.inputs.chunk_size
+            for name, model, data in volume:
+                rows = np.ravel_multi_index(tuple(model.voxel.T), shape, order='F')
+                for start in range(0, n_maps, chunk):
+                    out[rows, start:start + chunk] = np.asarray(data[start:start + chunk]).T
+            out.flush()
+            del out
+            if filename != outputs['volume_all_out']:
+                compress_nifti(filename, n_threads=self.inputs.num_threads)
+
+        if isdefined(self.inputs.metric):
+            for structure in self.inputs.metric:
+                name = BrainModelAxis.to_cifti_brain_structure_name(structure)
+                if name not in structures or not structures[name][0].surface_mask.all():
+                    raise ValueError('%s has no surface structure %s' % (self.inputs.in_file, structure))
+                model, data = structures[name]
+                values = np.zeros((data.shape[0], model.nvertices[name]), dtype=np.float32)
+                values[:, model.vertex] = data
+                write_metric(outputs[structure + '_out'], values, name)
+
+        return runtime
+
+    def _list_outputs(self):
+        from nipype.interfaces.base import isdefined
+
+        outputs = self.output_spec().get()
+        # named like the wb_command outputs
+        fname = os.path.basename(self.inputs.in_file)
+        fname, _ = os.path.splitext(fname)
+        fname, _ = os.path.splitext(fname)
+
+        if self.inputs.volume_all:
+            ext = INTERMEDIATE_FORMATS[self.inputs.output_type]
+            outputs['volume_all_out'] = os.path.abspath(fname + '_volume_all' + ext)
+            outputs['volume_all_roi_out'] = os.path.abspath(fname + '_volume_all_roi' + ext)
+            outputs['volume_all_label_out'] = os.path.abspath(fname + '_volume_all_label' + ext)
+
+        if isdefined(self.inputs.metric):
+            for structure in self.inputs.metric:
+                outputs[structure + '_out'] = os.path.abspath(fname + '_' + structure + '.func.gii')
+
+        return outputs
+
+
+# Dense assembly
+#
+# wb_command -cifti-create-dense-timeseries builds the brain models of its output
+# from the label volume (-volume ... -label) and the atlas ROIs of the two
+# hemispheres and copies the data of every grayordinate out of the volume and the
+# metrics. Each statistic of each contrast used to be one such call, followed by
+# a -cifti-merge of the contrasts. The brain models are the same for every map,
+# so dense_brain_models builds them once and gather_dense copies any number of
+# maps (or timepoints) into a dense output with one fancy index per structure.
+# They are also the same for every run of a subject, so cached_brain_models
+# keeps them in the 'brainmodels' namespace of glm.cache (and in memory).
+
+def volume_label_table(img):
+    # {key: name} of the label table Workbench stored in the NIfTI img
+    import xml.etree.ElementTree as ET
+
+    for ext in img.header.extensions:
+        if ext.get_code() != CARET_ECODE:
+            continue
+        content = ext.content if hasattr(ext, 'content') else ext.get_content()
+        root = ET.fromstring(content.rstrip(b'\0'))
+        return {int(label.get('Key')): (label.text or '').strip() for label in root.iter('Label')}
+
+    raise ValueError('%s has no Workbench label table' % img.get_filename())
+
+
+def dense_brain_models(label_file, left_roi, right_roi):
+    '''
+    label_file - label volume of structures, e.g. from wb_command -cifti-separate
+                 -volume-all -label
+    left_roi, right_roi - atlasroi shape.gii of the hemispheres
+
+    returns the BrainModelAxis wb_command -cifti-create-dense-timeseries gives its
+    output: the ROI vertices of the left and right cortex, then the voxels of each
+    labelled structure
+    '''
+    import nibabel as nib
+    from nibabel.cifti2.cifti2_axes import BrainModelAxis
+
+    models = None
+    for name, roi in [('CORTEX_LEFT', left_roi), ('CORTEX_RIGHT', right_roi)]:
+        model = BrainModelAxis.from_mask(np.asarray(nib.load(roi).agg_data()) > 0, name=name)
+        models = model if models is None else models + model
+
+    label = nib.load(label_file)
+    keys = np.asanyarray(label.dataobj)
+    keys = keys.reshape(keys.shape[:3])
+    table = volume_label_table(label)
+
+    # Workbench adds structures in the order of its structure enum, which is
+    # alphabetical for the subcortical ones, and their voxels with i fastest
+    structures = sorted((BrainModelAxis.to_cifti_brain_structure_name(name), key)
+                        for key, name in table.items() if key != 0)
+    for name, key in structures:
+        voxels = np.argwhere(keys.T == key)[:, ::-1]
+        if len(voxels):
+            models = models + BrainModelAxis(name, voxel=voxels, affine=label.affine,
+                                             volume_shape=keys.shape)
+
+    return models
+
+
+def save_brain_models(filename, brain_models):
+    # writes brain_models to an npz, one name, vertex and voxel range per structure
+    structures, counts = [], []
+    for name, indices, model in brain_models.iter_structures():
+        structures.append(str(name))
+        counts.append(len(model))
+    np.savez_compressed(filename, structures=np.array(structures), counts=np.array(counts),
+                        vertex=brain_models.vertex, voxel=brain_models.voxel,
+                        affine=brain_models.affine if brain_models.affine is not None else np.zeros((0, 0)),
+                        volume_shape=np.array(brain_models.volume_shape or ()),
+                        surfaces=np.array(list(brain_models.nvertices)),
+                        nvertices=np.array(list(brain_models.nvertices.values())))
+
+
+def load_brain_models(filename):
+    from nibabel.cifti2.cifti2_axes import BrainModelAxis
+
+    with np.load(filename, allow_pickle=False) as saved:
+        affine = saved['affine'] if saved['affine'].size else None
+        volume_shape = tuple(int(n) for n in saved['volume_shape']) or None
+        return BrainModelAxis(np.repeat(saved['structures'], saved['counts']),
+                              voxel=saved['voxel'], vertex=saved['vertex'], affine=affine,
+                              volume_shape=volume_shape,
+                              nvertices=dict(zip(saved['surfaces'].tolist(), saved['nvertices'].tolist())))
+
+
+# brain models built or loaded by this process, by cache key
+_brain_models = {}
+
+def cached_brain_models(label_file, left_roi, right_roi, use_cache=True, cache_dir=None):
+    '''
+    dense_brain_models, keyed by the label volume's labels, affine and label names
+    and by the contents of the ROIs. Label colors don't matter, so the label
+    volumes of all runs of a subject share one entry.
+    '''
+    import nibabel as nib
+    from glm.cache import DiskCache, hash_bytes, hash_file
+
+    if not use_cache:
+        return dense_brain_models(label_file, left_roi, right_roi)
+
+    label = nib.load(label_file)
+    table = volume_label_table(label)
+    key = hash_bytes(np.ascontiguousarray(np.asanyarray(label.dataobj)).tobytes(), repr(label.shape),
+                     np.asarray(label.affine, dtype=np.float64).tobytes(), repr(sorted(table.items())),
+                     hash_file(left_roi), hash_file(right_roi))
+    if key in _brain_models:
+        return _brain_models[key]
+
+    cache = DiskCache('brainmodels', cache_dir=cache_dir)
+    cached = cache.get(key, '.npz')
+    if cached is not None:
+        brain_models = load_brain_models(cached)
+    else:
+        import tempfile
+
+        brain_models = dense_brain_models(label_file, left_roi, right_roi)
+        fd, tmp = tempfile.mkstemp(dir=cache.cache_dir, prefix='.tmp_', suffix='.npz')
+        os.close(fd)
+        save_brain_models(tmp, brain_models)
+        cache.put(key, tmp, '.npz', move=True)
+
+    _brain_models[key] = brain_models
+    return brain_models
+
+
+def gather_dense(brain_models, volume, left, right, out):
+    '''
+    brain_models - BrainModelAxis of the output
+    volume - voxels x n array of volume data, flattened in Fortran order like
+             NIfTI stores it (so a reshaped memmap works)
+    left, right - vertices x n arrays of the left and right surface data
+    out - grayordinates x n array to write into, e.g. columns of a memmap
+
+    returns out
+    '''
+    for name, indices, model in brain_models.iter_structures():
+        if name == 'CIFTI_STRUCTURE_CORTEX_LEFT':
+            source, rows = left, model.vertex
+        elif name == 'CIFTI_STRUCTURE_CORTEX_RIGHT':
+            source, rows = right, model.vertex
+        elif model.volume_mask.all():
+            source = volume
+            rows = np.ravel_multi_index(tuple(model.voxel.T), model.volume_shape, order='F')
+        else:
+            raise ValueError('no data for surface structure %s' % name)
+        out[indices] = source[rows]
+
+    return out
+
+
+def _filmgls_files(directory, stat):
+    # {contrast number: file} of a statistic FILMGLS wrote to its results directory
+    import re
+
+    pattern = re.compile(r'^%s(\d+)\.(nii|nii\.gz|func\.gii)$' % stat)
+    files = {}
+    for name in os.listdir(directory):
+        match = pattern.match(name)
+        if match:
+            files[int(match.group(1))] = os.path.join(directory, name)
+    return files
+
+
+def _filmgls_file(directory, name):
+    # a single file FILMGLS wrote to its results directory, e.g. res4d
+    for ext in ['.nii', '.nii.gz', '.func.gii']:
+        if os.path.exists(os.path.join(directory, name + ext)):
+            return os.path.join(directory, name + ext)
+    raise ValueError('FILMGLS results directory %s has no %s' % (directory, name))
+
+
+def _volume_rows(filename):
+    # voxels x n view of a NIfTI, memory mapped if it is uncompressed
+    import nibabel as nib
+
+    img = nib.load(filename, mmap=True)
+    data = np.asanyarray(img.dataobj)
+    return data.reshape((int(np.prod(img.shape[:3])), -1), order='F')
+
+
+def _surface_rows(filename):
+    # vertices x n array of a metric, whatever the intent of its data arrays
+    import nibabel as nib
+
+    return np.column_stack([np.asarray(d.data, dtype=np.float32).ravel() for d in nib.load(filename).darrays])
+
+
+def open_dense_output(filename, brain_models, n_maps):
+    '''
+    writes a float32 dtseries header with n_maps timepoints (start 0, step 1 s,
+    the -cifti-create-dense-timeseries defaults) over brain_models to filename and
+    returns the data block memory mapped as a grayordinates x maps array
+    '''
+    import nibabel as nib
+    from nibabel.cifti2.cifti2_axes import SeriesAxis
+
+    shape = (n_maps, len(brain_models))
+    template = nib.Cifti2Image(np.broadcast_to(np.float32(0), shape),
+                               header=(SeriesAxis(0, 1, n_maps, unit='second'), brain_models))
+    template.nifti_header.set_intent('ConnDenseSeries')
+    return open_cifti_output(filename, template)
+
+
+def write_dense(filename, brain_models, volume, left, right):
+    '''
+    writes a dtseries over brain_models from voxels x T, vertices x T arrays
+    (in memory or memory mapped, see gather_dense) straight into the memory
+    mapped output, and returns filename
+    '''
+    out = open_dense_output(filename, brain_models, volume.shape[1])
+    gather_dense(brain_models, volume, left, right, out)
+    out.flush()
+    del out
+    return filename
+
+
+class CiftiCreateDenseTimeseriesInputSpec(BaseInterfaceInputSpec):
+    out_file = File(desc='the output dtseries. Defaults to the volume file name with a .dtseries.nii extension')
+    volume = File(exists=True, mandatory=True, desc='volume with the data of all volume structures')
+    volume_label = File(exists=True, mandatory=True, desc='label volume of the structures')
+    left_metric = File(exists=True, mandatory=True, desc='metric of the left surface')
+    left_roi = File(exists=True, mandatory=True, desc='roi of the left surface vertices to use')
+    right_metric = File(exists=True, mandatory=True, desc='metric of the right surface')
+    right_roi = File(exists=True, mandatory=True, desc='roi of the right surface vertices to use')
+    use_cache = traits.Bool(True, usedefault=True,
+        desc='reuse brain models built earlier from the same labels and ROIs')
+    cache_dir = Directory(desc='root of the cache. Defaults to glm.cache.DEFAULT_CACHE_DIR')
+
+class CiftiCreateDenseTimeseriesOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc='the output dtseries')
+
+# native replacement for nipype_ext.workbench.CiftiCreateDenseTimeseries. Brain
+# models come from cached_brain_models, so after the first run of a subject
+# creating a dense file is a copy out of the (memory mapped, if uncompressed)
+# inputs. The output is named after the volume unless out_file is set.
+class CiftiCreateDenseTimeseries(BaseInterface):
+    input_spec = CiftiCreateDenseTimeseriesInputSpec
+    output_spec = CiftiCreateDenseTimeseriesOutputSpec
+
+    def _run_interface(self, runtime):
+        from nipype.interfaces.base import isdefined
+
+        brain_models = cached_brain_models(self.inputs.volume_label, self.inputs.left_roi, self.inputs.right_roi,
+            use_cache=self.inputs.use_cache,
+            cache_dir=self.inputs.cache_dir if isdefined(self.inputs.cache_dir) else None)
+        write_dense(self._list_outputs()['out_file'], brain_models, _volume_rows(self.inputs.volume),
+                    _surface_rows(self.inputs.left_metric), _surface_rows(self.inputs.right_metric))
+
+        return runtime
+
+    def _list_outputs(self):
+        from nipype.interfaces.base import isdefined
+
+        outputs = self.output_spec().get()
+        if isdefined(self.inputs.out_file):
+            outputs['out_file'] = os.path.abspath(self.inputs.out_file)
+        else:
+            _, base, _ = split_filename(self.inputs.volume)
+            outputs['out_file'] = os.path.abspath(base + '.dtseries.nii')
+        return outputs
+
+
+# statistics of CiftiStatMaps: FILMGLS file prefix, output field and directory
+STAT_MAPS = [('cope', 'copes', 'copes'),
+             ('varcope', 'varcopes', 'varcopes'),
+             ('tstat', 'tstats', 'tstat'),
+             ('zstat', 'zstats', 'zstat')]
+
+
+class CiftiStatMapsInputSpec(BaseInterfaceInputSpec):
+    volume_dir = Directory(exists=True, mandatory=True, desc='results directory of the volume FILMGLS')
+    left_dir = Directory(exists=True, mandatory=True, desc='results directory of the left surface FILMGLS')
+    right_dir = Directory(exists=True, mandatory=True, desc='results directory of the right surface FILMGLS')
+    volume_label = File(exists=True, mandatory=True,
+        desc='label volume of the subcortical structures, from CiftiSeparate volume_all_label_out')
+    left_roi = File(exists=True, mandatory=True, desc='left atlasroi shape.gii')
+    right_roi = File(exists=True, mandatory=True, desc='right atlasroi shape.gii')
+    use_cache = traits.Bool(True, usedefault=True,
+        desc='reuse brain models built earlier from the same labels and ROIs')
+    cache_dir = Directory(desc='root of the cache. Defaults to glm.cache.DEFAULT_CACHE_DIR')
+
+class CiftiStatMapsOutputSpec(TraitedSpec):
+    copes = File(exists=True, desc='copes of all contrasts, in contrast order')
+    varcopes = File(exists=True, desc='varcopes of all contrasts')
+    tstats = File(exists=True, desc='tstats of all contrasts')
+    zstats = File(exists=True, desc='zstats of all contrasts')
+    res4 = File(exists=True, desc='dense residual timeseries')
+
+# native replacement for the cifticreatedense* MapNodes (wb_command
+# -cifti-create-dense-timeseries per contrast and statistic) and the CiftiMerge
+# of their outputs. Every statistic is written straight into its merged file,
+# one contrast at a time. The outputs keep the names and layout of the
+# wb_command files (a series of maps, even though the merged files are named
+# .dscalar.nii), each in a directory named after its datasink field.
+class CiftiStatMaps(BaseInterface):
+    input_spec = CiftiStatMapsInputSpec
+    output_spec = CiftiStatMapsOutputSpec
+
+    def _run_interface(self, runtime):
+        from nipype.interfaces.base import isdefined
+
+        brain_models = cached_brain_models(self.inputs.volume_label, self.inputs.left_roi, self.inputs.right_roi,
+            use_cache=self.inputs.use_cache,
+            cache_dir=self.inputs.cache_dir if isdefined(self.inputs.cache_dir) else None)
+        outputs = self._list_outputs()
+        dirs = [self.inputs.volume_dir, self.inputs.left_dir, self.inputs.right_dir]
+
+        for stat, field, _ in STAT_MAPS:
+            volume, left, right = [_filmgls_files(d, stat) for d in dirs]
+            if not volume or set(volume) != set(left) or set(volume) != set(right):
+                raise ValueError('FILMGLS %s files of %s differ' % (stat, dirs))
+
+            os.makedirs(os.path.dirname(outputs[field]), exist_ok=True)
+            out = open_dense_output(outputs[field], brain_models, len(volume))
+            for column, contrast in enumerate(sorted(volume)):
+                gather_dense(brain_models, _volume_rows(volume[contrast]), _surface_rows(left[contrast]),
+                             _surface_rows(right[contrast]), out[:, column:column + 1])
+            out.flush()
+            del out
+
+        os.makedirs(os.path.dirname(outputs['res4']), exist_ok=True)
+        write_dense(outputs['res4'], brain_models,
+                    _volume_rows(_filmgls_file(self.inputs.volume_dir, 'res4d')),
+                    _surface_rows(_filmgls_file(self.inputs.left_dir, 'res4d')),
+                    _surface_rows(_filmgls_file(self.inputs.right_dir, 'res4d')))
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        for _, field, directory in STAT_MAPS:
+            outputs[field] = os.path.abspath(os.path.join(directory, 'merged_cifti.dscalar.nii'))
+        outputs['res4'] = os.path.abspath(os.path.join('res4', 'dense_cifti.dtseries.nii'))
+        return outputs
+
+
+# Streaming merge
+#
+# wb_command -cifti-merge reads every input before writing the output, which for
+# single trial designs means holding up to 99 maps per statistic. merge_cifti
+# instead writes the header of the merged file first and then copies the maps
+# in one at a time. The inputs have to share their brain models, which are
+# compared by the digests of the headers merge_cifti loads anyway.
+
+def brain_models_digest(brain_models):
+    # sha1 of everything that defines a BrainModelAxis
+    from glm.cache import hash_bytes
+
+    affine = brain_models.affine if brain_models.affine is not None else np.zeros(0)
+    return hash_bytes(np.asarray(brain_models.name).astype(str).tobytes(), brain_models.vertex.tobytes(),
+                      brain_models.voxel.tobytes(), np.asarray(affine, dtype=np.float64).tobytes(),
+                      repr(brain_models.volume_shape), repr(sorted(brain_models.nvertices.items())))
+
+
+def _merged_axis(axes):
+    # the row axis of the merged file: series are joined into one series starting
+    # where the first one does, scalar maps keep their names
+    from nibabel.cifti2.cifti2_axes import SeriesAxis, ScalarAxis
+
+    if all(isinstance(axis, SeriesAxis) for axis in axes):
+        return SeriesAxis(axes[0].start, axes[0].step, sum(axis.size for axis in axes), unit=axes[0].unit)
+    if all(isinstance(axis, ScalarAxis) for axis in axes):
+        merged = axes[0]
+        for axis in axes[1:]:
+            merged = merged + axis
+        return merged
+    raise ValueError('can only merge series or scalar maps, got %s' % ', '.join(type(a).__name__ for a in axes))
+
+
+def merge_cifti(filename, in_files):
+    '''
+    writes the maps of in_files, in order, to filename, holding one map in memory
+    at a time, and returns filename. The inputs must have the same brain models.
+    '''
+    import nibabel as nib
+
+    images = [nib.load(f, mmap=True) for f in in_files]
+    brain_models = images[0].header.get_axis(1)
+    digest = brain_models_digest(brain_models)
+    for in_file, img in zip(in_files[1:], images[1:]):
+        if brain_models_digest(img.header.get_axis(1)) != digest:
+            raise ValueError('brain models of %s differ from %s' % (in_file, in_files[0]))
+
+    row_axis = _merged_axis([img.header.get_axis(0) for img in images])
+
+    template = nib.Cifti2Image(np.broadcast_to(np.float32(0), (len(row_axis), len(brain_models))),
+                               header=(row_axis, brain_models), nifti_header=images[0].nifti_header)
+    out = open_cifti_output(filename, template)
+
+    column = 0
+    for img in images:
+        for row in range(img.shape[0]):
+            out[:, column] = img.dataobj[row:row + 1][0]
+            column += 1
+    out.flush()
+    del out
+
+    return filename
+
+
+class CiftiMergeInputSpec(BaseInterfaceInputSpec):
+    cifti = traits.List(File(exists=True), mandatory=True, desc='CIFTI files to merge, in order')
+    out_file = File(desc='the output CIFTI. Defaults to merged_cifti.dscalar.nii')
+
+class CiftiMergeOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc='the merged CIFTI')
+
+# native replacement for nipype_ext.workbench.CiftiMerge (see merge_cifti), with
+# the same default output name
+class CiftiMerge(BaseInterface):
+    input_spec = CiftiMergeInputSpec
+    output_spec = CiftiMergeOutputSpec
+
+    def _run_interface(self, runtime):
+        merge_cifti(self._list_outputs()['out_file'], self.inputs.cifti)
+        return runtime
+
+    def _list_outputs(self):
+        from nipype.interfaces.base import isdefined
+
+        outputs = self.output_spec().get()
+        if isdefined(self.inputs.out_file):
+            outputs['out_file'] = os.path.abspath(self.inputs.out_file)
+        else:
+            outputs['out_file'] = os.path.abspath('merged_cifti.dscalar.nii')
+        return outputs
+
+
+# Expressions
+#
+# wb_command -cifti-math evaluates an expression over every element of its
+# input files. parse_expression compiles the same syntax (operators, precedence,
+# functions and the E and PI constants of -cifti-math) into numpy operations,
+# so CiftiMath evaluates it on blocks of grayordinates read through memory maps,
+# a few at a time and across threads. As in wb_command, -select <dim> <index>
+# picks one index of a dimension of a variable (dimension 1 is along rows, i.e.
+# the maps, 2 the grayordinates, both 1-based) and -repeat broadcasts it.
+
+def _round(x):
+    # C round, half away from zero
+    return np.sign(x) * np.floor(np.abs(x) + 0.5)
+
+def _mod(x, y):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(y == 0, 0., x - y * np.floor(x / y))
+
+def _clamp(x, low, high):
+    return np.minimum(np.maximum(x, low), high)
+
+# name: (number of arguments, function)
+MATH_FUNCTIONS = {
+    'sin': (1, np.sin), 'cos': (1, np.cos), 'tan': (1, np.tan),
+    'asin': (1, np.arcsin), 'acos': (1, np.arccos), 'atan': (1, np.arctan), 'atan2': (2, np.arctan2),
+    'sinh': (1, np.sinh), 'cosh': (1, np.cosh), 'tanh': (1, np.tanh),
+    'asinh': (1, np.arcsinh), 'acosh': (1, np.arccosh), 'atanh': (1, np.arctanh),
+    'ln': (1, np.log), 'exp': (1, np.exp), 'log': (1, np.log10), 'log2': (1, np.log2),
+    'sqrt': (1, np.sqrt), 'abs': (1, np.abs), 'floor': (1, np.floor), 'round': (1, _round), 'ceil': (1, np.ceil),
+    'min': (2, np.minimum), 'max': (2, np.maximum), 'mod': (2, _mod), 'clamp': (3, _clamp),
+}
+
+MATH_CONSTANTS = {'E': np.e, 'PI': np.pi}
+
+def _truth(x):
+    return np.asarray(x, dtype=np.float64) != 0
+
+# binary operators by precedence level, loosest first
+_BINARY = [
+    {'||': lambda a, b: (_truth(a) | _truth(b)).astype(np.float64)},
+    {'&&': lambda a, b: (_truth(a) & _truth(b)).astype(np.float64)},
+    {'==': lambda a, b: np.equal(a, b).astype(np.float64), '!=': lambda a, b: np.not_equal(a, b).astype(np.float64)},
+    {'<': lambda a, b: np.less(a, b).astype(np.float64), '>': lambda a, b: np.greater(a, b).astype(np.float64),
+     '<=': lambda a, b: np.less_equal(a, b).astype(np.float64),
+     '>=': lambda a, b: np.greater_equal(a, b).astype(np.float64)},
+    {'+': np.add, '-': np.subtract},
+    {'*': np.multiply, '/': np.divide},
+]
+
+
+def parse_expression(expression):
+    '''
+    compiles a -cifti-math expression. Returns (evaluate, names): evaluate(env)
+    computes the expression from a dict of variable name to array, and names
+    are the variables it uses.
+    '''
+    import re
+
+    tokens = re.findall(r'\s*(\d+\.?\d*(?:[eE][+-]?\d+)?|\.\d+(?:[eE][+-]?\d+)?|[A-Za-z_]\w*'
+                        r'|\|\||&&|==|!=|<=|>=|[-+*/^!<>(),]|\S)', expression)
+    pos = [0]
+    names = set()
+
+    def peek():
+        return tokens[pos[0]] if pos[0] < len(tokens) else None
+
+    def take(expected=None):
+        token = peek()
+        if token is None or (expected is not None and token != expected):
+            raise ValueError('expected %s at token %d of expression %r, got %s'
+                             % (expected or 'a term', pos[0] + 1, expression, token))
+        pos[0] += 1
+        return token
+
+    def binary(level):
+        if level == len(_BINARY):
+            return unary()
+        node = binary(level + 1)
+        while peek() in _BINARY[level]:
+            op, left, right = _BINARY[level][take()], node, binary(level + 1)
+            node = lambda env, op=op, left=left, right=right: op(left(env), right(env))
+        return node
+
+    def unary():
+        if peek() == '-':
+            take()
+            operand = unary()
+            return lambda env: np.negative(operand(env))
+        if peek() == '!':
+            take()
+            operand = unary()
+            return lambda env: (~_truth(operand(env))).astype(np.float64)
+        return power()
+
+    def power():
+        base = atom()
+        if peek() == '^':
+            take()
+            exponent = unary()
+            return lambda env: np.power(base(env), exponent(env))
+        return base
+
+    def atom():
+        token = take()
+        if token == '(':
+            node = binary(0)
+            take(')')
+            return node
+        if re.match(r'^(\d|\.\d)', token):
+            value = float(token)
+            return lambda env: value
+        if re.match(r'^[A-Za-z_]', token):
+            if peek() == '(':
+                if token not in MATH_FUNCTIONS:
+                    raise ValueError('unknown function %s in expression %r' % (token, expression))
+                n_args, function = MATH_FUNCTIONS[token]
+                take('(')
+                args = [binary(0)]
+                while peek() == ',':
+                    take()
+                    args.append(binary(0))
+                take(')')
+                if len(args) != n_args:
+                    raise ValueError('%s takes %d arguments, got %d in expression %r'
+                                     % (token, n_args, len(args), expression))
+                return lambda env: function(*[arg(env) for arg in args])
+            if token in MATH_CONSTANTS:
+                value = MATH_CONSTANTS[token]
+                return lambda env: value
+            names.add(token)
+            return lambda env: env[token]
+        raise ValueError('unexpected %s in expression %r' % (token, expression))
+
+    evaluate = binary(0)
+    if peek() is not None:
+        raise ValueError('unexpected %s at the end of expression %r' % (peek(), expression))
+
+    return evaluate, names
+
+
+def parse_var(value):
+    '''
+    splits a -var value ('file [-select dim index [-repeat]]...') into the file
+    and a list of (dim, index, repeat), with 1-based dim and index like wb_command
+    '''
+    words = value.split()
+    filename, selects, i = words[0], [], 1
+    while i < len(words):
+        if words[i] != '-select' or i + 2 >= len(words):
+            raise ValueError('can not parse -var %r' % value)
+        dim, index = int(words[i + 1]), int(words[i + 2])
+        repeat = i + 3 < len(words) and words[i + 3] == '-repeat'
+        selects.append((dim, index, repeat))
+        i += 4 if repeat else 3
+    return filename, selects
+
+
+def _over_chunks(apply_chunk, n_rows, chunk_size, n_threads):
+    # calls apply_chunk(start) for row chunks of chunk_size, across n_threads threads
+    from concurrent.futures import ThreadPoolExecutor
+
+    starts = range(0, n_rows, chunk_size)
+    if n_threads > 1:
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            list(pool.map(apply_chunk, starts))
+    else:
+        for start in starts:
+            apply_chunk(start)
+
+
+def cifti_math(filename, expression, in_vars, fix_nan=None, header_only=False,
+               chunk_size=4096, n_threads=1):
+    '''
+    evaluates expression over the variables in_vars ([(name, -var value)]) and
+    writes the result to filename with the header of the first variable (after
+    -select). With header_only the data is left zero and no input data is read,
+    which is enough for files only used as templates.
+    '''
+    import nibabel as nib
+
+    evaluate, names = parse_expression(expression)
+    variables = dict(in_vars)
+    for name in names:
+        if name not in variables:
+            raise ValueError('expression %r uses %s, which is not a variable' % (expression, name))
+    for name in variables:
+        if name in MATH_FUNCTIONS or name in MATH_CONSTANTS:
+            raise ValueError('variable %s has the name of a function or constant' % name)
+
+    # each variable as a memory mapped maps x grayordinates view, with its size
+    # and axis along each dimension (size None where it is repeated)
+    views, sizes, var_axes = {}, {}, {}
+    digests = set()
+    nifti_header = None
+    for name, value in in_vars:
+        in_file, selects = parse_var(value)
+        img = nib.load(in_file, mmap=True)
+        if nifti_header is None:
+            nifti_header = img.nifti_header
+        data = np.asanyarray(img.dataobj) if not header_only else np.broadcast_to(np.float32(0), img.shape)
+        brain_models = img.header.get_axis(1)
+        var_axes[name] = [img.header.get_axis(0), brain_models]
+        size = list(img.shape)
+        for dim, index, repeat in selects:
+            if dim not in (1, 2) or not 1 <= index <= img.shape[dim - 1]:
+                raise ValueError('can not select %d %d of %s' % (dim, index, in_file))
+            selection = [slice(None), slice(None)]
+            selection[dim - 1] = slice(index - 1, index)
+            data = data[tuple(selection)]
+            var_axes[name][dim - 1] = var_axes[name][dim - 1][index - 1:index]
+            size[dim - 1] = None if repeat else 1
+        views[name], sizes[name] = data, size
+        if size[1] is not None:
+            digests.add(brain_models_digest(brain_models))
+
+    # the output takes each axis from the first variable that isn't repeated along it
+    shape, axes = [], []
+    for dim in range(2):
+        given = [name for name, _ in in_vars if sizes[name][dim] is not None] or [in_vars[0][0]]
+        if len(set(sizes[name][dim] for name in given)) > 1:
+            raise ValueError('variables of %r differ in size along dimension %d' % (expression, dim + 1))
+        axes.append(var_axes[given[0]][dim])
+        shape.append(len(axes[-1]))
+    if len(digests) > 1:
+        raise ValueError('variables of %r have different brain models' % expression)
+
+    template = nib.Cifti2Image(np.broadcast_to(np.float32(0), shape), header=axes, nifti_header=nifti_header)
+    out = open_cifti_output(filename, template)
+
+    if not header_only:
+        def evaluate_chunk(start):
+            env = {name: np.asarray(view[:, start:start + chunk_size] if view.shape[1] > 1 else view,
+                                    dtype=np.float64)
+                   for name, view in views.items()}
+            with np.errstate(all='ignore'):
+                result = np.broadcast_to(evaluate(env), (shape[0], min(chunk_size, shape[1] - start)))
+            if fix_nan is not None:
+                result = np.where(np.isnan(result), fix_nan, result)
+            out[start:start + chunk_size] = result.T
+
+        _over_chunks(evaluate_chunk, shape[1], chunk_size, n_threads)
+
+    out.flush()
+    del out
+
+    return filename
+
+
+class CiftiMathInputSpec(BaseInterfaceInputSpec):
+    expression = traits.Str(mandatory=True, desc='a mathematical expression to evaluate, as for wb_command -cifti-math')
+    in_vars = traits.List(traits.Tuple(traits.Str(), traits.Str()), mandatory=True,
+        desc='(name, value) of each variable, where value is a CIFTI file optionally followed by '
+             '-select <dim> <index> [-repeat] like the -var option of wb_command -cifti-math')
+    out_file = File(desc='the output CIFTI. Defaults to cifti_math_results.dscalar.nii')
+    fix_nan = traits.Float(desc='value to replace NaN results with')
+    header_only = traits.Bool(False, usedefault=True,
+        desc='write the header of the result without evaluating the expression. For outputs only used as templates')
+    chunk_size = traits.Int(4096, usedefault=True, desc='number of grayordinates evaluated at a time')
+    num_threads = traits.Int(1, usedefault=True, desc='number of threads evaluating chunks')
+
+class CiftiMathOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc='the output CIFTI')
+
+# native replacement for nipype_ext.workbench.CiftiMath (see cifti_math), with
+# the same default output name
+class CiftiMath(BaseInterface):
+    input_spec = CiftiMathInputSpec
+    output_spec = CiftiMathOutputSpec
+
+    def _run_interface(self, runtime):
+        from nipype.interfaces.base import isdefined
+
+        cifti_math(self._list_outputs()['out_file'], self.inputs.expression, self.inputs.in_vars,
+                   fix_nan=self.inputs.fix_nan if isdefined(self.inputs.fix_nan) else None,
+                   header_only=self.inputs.header_only,
+                   chunk_size=self.inputs.chunk_size, n_threads=self.inputs.num_threads)
+        return runtime
+
+    def _list_outputs(self):
+        from nipype.interfaces.base import isdefined
+
+        outputs = self.output_spec().get()
+        if isdefined(self.inputs.out_file):
+            outputs['out_file'] = os.path.abspath(self.inputs.out_file)
+        else:
+            outputs['out_file'] = os.path.abspath('cifti_math_results.dscalar.nii')
+        return outputs
+
+
+# Reductions
+#
+# wb_command -cifti-reduce reduces every row (ROW, over the maps of each
+# grayordinate) or column (COLUMN, over the grayordinates of each map) of a file
+# to one value. reduce_rows does each of its operations on a block of rows at
+# once, so cifti_reduce can stream a dtseries through a thread pool in chunks
+# and compute any number of operations from one read of each chunk. Index
+# operations are 1-based like wb_command's.
+
+REDUCE_OPERATIONS = ('MAX', 'MIN', 'INDEXMAX', 'INDEXMIN', 'SUM', 'PRODUCT', 'MEAN', 'STDEV', 'SAMPSTDEV',
+                     'VARIANCE', 'TSNR', 'COV', 'L2NORM', 'MEDIAN', 'MODE', 'COUNT_NONZERO')
+
+
+def _mode(block):
+    # most frequent value of each row (the smallest of equally frequent ones),
+    # ignoring NaNs
+    values = np.sort(block, axis=1)
+    n_rows, n = values.shape
+    position = np.arange(n)
+    starts = np.ones(values.shape, dtype=bool)
+    starts[:, 1:] = values[:, 1:] != values[:, :-1]
+    # length of the run of equal values up to each element
+    counts = position - np.maximum.accumulate(np.where(starts, position, 0), axis=1) + 1
+    counts[np.isnan(values)] = 0
+    return values[np.arange(n_rows), np.argmax(counts, axis=1)]
+
+
+def reduce_rows(block, operation, excluded=False):
+    '''
+    block - rows x n float64 array
+    operation - one of REDUCE_OPERATIONS
+    excluded - whether block has NaNs in place of excluded values, which are
+               then skipped
+
+    returns the reduction of every row
+    '''
+    if excluded:
+        mean, std, var, median = np.nanmean, np.nanstd, np.nanvar, np.nanmedian
+        total, product = np.nansum, np.nanprod
+        valid = ~np.isnan(block)
+    else:
+        mean, std, var, median = np.mean, np.std, np.var, np.median
+        total, product = np.sum, np.prod
+        valid = True
+
+    if operation == 'MAX':
+        return (np.nanmax if excluded else np.max)(block, axis=1)
+    if operation == 'MIN':
+        return (np.nanmin if excluded else np.min)(block, axis=1)
+    if operation == 'INDEXMAX':
+        return np.argmax(np.where(valid, block, -np.inf), axis=1) + 1.
+    if operation == 'INDEXMIN':
+        return np.argmin(np.where(valid, block, np.inf), axis=1) + 1.
+    if operation == 'SUM':
+        return total(block, axis=1)
+    if operation == 'PRODUCT':
+        return product(block, axis=1)
+    if operation == 'MEAN':
+        return mean(block, axis=1)
+    if operation == 'STDEV':
+        return std(block, axis=1)
+    if operation == 'SAMPSTDEV':
+        return std(block, axis=1, ddof=1)
+    if operation == 'VARIANCE':
+        return var(block, axis=1)
+    if operation == 'TSNR':
+        return mean(block, axis=1) / std(block, axis=1, ddof=1)
+    if operation == 'COV':
+        return std(block, axis=1, ddof=1) / mean(block, axis=1)
+    if operation == 'L2NORM':
+        return np.sqrt(total(block * block, axis=1))
+    if operation == 'MEDIAN':
+        return median(block, axis=1)
+    if operation == 'MODE':
+        return _mode(block)
+    if operation == 'COUNT_NONZERO':
+        return np.sum((block != 0) & valid, axis=1).astype(np.float64)
+    raise ValueError('unknown reduction %s, must be one of %s' % (operation, ', '.join(REDUCE_OPERATIONS)))
+
+
+def exclude_values(block, exclude=None):
+    '''
+    replaces values of a rows x n block that wb_command -cifti-reduce would
+    exclude with NaN: non-numeric values and, with exclude = (sigma_below,
+    sigma_above), values more than that many standard deviations from their
+    row's mean
+    '''
+    block = np.where(np.isfinite(block), block, np.nan)
+    if exclude is not None:
+        below, above = exclude
+        mean = np.nanmean(block, axis=1, keepdims=True)
+        std = np.nanstd(block, axis=1, keepdims=True)
+        block[(block < mean - below * std) | (block > mean + above * std)] = np.nan
+    return block
+
+
+def cifti_reduce(filename, in_file, operations, direction='ROW', exclude=None, only_numeric=False,
+                 chunk_size=4096, n_threads=1):
+    '''
+    reduces in_file along direction (ROW reduces the maps of each grayordinate,
+    COLUMN the grayordinates of each map) with each of operations, in one pass
+    over the data, and writes the results to filename as one scalar map per
+    operation, named after it. With only_numeric or exclude the values
+    exclude_values drops are skipped.
+    '''
+    import nibabel as nib
+    from nibabel.cifti2.cifti2_axes import ScalarAxis
+
+    for operation in operations:
+        if operation not in REDUCE_OPERATIONS:
+            raise ValueError('unknown reduction %s, must be one of %s' % (operation, ', '.join(REDUCE_OPERATIONS)))
+    if direction not in ('ROW', 'COLUMN'):
+        raise ValueError('direction must be ROW or COLUMN, got %s' % direction)
+
+    img = nib.load(in_file, mmap=True)
+    data = np.asanyarray(img.dataobj)
+    excluded = exclude is not None or only_numeric
+    scalars = ScalarAxis(list(operations))
+
+    if direction == 'ROW':
+        axes, n_rows = (scalars, img.header.get_axis(1)), data.shape[1]
+        rows = lambda start: data[:, start:start + chunk_size].T
+    else:
+        axes, n_rows = (img.header.get_axis(0), scalars), data.shape[0]
+        rows = lambda start: data[start:start + chunk_size]
+
+    template = nib.Cifti2Image(np.broadcast_to(np.float32(0), (len(axes[0]), len(axes[1]))), header=axes,
+                               nifti_header=img.nifti_header)
+    template.nifti_header.set_intent('ConnDenseScalar' if direction == 'ROW' else 'ConnUnknown')
+    # operations x maps for COLUMN
+    out = open_cifti_output(filename, template)
+
+    def reduce_chunk(start):
+        block = np.asarray(rows(start), dtype=np.float64)
+        if excluded:
+            block = exclude_values(block, exclude)
+        with np.errstate(all='ignore'):
+            reduced = [reduce_rows(block, operation, excluded) for operation in operations]
+        if direction == 'ROW':
+            out[start:start + chunk_size] = np.column_stack(reduced)
+        else:
+            out[:, start:start + chunk_size] = np.vstack(reduced)
+
+    _over_chunks(reduce_chunk, n_rows, chunk_size, n_threads)
+    out.flush()
+    del out
+
+    return filename
+
+
+class CiftiReduceInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc='the CIFTI file to reduce')
+    operation = traits.Enum(*REDUCE_OPERATIONS, xor=['operations'], desc='the reduction operator to use')
+    operations = traits.List(traits.Enum(*REDUCE_OPERATIONS), xor=['operation'],
+        desc='several reductions computed in one pass, e.g. [MEAN, STDEV, TSNR]. One output map each')
+    out_file = File(desc='the output CIFTI. Defaults to reduced_cifti.dscalar.nii')
+    direction = traits.Enum('COLUMN', 'ROW', usedefault=True,
+        desc='ROW reduces the maps of each grayordinate, COLUMN the grayordinates of each map')
+    exclude = traits.List(traits.Tuple(traits.Float(), traits.Float()), maxlen=1,
+        desc='exclude non-numeric values and outliers by standard deviation. Specify sigma below and sigma above')
+    numeric = traits.Bool(False, usedefault=True, desc='exclude non-numeric values')
+    chunk_size = traits.Int(4096, usedefault=True, desc='number of rows reduced at a time')
+    num_threads = traits.Int(1, usedefault=True, desc='number of threads reducing chunks')
+
+class CiftiReduceOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc='the output CIFTI')
+
+# native replacement for nipype_ext.workbench.CiftiReduce (see cifti_reduce), with
+# the same inputs, defaults and default output name, plus several operations at once
+class CiftiReduce(BaseInterface):
+    input_spec = CiftiReduceInputSpec
+    output_spec = CiftiReduceOutputSpec
+
+    def _run_interface(self, runtime):
+        from nipype.interfaces.base import isdefined
+
+        if isdefined(self.inputs.operations):
+            operations = self.inputs.operations
+        elif isdefined(self.inputs.operation):
+            operations = [self.inputs.operation]
+        else:
+            raise ValueError('CiftiReduce needs operation or operations')
+
+        cifti_reduce(self._list_outputs()['out_file'], self.inputs.in_file, operations,
+                     direction=self.inputs.direction,
+                     exclude=self.inputs.exclude[0] if isdefined(self.inputs.exclude) and self.inputs.exclude else None,
+                     only_numeric=self.inputs.numeric,
+                     chunk_size=self.inputs.chunk_size, n_threads=self.inputs.num_threads)
+        return runtime
+
+    def _list_outputs(self):
+        from nipype.interfaces.base import isdefined
+
+        outputs = self.output_spec().get()
+        if isdefined(self.inputs.out_file):
+            outputs['out_file'] = os.path.abspath(self.inputs.out_file)
+        else:
+            outputs['out_file'] = os.path.abspath('reduced_cifti.dscalar.nii')
+        return outputs
+
+
+# Nearest vertex dilation
+#
+# wb_command -metric-dilate -nearest gives every bad vertex (one whose value is
+# zero) the value of the nearest good vertex within the dilation distance,
+# measured along the surface. Which vertex that is only depends on the surface,
+# the set of good vertices and the distance, and for the cortex metrics of a
+# dtseries the good vertices are the same for every timepoint and every run:
+# the atlas ROI. nearest_vertex_map finds them with one multi-source dijkstra
+# over surface_graph (the geodesic approximation of CiftiSmooth) and
+# MetricDilate keeps the map in the 'dilate' namespace of glm.cache, so dilating
+# is a gather over all columns with the same good vertices.
+
+def nearest_vertex_map(coords, triangles, good, distance):
+    '''
+    good - boolean mask of the vertices with data
+    distance - dilation distance in mm
+
+    returns for every vertex the good vertex it takes its value from: itself if
+    it is good, the nearest good vertex within distance otherwise, or -1 if
+    there is none
+    '''
+    from scipy.sparse.csgraph import dijkstra
+
+    source = np.full(len(good), -1, dtype=np.int64)
+    if not good.any():
+        return source
+
+    graph = surface_graph(coords, triangles)
+    dist, _, nearest = dijkstra(graph, directed=False, indices=np.flatnonzero(good), limit=distance,
+                                min_only=True, return_predecessors=True)
+    reached = np.isfinite(dist)
+    source[reached] = nearest[reached]
+    return source
+
+
+# nearest vertex maps built or loaded by this process, by cache key
+_vertex_maps = {}
+
+def cached_vertex_map(surface, good, distance, use_cache=True, cache_dir=None):
+    '''
+    nearest_vertex_map of the surface file, keyed by its contents, the good
+    vertices and the distance
+    '''
+    import nibabel as nib
+    from glm.cache import DiskCache, hash_bytes, hash_file
+
+    def build():
+        surf = nib.load(surface)
+        return nearest_vertex_map(surf.agg_data('pointset'), surf.agg_data('triangle'), good, distance)
+
+    if not use_cache:
+        return build()
+
+    key = hash_bytes(hash_file(surface), np.packbits(good).tobytes(), repr(len(good)), repr(float(distance)))
+    if key in _vertex_maps:
+        return _vertex_maps[key]
+
+    cache = DiskCache('dilate', cache_dir=cache_dir)
+    cached = cache.get(key, '.npy')
+    if cached is not None:
+        source = np.load(cached, allow_pickle=False)
+    else:
+        import tempfile
+
+        source = build()
+        fd, tmp = tempfile.mkstemp(dir=cache.cache_dir, prefix='.tmp_', suffix='.npy')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, source)
+        cache.put(key, tmp, '.npy', move=True)
+
+    _vertex_maps[key] = source
+    return source
+
+
+def dilate_nearest(values, surface, distance, use_cache=True, cache_dir=None):
+    '''
+    values - vertices x n metric data, where zeros are bad vertices
+    returns the dilated values. Columns are grouped by their bad vertices, and
+    each group is dilated with one gather.
+    '''
+    out = np.array(values, dtype=np.float32)
+    good = values != 0
+
+    groups = {}
+    for column in range(values.shape[1]):
+        groups.setdefault(np.packbits(good[:, column]).tobytes(), []).append(column)
+
+    for columns in groups.values():
+        mask = good[:, columns[0]]
+        source = cached_vertex_map(surface, mask, distance, use_cache=use_cache, cache_dir=cache_dir)
+        fill = np.flatnonzero(~mask & (source >= 0))
+        out[np.ix_(fill, columns)] = values[np.ix_(source[fill], columns)]
+
+    return out
+
+
+class MetricDilateInputSpec(BaseInterfaceInputSpec):
+    metric = File(exists=True, mandatory=True, desc='the metric to dilate')
+    surface = File(exists=True, mandatory=True, desc='the surface to compute on')
+    distance = traits.Float(mandatory=True, desc='distance in mm to dilate')
+    out_file = File(desc='the output metric. Defaults to dilated_metric.func.gii')
+    nearest = traits.Bool(False, usedefault=True, desc='use the nearest good value instead of a weighted average')
+    use_cache = traits.Bool(True, usedefault=True,
+        desc='reuse nearest vertex maps built earlier for the same surface, good vertices and distance')
+    cache_dir = Directory(desc='root of the cache. Defaults to glm.cache.DEFAULT_CACHE_DIR')
+
+class MetricDilateOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc='the output metric file')
+
+# native, cached replacement for nipype_ext.workbench.MetricDilate with -nearest
+# (see dilate_nearest), with the same default output name. The output keeps the
+# metadata of the input metric. Weighted dilation still runs wb_command.
+class MetricDilate(BaseInterface):
+    input_spec = MetricDilateInputSpec
+    output_spec = MetricDilateOutputSpec
+
+    def _run_interface(self, runtime):
+        import nibabel as nib
+        from nipype.interfaces.base import isdefined
+
+        out_file = self._list_outputs()['out_file']
+
+        if not self.inputs.nearest:
+            from nipype_ext.workbench import MetricDilate as WBMetricDilate
+
+            WBMetricDilate(metric=self.inputs.metric, surface=self.inputs.surface,
+                           distance=self.inputs.distance, out_file=out_file).run()
+            return runtime
+
+        metric = nib.load(self.inputs.metric)
+        dilated = dilate_nearest(_surface_rows(self.inputs.metric), self.inputs.surface, self.inputs.distance,
+            use_cache=self.inputs.use_cache,
+            cache_dir=self.inputs.cache_dir if isdefined(self.inputs.cache_dir) else None)
+        metric.darrays = [nib.gifti.GiftiDataArray(np.ascontiguousarray(dilated[:, column]), intent=darray.intent,
+                                                   datatype='NIFTI_TYPE_FLOAT32', meta=darray.meta)
+                          for column, darray in enumerate(metric.darrays)]
+        nib.save(metric, out_file)
+
+        return runtime
+
+    def _list_outputs(self):
+        from nipype.interfaces.base import isdefined
+
+        outputs = self.output_spec().get()
+        if isdefined(self.inputs.out_file):
+            outputs['out_file'] = os.path.abspath(self.inputs.out_file)
+        else:
+            outputs['out_file'] = os.path.abspath('dilated_metric.func.gii')
+        return outputs
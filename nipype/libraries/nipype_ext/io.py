@@ -0,0 +1,160 @@
+import os
+import threading
+from contextlib import contextmanager
+
+from nipype.interfaces.base import File, isdefined, traits
+from nipype.interfaces.io import DataGrabber, DataGrabberInputSpec, DataSink, DataSinkInputSpec
+
+
+class _GlobModule:
+    # stands in for the glob module with glob replaced
+    def __init__(self, glob):
+        self.glob = glob
+
+    def __getattr__(self, name):
+        import glob
+        return getattr(glob, name)
+
+
+_glob_lock = threading.RLock()
+
+@contextmanager
+def _globbing(glob):
+    import nipype.interfaces.io as nio
+
+    with _glob_lock:
+        original = nio.glob
+        nio.glob = _GlobModule(glob)
+        try:
+            yield
+        finally:
+            nio.glob = original
+
+
+class IndexedDataGrabberInputSpec(DataGrabberInputSpec):
+    index_file = File(exists=True,
+        desc=('file index written by glm.fileindex.build_file_index. Templates under its root are '
+              'resolved from the index instead of globbing the filesystem'))
+
+# DataGrabber that resolves its templates from a glm.fileindex index. Without an
+# index_file, or for templates the index doesn't cover, it behaves exactly like
+# DataGrabber, so it can be swapped in for any existing datasource node.
+class IndexedDataGrabber(DataGrabber):
+    input_spec = IndexedDataGrabberInputSpec
+
+    def _glob(self, pattern):
+        from glm.fileindex import indexed_glob
+
+        index_file = self.inputs.index_file if isdefined(self.inputs.index_file) else None
+        return indexed_glob(pattern, index_file=index_file)
+
+    def _list_outputs(self):
+        # DataGrabber._list_outputs with the glob.glob calls it makes answered by
+        # self._glob. Only nipype.interfaces.io's reference to the glob module is
+        # swapped, and only for the duration of the call. Patterns the index
+        # doesn't cover fall through to glob.glob, so anything else in that
+        # module globbing meanwhile gets the same answer it would have.
+        with _globbing(self._glob):
+            return super(IndexedDataGrabber, self)._list_outputs()
+
+
+# Intermediate image format
+#
+# Every image a node writes to the working directory is read back by the next
+# node, and with NIFTI_GZ that means a gzip and a gunzip of a 4D run at every
+# step. set_intermediate_format switches the nodes of a pipeline to uncompressed
+# NIfTI, which the native interfaces also read through memory maps, and
+# CompressingDataSink compresses what ends up in the results directory, so the
+# results look the same whatever the scratch format.
+INTERMEDIATE_FORMATS = {'NIFTI_GZ': '.nii.gz', 'NIFTI': '.nii'}
+
+# CIFTI files are NIfTI-2 but never compressed
+CIFTI_EXTENSIONS = ('.dtseries.nii', '.dscalar.nii', '.dlabel.nii', '.ptseries.nii',
+                    '.pscalar.nii', '.plabel.nii', '.dconn.nii', '.pconn.nii')
+
+
+def set_intermediate_format(workflow, output_type):
+    '''
+    sets the output_type of every node in workflow (and its subworkflows) that has
+    one, i.e. the FSL interfaces and the nipype_ext interfaces writing images, and
+    makes it the default of FSL interfaces created afterwards. Nodes are configured
+    rather than relying on the FSL default, because the preproc nodes are created
+    when glm.preproc is imported.
+
+    output_type - a key of INTERMEDIATE_FORMATS
+    '''
+    import nipype.interfaces.fsl as fsl
+
+    if output_type not in INTERMEDIATE_FORMATS:
+        raise ValueError('intermediate format must be one of %s, got %s'
+                         % (', '.join(INTERMEDIATE_FORMATS), output_type))
+
+    fsl.FSLCommand.set_default_output_type(output_type)
+    for node in workflow._get_all_nodes():
+        if 'output_type' in node.inputs.copyable_trait_names():
+            node.inputs.output_type = output_type
+
+
+def gzip_file(src, dst, n_threads=1, level=6, block_size=1 << 24):
+    '''
+    gzip compresses src to dst. With n_threads > 1 blocks of block_size bytes are
+    compressed concurrently (zlib releases the GIL) and written as consecutive
+    gzip members, which gzip, zlib (and so FSL and Workbench) and nibabel read as
+    one stream.
+    '''
+    import gzip
+    from concurrent.futures import ThreadPoolExecutor
+
+    with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+        if n_threads <= 1:
+            with gzip.GzipFile(fileobj=fout, mode='wb', compresslevel=level, mtime=0) as gz:
+                for block in iter(lambda: fin.read(block_size), b''):
+                    gz.write(block)
+            return dst
+
+        compress = lambda block: gzip.compress(block, compresslevel=level, mtime=0)
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            # a few blocks per thread in flight at a time keeps memory bounded
+            while True:
+                blocks = [block for block in (fin.read(block_size) for _ in range(2 * n_threads)) if block]
+                if not blocks:
+                    break
+                for member in pool.map(compress, blocks):
+                    fout.write(member)
+
+    return dst
+
+
+def compress_nifti(path, n_threads=1):
+    # gzips path in place if it is an uncompressed NIfTI (or a directory holding
+    # some) and returns its new path
+    if os.path.isdir(path):
+        for root, _, files in os.walk(path):
+            for name in files:
+                compress_nifti(os.path.join(root, name), n_threads=n_threads)
+        return path
+
+    if not path.endswith('.nii') or path.endswith(CIFTI_EXTENSIONS) or not os.path.isfile(path):
+        return path
+
+    gzip_file(path, path + '.gz', n_threads=n_threads)
+    os.remove(path)
+    return path + '.gz'
+
+
+class CompressingDataSinkInputSpec(DataSinkInputSpec):
+    compress = traits.Bool(True, usedefault=True, desc='gzip uncompressed NIfTI files as they are stored')
+    num_threads = traits.Int(1, usedefault=True, desc='number of threads compressing each file')
+
+# DataSink that stores uncompressed NIfTI inputs as .nii.gz, so pipelines can
+# keep their scratch files uncompressed (see set_intermediate_format) and still
+# write the results they always did. Everything else is stored as is.
+class CompressingDataSink(DataSink):
+    input_spec = CompressingDataSinkInputSpec
+
+    def _list_outputs(self):
+        outputs = super(CompressingDataSink, self)._list_outputs()
+        if self.inputs.compress:
+            outputs['out_file'] = [compress_nifti(f, n_threads=self.inputs.num_threads)
+                                   for f in outputs['out_file']]
+        return outputs
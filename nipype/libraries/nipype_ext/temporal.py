@@ -0,0 +1,147 @@
+import os
+
+import numpy as np
+
+from nipype.interfaces.base import BaseInterface, BaseInterfaceInputSpec, traits, File, TraitedSpec
+from nipype.utils.filemanip import split_filename
+
+
+# Temporal highpass filter matching fslmaths -bptf hp_sigma -1
+#
+# fslmaths fits a Gaussian weighted line to the window around every timepoint
+# (weights exp(-dt^2/2sigma^2), truncated at int(3 sigma) and at the ends of the
+# run) and subtracts the fitted value at dt = 0:
+#   c(t) = (B*C - A*D) / (C*N - A*A)
+# with A = sum w dt, B = sum w x, C = sum w dt^2, D = sum w dt x and N = sum w.
+# A, C and N only depend on t, so c is linear in x and the whole filter is one
+# banded T x T matrix K shared by every voxel: out = x - K x. Applying K with a
+# matrix product gives the same double precision result as the per voxel loop in
+# FSL up to summation order, which is lost when the output is cast to float32.
+#
+# The preproc workflows add the temporal mean back after filtering (-Tmean and
+# -add), so highpass_filter adds it back as well.
+
+def bptf_operator(n_vols, hp_sigma):
+    '''
+    n_vols - number of timepoints
+    hp_sigma - highpass sigma in volumes, as passed to -bptf
+
+    returns the T x T matrix K for which K x is the running line fit fslmaths subtracts
+    '''
+    half = int(hp_sigma * 3)
+    dt = np.arange(-half, half + 1)
+    # fslmaths keeps the kernel in single precision
+    kernel = np.exp(-0.5 * (dt * dt) / (hp_sigma * hp_sigma)).astype(np.float32).astype(np.float64)
+
+    K = np.zeros((n_vols, n_vols))
+    for t in range(n_vols):
+        lo, hi = max(t - half, 0), min(t + half, n_vols - 1)
+        d = np.arange(lo, hi + 1) - t
+        w = kernel[d + half]
+
+        A, C, N = (w * d).sum(), (w * d * d).sum(), w.sum()
+        denom = C * N - A * A
+        if denom != 0:
+            K[t, lo:hi + 1] = (w * C - w * d * A) / denom
+
+    return K
+
+
+def highpass_filter(data, hp_sigma, out=None, chunk_size=4096, n_threads=1, scale=None):
+    '''
+    data - V x T array of timeseries (voxels or grayordinates by timepoints)
+    hp_sigma - highpass sigma in volumes
+    scale - optional factor the timeseries are multiplied by (in float32, like
+            fslmaths -mul) before filtering
+    out - V x T float32 array to write into, e.g. a memmap of the output file.
+          Defaults to a new array
+    chunk_size - number of timeseries filtered at a time
+    n_threads - chunks are filtered concurrently by this many threads
+
+    returns out, which holds the filtered timeseries with their mean added back
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    n_series, n_vols = data.shape
+    if out is None:
+        out = np.empty((n_series, n_vols), dtype=np.float32)
+
+    # x - K x = x (I - K)^T for timeseries in rows
+    operator = (np.eye(n_vols) - bptf_operator(n_vols, hp_sigma)).T
+
+    def filter_chunk(start):
+        x = np.asarray(data[start:start + chunk_size], dtype=np.float32)
+        if scale is not None:
+            x = x * np.float32(scale)
+        filtered = (x.astype(np.float64) @ operator).astype(np.float32)
+        filtered += x.mean(axis=1, dtype=np.float64).astype(np.float32)[:, None]
+        out[start:start + chunk_size] = filtered
+
+    starts = range(0, n_series, chunk_size)
+    if n_threads > 1:
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            list(pool.map(filter_chunk, starts))
+    else:
+        for start in starts:
+            filter_chunk(start)
+
+    return out
+
+
+def open_nifti_output(filename, template, shape):
+    # writes a float32 header for shape to filename and memory maps its data block
+    # as a V x T array, so filtered chunks go straight to disk
+    import nibabel as nib
+
+    header = nib.Nifti1Header.from_header(template.header)
+    header.extensions.clear()
+    header.set_data_shape(shape)
+    header.set_data_dtype(np.float32)
+    header.set_slope_inter(1, 0)
+    header.set_data_offset(352)
+
+    with open(filename, 'wb') as f:
+        header.write_to(f)
+        f.write(b'\0' * (header.get_data_offset() - f.tell()))
+        f.truncate(header.get_data_offset() + int(np.prod(shape)) * 4)
+
+    return np.memmap(filename, dtype=header.get_data_dtype(), mode='r+', offset=header.get_data_offset(),
+                     shape=(int(np.prod(shape[:-1])), shape[-1]), order='F')
+
+
+class TemporalHighpassInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc='4D NIfTI to filter along its last axis')
+    highpass_sigma = traits.Float(mandatory=True, desc='highpass sigma in volumes, as passed to fslmaths -bptf')
+    chunk_size = traits.Int(4096, usedefault=True, desc='number of voxels filtered at a time')
+    num_threads = traits.Int(1, usedefault=True, desc='number of threads filtering chunks')
+
+class TemporalHighpassOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc='filtered image with its temporal mean added back')
+
+# native replacement for meanfunc + highpass (fslmaths -bptf sigma -1 -add mean).
+# The output is written uncompressed through a memory map as it is filtered.
+class TemporalHighpass(BaseInterface):
+    input_spec = TemporalHighpassInputSpec
+    output_spec = TemporalHighpassOutputSpec
+
+    def _run_interface(self, runtime):
+        import nibabel as nib
+
+        img = nib.load(self.inputs.in_file, mmap=True)
+        shape = img.shape
+        # a memmap for uncompressed float32 inputs, read in full otherwise
+        data = np.asanyarray(img.dataobj).reshape((-1, shape[-1]), order='F')
+
+        out = open_nifti_output(self._list_outputs()['out_file'], img, shape)
+        highpass_filter(data, self.inputs.highpass_sigma, out=out,
+                        chunk_size=self.inputs.chunk_size, n_threads=self.inputs.num_threads)
+        out.flush()
+        del out
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        _, base, _ = split_filename(self.inputs.in_file)
+        outputs['out_file'] = os.path.abspath(base + '_hpf.nii')
+        return outputs
@@ -1,10 +1,73 @@
-from nipype.interfaces.base import BaseInterface, BaseInterfaceInputSpec, traits, File, TraitedSpec
+from nipype.interfaces.base import BaseInterface, BaseInterfaceInputSpec, traits, File, Directory, TraitedSpec
 from traits.api import List
 
+
+# Closed form VIFs for every column of a design matrix from a single SVD.
+#
+# statsmodels' variance_inflation_factor regresses each column on all the others
+# (without adding an intercept) and returns 1/(1 - R^2). For a regression without
+# an intercept R^2 is uncentered, so VIF_i = x_i'x_i / RSS_i, and RSS_i is the
+# reciprocal of the i-th diagonal element of inv(X'X). Scaling columns to unit
+# length turns X'X into a (uncentered) correlation matrix, so the VIFs are the
+# diagonal of its inverse. FEAT demeans every EV, in which case this is the usual
+# inverse correlation matrix (and newer statsmodels releases, which standardize
+# the columns first, give the same numbers). We get that diagonal from the SVD of
+# the scaled design (X = U S V', diag(inv(X'X)) = sum_k V_ik^2 / S_k^2) rather
+# than by inverting X'X, which squares the condition number.
+#
+# Columns that are a linear combination of the others get an infinite VIF, all
+# zero columns get NaN. If the design is rank deficient the remaining columns
+# fall back to one least squares fit each, since the diagonal of the
+# pseudoinverse is not their VIF.
+def batched_vif(design_matrix):
+    import numpy as np
+
+    X = np.asarray(design_matrix, dtype=np.float64)
+
+    norms = np.sqrt(np.sum(X**2, axis=0))
+    good = norms > 0
+
+    vifs = np.full(X.shape[1], np.nan)
+    if not np.any(good):
+        return vifs
+
+    Xn = X[:, good] / norms[good]
+    _, s, vt = np.linalg.svd(Xn, full_matrices=False)
+
+    # singular values at the level of rounding error are treated as exact collinearity
+    tol = s.max() * max(Xn.shape) * np.finfo(np.float64).eps
+    full_rank = s > tol
+    loadings = vt.T**2
+
+    if np.all(full_rank):
+        vifs[good] = loadings @ (1/s**2)
+        return vifs
+
+    # columns loading on the null space are collinear with the rest
+    collinear = np.any(loadings[:, ~full_rank] > np.sqrt(tol), axis=1)
+    these_vifs = np.full(Xn.shape[1], np.inf)
+    for i in np.where(~collinear)[0]:
+        others = np.delete(Xn, i, axis=1)
+        beta = np.linalg.lstsq(others, Xn[:, i], rcond=None)[0]
+        these_vifs[i] = 1/np.sum((Xn[:, i] - others @ beta)**2)
+
+    vifs[good] = these_vifs
+    return vifs
+
+
 # this VIF interface code was developed based on a draft from ChatGPT
 class VIFCalculationInputSpec(BaseInterfaceInputSpec):
     design_matrix = File(exists=True, desc='Path to design matrix file', mandatory=True)
     contrast_names = List(minlen=1, desc='row names of VIFs (e.g. contrast names)', mandatory=True)
+    method = traits.Enum('closed_form', 'statsmodels', usedefault=True,
+        desc=('closed_form computes all VIFs from one SVD of the design. statsmodels fits '
+              'one OLS regression per column and is kept as a reference implementation'))
+    use_cache = traits.Bool(True, usedefault=True,
+        desc=('reuse VIF tables computed earlier for a byte identical design matrix and '
+              'the same contrast names, e.g. by other subjects with the same EV timings'))
+    cache_dir = Directory(desc='root of the diagnostics cache. Defaults to glm.cache.DEFAULT_CACHE_DIR')
+    cache_size = traits.Int(100, usedefault=True,
+        desc='size cap of the VIF cache in MB. Least recently used tables are evicted first')
 
 class VIFCalculationOutputSpec(TraitedSpec):
     vif_file = File(exists=True, desc='Output file with VIF calculations')
@@ -15,26 +78,46 @@ class VIFCalculation(BaseInterface):
 
     def _run_interface(self, runtime):
         import os
+        import shutil
+        from nipype.interfaces.base import isdefined
 
-        vif_results = self.calculate_vif(self.inputs.design_matrix)
         self.vif_file_path = os.path.abspath('vifs.csv')
+
+        cache = None
+        if self.inputs.use_cache:
+            from glm.cache import DiskCache, hash_bytes, hash_file
+
+            cache = DiskCache('vifs',
+                              cache_dir=self.inputs.cache_dir if isdefined(self.inputs.cache_dir) else None,
+                              max_bytes=self.inputs.cache_size * 2**20)
+            key = hash_bytes(hash_file(self.inputs.design_matrix), self.inputs.method,
+                             *self.inputs.contrast_names)
+
+            cached = cache.get(key, '.csv')
+            if cached is not None:
+                shutil.copyfile(cached, self.vif_file_path)
+                return runtime
+
+        vif_results = self.calculate_vif(self.inputs.design_matrix)
         with open(self.vif_file_path, 'w') as file:
             for name,vif in zip(self.inputs.contrast_names, vif_results):
                 file.write(f"{name},{vif}\n")
+
+        if cache is not None:
+            cache.put(key, self.vif_file_path, '.csv')
+
         return runtime
 
     def calculate_vif(self, design_matrix_path):
-        import io
-        import pandas as pd
-        from statsmodels.stats.outliers_influence import variance_inflation_factor as get_vif
+        from glm.utils import read_fsl_matrix
 
-        with open(design_matrix_path, 'r') as file:
-            lines = file.readlines()[5:]
+        design_matrix, _ = read_fsl_matrix(design_matrix_path)
 
-        # Load the remaining lines as a pandas DataFrame
-        design_matrix = pd.read_csv(io.StringIO(''.join(lines)), sep='\s+', header=None)
+        if self.inputs.method == 'closed_form':
+            return batched_vif(design_matrix).tolist()
+
+        from statsmodels.stats.outliers_influence import variance_inflation_factor as get_vif
 
-        # Convert the DataFrame to a numpy array for plotting
         vifs = [get_vif(design_matrix,i) for i in range(0,design_matrix.shape[1])]
 
         return vifs
@@ -45,4 +128,3 @@ class VIFCalculation(BaseInterface):
         outputs = self.output_spec().get()
         outputs['vif_file'] = self.vif_file_path
         return outputs
-
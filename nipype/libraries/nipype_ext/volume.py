@@ -0,0 +1,374 @@
+import os
+
+import numpy as np
+
+from nipype.interfaces.base import BaseInterface, BaseInterfaceInputSpec, traits, File, Directory, TraitedSpec
+from nipype.utils.filemanip import split_filename
+
+from nipype_ext.io import INTERMEDIATE_FORMATS
+
+
+# FEAT style intensity normalization in one pass
+#
+# The preproc workflows used to normalize the volume with seven FSL calls
+#   img2float   fslmaths in -odt float
+#   getthresh   fslstats -p 2 -p 98
+#   threshold   fslmaths -thr 0.1*p98 -Tmin -bin -odt char
+#   medianval   fslstats -k mask -p 50
+#   dilatemask  fslmaths mask -dilF
+#   maskfunc    fslmaths func -mas dilated_mask
+#   volintnorm  fslmaths masked_func -mul 10000/median
+# each of which reads and writes a full gzipped 4D run. The functions below
+# reproduce the arithmetic of those calls on an array that is loaded once,
+# including the places where values pass through text (fslstats prints 6
+# significant digits and the op strings are formatted with %.14f) and float32.
+
+def fsl_percentiles(values, percentiles):
+    # fslstats -p: the value at rank int(n * p/100) of the sorted values, computed in float32
+    values = np.ravel(values)
+    n = values.size
+    ranks = [min(int(np.float32(n) * np.float32(p / 100.)), n - 1) for p in percentiles]
+    partitioned = np.partition(values, sorted(set(ranks)))
+    # fslstats prints with the default stream precision, which is what ImageStats parses
+    return [float('%.6g' % partitioned[rank]) for rank in ranks]
+
+
+def fsl_dilate(mask):
+    # fslmaths -dilF with the default 3x3x3 box kernel, i.e. a separable max filter
+    from scipy.ndimage import maximum_filter1d
+
+    dilated = mask
+    for axis in range(3):
+        dilated = maximum_filter1d(dilated, size=3, axis=axis, mode='nearest')
+    return dilated
+
+
+def intensity_normalize(data, global_signal=False):
+    '''
+    data - 4D float32 array. It is masked and scaled in place.
+    global_signal - also return the global intensity of the masked volume before
+                    it is scaled (see global_intensity)
+
+    returns (p2, p98), the binary Tmin mask, the dilated mask and the median, as
+    they come out of the FSL chain, followed by the global intensity if requested
+    '''
+    thresholds = fsl_percentiles(data, [2, 98])
+
+    # -thr keeps values >= thr, -Tmin -bin keeps voxels above it at every timepoint
+    thr = np.float32(float('%.14f' % (0.1 * thresholds[1])))
+    tmin = data.min(axis=3)
+    mask = (tmin >= thr) & (tmin > 0)
+
+    median = fsl_percentiles(data[mask], [50])[0]
+
+    dilated = fsl_dilate(mask)
+
+    data *= dilated[..., None]
+    if global_signal:
+        # what ArtifactDetect read back from the maskfunc output
+        signal = global_intensity(data, dilated)
+    data *= np.float32(float('%.14f' % (10000. / median)))
+
+    if global_signal:
+        return thresholds, mask, dilated, median, signal
+    return thresholds, mask, dilated, median
+
+
+# Spike detection matching rapidart.ArtifactDetect
+#
+# The preproc workflows ran ArtifactDetect on the masked volume and the dilated
+# mask with use_differences=[True, False], use_norm=True, norm_threshold=1,
+# zintensity_threshold=3 and parameter_source='FSL', after
+# _hcp2mcflirt_motion_parameters had rewritten Movement_Regressors.txt as MCFLIRT
+# parameters. A timepoint is an outlier if
+#   - the composite norm, the largest distance one of six points on a box around
+#     the brain moves since the previous timepoint, is above 1 mm, or
+#   - the z-score of the linearly detrended global intensity is above 3.
+# The functions below compute both from Movement_Regressors.txt and the array
+# intensity_normalize already holds, so neither the motion file nor the masked
+# volume has to be written and read back.
+
+def hcp_motion_params(motion_file):
+    # translations (mm) and rotations (radians) from an HCP Movement_Regressors.txt,
+    # which lists translations, rotations in degrees and then their derivatives
+    data = np.loadtxt(motion_file, ndmin=2)
+    return np.hstack([data[:, :3], np.pi / 180 * data[:, 3:6]])
+
+
+def rigid_affines(params):
+    # T x 4 x 4 transforms of (translation, rotation) rows, composed T Rx Ry Rz like
+    # rapidart's _get_affine_matrix
+    n = len(params)
+    c, s = np.cos(params[:, 3:6]), np.sin(params[:, 3:6])
+
+    T, Rx, Ry, Rz = (np.tile(np.eye(4), (n, 1, 1)) for _ in range(4))
+    T[:, :3, 3] = params[:, :3]
+    for R, axis, (i, j) in [(Rx, 0, (1, 2)), (Ry, 1, (0, 2)), (Rz, 2, (0, 1))]:
+        R[:, i, i], R[:, i, j] = c[:, axis], s[:, axis]
+        R[:, j, i], R[:, j, j] = -s[:, axis], c[:, axis]
+
+    return T @ (Rx @ (Ry @ Rz))
+
+
+def motion_norm(params):
+    # ArtifactDetect's composite norm with use_differences, 0 at the first timepoint
+    points = np.vstack([np.hstack([np.diag([70, 70, 75]), np.diag([-70, -110, -45])]),
+                        np.ones((1, 6))])
+    moved = (rigid_affines(params) @ points)[:, :3]
+    step = np.diff(moved, axis=0, prepend=moved[:1])
+    return np.sqrt((step ** 2).sum(axis=1)).max(axis=1)
+
+
+def global_intensity(data, mask):
+    # mean of each volume of a 4D float32 array within mask. Taken one volume at a
+    # time in float32 like ArtifactDetect, so the z-scores come out the same
+    return np.array([np.nanmean(data[..., t][mask]) for t in range(data.shape[3])], dtype=np.float64)
+
+
+def detect_outliers(params, signal, norm_threshold=1, zintensity_threshold=3):
+    '''
+    params - T x 6 translations and rotations, e.g. from hcp_motion_params
+    signal - global intensity at each timepoint
+
+    returns the outlier timepoints (0 based, sorted), the composite norm and the
+    intensity z-scores
+    '''
+    from scipy.signal import detrend
+
+    norm = motion_norm(params)
+
+    z = detrend(signal, axis=0)
+    z = (z - np.mean(z)) / np.std(z)
+
+    outliers = np.union1d(np.flatnonzero(np.abs(z) > zintensity_threshold),
+                          np.flatnonzero(norm > norm_threshold))
+    return outliers, norm, z
+
+
+class IntensityNormalizationInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc='4D functional volume')
+    save_normalized = traits.Bool(True, usedefault=True,
+        desc='write out_file. Turn off when only the median and masks are needed')
+    motion_file = File(exists=True,
+        desc='HCP Movement_Regressors.txt. If set, spikes are detected like ArtifactDetect')
+    norm_threshold = traits.Float(1, usedefault=True, desc='composite norm above which a timepoint is an outlier (mm)')
+    zintensity_threshold = traits.Float(3, usedefault=True,
+        desc='global intensity z-score above which a timepoint is an outlier')
+    output_type = traits.Enum(*INTERMEDIATE_FORMATS, usedefault=True, desc='format of the images written')
+
+class IntensityNormalizationOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc='masked volume scaled to a median of 10000 (volintnorm output)')
+    mask_file = File(exists=True, desc='brain mask as uint8 (threshold output)')
+    dilated_mask_file = File(exists=True, desc='dilated brain mask (dilatemask output)')
+    thresholds = traits.List(traits.Float, desc='2nd and 98th percentiles (getthreshold output)')
+    median = traits.Float(desc='median within the brain mask (medianval output)')
+    outlier_files = File(exists=True, desc='outlier timepoints, one per line (spikedetection output)')
+    intensity_files = File(exists=True, desc='global intensity at each timepoint')
+    norm_files = File(exists=True, desc='composite norm at each timepoint')
+
+# native replacement for img2float -> getthreshold -> threshold -> medianval ->
+# dilatemask -> maskfunc -> volintnorm, and with a motion_file for
+# hcp2mcflirt_motion_params -> spikedetection as well. Output files are named like
+# the FSL chain and ArtifactDetect name them so datasink substitutions keep working.
+class IntensityNormalization(BaseInterface):
+    input_spec = IntensityNormalizationInputSpec
+    output_spec = IntensityNormalizationOutputSpec
+
+    def _run_interface(self, runtime):
+        import nibabel as nib
+
+        img = nib.load(self.inputs.in_file)
+        # img2float. The run is decompressed into one float32 copy in memory,
+        # which everything below works on in place
+        data = np.array(img.dataobj, dtype=np.float32)
+
+        from nipype.interfaces.base import isdefined
+
+        detect = isdefined(self.inputs.motion_file)
+        result = intensity_normalize(data, global_signal=detect)
+        self._thresholds, mask, dilated, self._median = result[:4]
+
+        if detect:
+            outputs = self._list_outputs()
+            outliers, norm, _ = detect_outliers(hcp_motion_params(self.inputs.motion_file), result[4],
+                                                norm_threshold=self.inputs.norm_threshold,
+                                                zintensity_threshold=self.inputs.zintensity_threshold)
+            # formats of ArtifactDetect's outputs, which SpecifyModel parses
+            np.savetxt(outputs['outlier_files'], outliers, fmt='%d', delimiter=' ')
+            np.savetxt(outputs['intensity_files'], result[4], fmt='%.2f', delimiter=' ')
+            np.savetxt(outputs['norm_files'], norm, fmt='%.4f', delimiter=' ')
+
+        header = img.header.copy()
+        header.set_slope_inter(1, 0)
+
+        self._write(mask.astype(np.uint8), img.affine, header, 'mask_file')
+        self._write(dilated.astype(np.uint8), img.affine, header, 'dilated_mask_file')
+        if self.inputs.save_normalized:
+            self._write(data, img.affine, header, 'out_file')
+
+        return runtime
+
+    def _write(self, data, affine, header, name):
+        import nibabel as nib
+
+        out = nib.Nifti1Image(data, affine, header)
+        out.set_data_dtype(data.dtype)
+        nib.save(out, self._list_outputs()[name])
+
+    def _list_outputs(self):
+        from nipype.interfaces.base import isdefined
+
+        outputs = self.output_spec().get()
+        _, base, _ = split_filename(self.inputs.in_file)
+        ext = INTERMEDIATE_FORMATS[self.inputs.output_type]
+        if self.inputs.save_normalized:
+            outputs['out_file'] = os.path.abspath(base + '_dtype_mask_intnorm' + ext)
+        outputs['mask_file'] = os.path.abspath(base + '_dtype_thresh' + ext)
+        outputs['dilated_mask_file'] = os.path.abspath(base + '_dtype_thresh_dil' + ext)
+        if isdefined(self.inputs.motion_file):
+            # ArtifactDetect names them after the maskfunc output
+            outputs['outlier_files'] = os.path.abspath('art.%s_dtype_mask_outliers.txt' % base)
+            outputs['intensity_files'] = os.path.abspath('global_intensity.%s_dtype_mask.txt' % base)
+            outputs['norm_files'] = os.path.abspath('norm.%s_dtype_mask.txt' % base)
+        if hasattr(self, '_median'):
+            outputs['thresholds'] = self._thresholds
+            outputs['median'] = self._median
+        return outputs
+
+
+# CSF mask resampled to the functional grid
+#
+# binarize_csf, erode_csf and resample_csf only depend on the subject's
+# aparc+aseg and on the geometry of the functional grid, so every run of a
+# subject builds the same mask. CSFMask builds it in process and keeps it in the
+# 'csfmask' namespace of glm.cache, keyed by the segmentation file and the
+# reference header. Runs build it under the cache's lock, so the first run of a
+# subject computes it and the rest, concurrent or later, copy it.
+
+def fsl_vox2mm(header):
+    # FSL's scaled voxel coordinates: voxel size times index, with x flipped for
+    # images in neurological order (positive determinant)
+    shape, zooms = header.get_data_shape()[:3], header.get_zooms()[:3]
+    vox2mm = np.diag(list(zooms) + [1.])
+    if np.linalg.det(header.get_best_affine()[:3, :3]) > 0:
+        vox2mm[0, 0] = -zooms[0]
+        vox2mm[0, 3] = (shape[0] - 1) * zooms[0]
+    return vox2mm
+
+
+def fsl_box_erode(mask, zooms, size):
+    # fslmaths -kernel box size -ero: the box is size mm wide, rounded to an odd
+    # number of voxels along each axis, and voxels beyond the edge are ignored
+    from scipy.ndimage import minimum_filter1d
+
+    eroded = mask
+    for axis, zoom in enumerate(zooms):
+        width = int(np.floor(size / zoom + 0.5))
+        width += 1 - width % 2
+        eroded = minimum_filter1d(eroded, size=width, axis=axis, mode='nearest')
+    return eroded
+
+
+def resample_nearest(data, in_header, ref_header):
+    # applywarp --interp=nn without a warp or premat: identity in FSL coordinates,
+    # nearest voxel, zero outside the input's field of view
+    ref_shape = ref_header.get_data_shape()[:3]
+    ref2in = np.linalg.inv(fsl_vox2mm(in_header)) @ fsl_vox2mm(ref_header)
+
+    ijk = np.indices(ref_shape).reshape(3, -1)
+    coords = np.floor(ref2in[:3, :3] @ ijk + ref2in[:3, 3:] + 0.5).astype(int)
+
+    inside = np.all((coords >= 0) & (coords < np.array(data.shape[:3])[:, None]), axis=0)
+    out = np.zeros(ijk.shape[1], dtype=data.dtype)
+    out[inside] = data[tuple(coords[:, inside])]
+    return out.reshape(ref_shape)
+
+
+def csf_mask(seg_file, ref_file, labels=(4, 43), erode_size=3):
+    '''
+    binary mask of the segmentation labels in seg_file (lateral ventricles by
+    default), eroded by a box erode_size mm wide and resampled onto the grid of
+    ref_file. Returns it as a uint8 array with the affine and header of ref_file.
+    '''
+    import nibabel as nib
+
+    seg = nib.load(seg_file)
+    ref = nib.load(ref_file)
+
+    mask = np.isin(np.asanyarray(seg.dataobj), labels).astype(np.uint8)
+    mask = fsl_box_erode(mask, seg.header.get_zooms()[:3], erode_size)
+
+    return resample_nearest(mask, seg.header, ref.header), ref.affine, ref.header
+
+
+class CSFMaskInputSpec(BaseInterfaceInputSpec):
+    seg_file = File(exists=True, mandatory=True, desc='segmentation, e.g. aparc+aseg.nii.gz')
+    ref_file = File(exists=True, mandatory=True,
+        desc='image on the target grid. Only its header is read')
+    labels = traits.List(traits.Int, [4, 43], usedefault=True, desc='labels to include (lateral ventricles)')
+    erode_size = traits.Float(3, usedefault=True, desc='width of the erosion box in mm')
+    use_cache = traits.Bool(True, usedefault=True,
+        desc='reuse masks built earlier for the same segmentation and reference grid')
+    cache_dir = Directory(desc='root of the cache. Defaults to glm.cache.DEFAULT_CACHE_DIR')
+    output_type = traits.Enum(*INTERMEDIATE_FORMATS, usedefault=True, desc='format of the mask written')
+
+class CSFMaskOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc='CSF mask on the reference grid')
+
+# native, cached replacement for binarize_csf -> erode_csf -> resample_csf
+class CSFMask(BaseInterface):
+    input_spec = CSFMaskInputSpec
+    output_spec = CSFMaskOutputSpec
+
+    def _run_interface(self, runtime):
+        import shutil
+        import nibabel as nib
+        from nipype.interfaces.base import isdefined
+
+        out_file = self._list_outputs()['out_file']
+        ext = INTERMEDIATE_FORMATS[self.inputs.output_type]
+
+        if not self.inputs.use_cache:
+            self._build(out_file)
+            return runtime
+
+        from glm.cache import DiskCache, hash_bytes, hash_stat
+
+        cache = DiskCache('csfmask', cache_dir=self.inputs.cache_dir if isdefined(self.inputs.cache_dir) else None)
+        ref = nib.load(self.inputs.ref_file).header
+        # aparc+aseg comes from the read only archive, so its path, size and mtime identify it
+        key = hash_bytes(hash_stat(self.inputs.seg_file),
+                         repr(ref.get_data_shape()[:3]), repr(ref.get_zooms()[:3]),
+                         ref.get_best_affine().tobytes(),
+                         repr(sorted(self.inputs.labels)), repr(self.inputs.erode_size))
+
+        # the runs of a subject start together under MultiProc. The first one to
+        # take the lock builds the mask and the others wait for it
+        cached = cache.get(key, ext)
+        if cached is None:
+            with cache.lock(key):
+                cached = cache.get(key, ext)
+                if cached is None:
+                    self._build(out_file)
+                    cache.put(key, out_file, ext)
+                    return runtime
+
+        shutil.copyfile(cached, out_file)
+        return runtime
+
+    def _build(self, out_file):
+        import nibabel as nib
+
+        mask, affine, header = csf_mask(self.inputs.seg_file, self.inputs.ref_file,
+                                        labels=self.inputs.labels, erode_size=self.inputs.erode_size)
+
+        header = header.copy()
+        header.set_slope_inter(1, 0)
+        out = nib.Nifti1Image(mask, affine, header)
+        out.set_data_dtype(np.uint8)
+        nib.save(out, out_file)
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs['out_file'] = os.path.abspath('csf_mask' + INTERMEDIATE_FORMATS[self.inputs.output_type])
+        return outputs
@@ -2,6 +2,8 @@ from nipype.interfaces.workbench import base as wb
 from nipype.interfaces.base import BaseInterface, BaseInterfaceInputSpec, traits, File, Str, isdefined, TraitedSpec, CommandLineInputSpec
 from traits.api import List
 
+from nipype_ext.io import INTERMEDIATE_FORMATS
+
 # convert cifti to nifti and back
 # this interface was drafted by ChatGPT then heavily modified by BP.
 class CiftiConvertNiftiInputSpec(CommandLineInputSpec):
@@ -192,6 +194,9 @@ class CiftiSeparateInputSpec(CommandLineInputSpec):
         position=2,
         usedefault=True)
 
+    output_type=traits.Enum(*INTERMEDIATE_FORMATS, usedefault=True,
+        desc='format of the volume_all files')
+
     # this needs
     # note that this logic could be adapted for a -volume argument too (for more granular control than volume-all)
     metric=traits.List(traits.Str,
@@ -225,10 +230,11 @@ class CiftiSeparate(wb.WBCommand):
             cwd = os.getcwd()
             fname, _ = os.path.splitext(os.path.basename(self.inputs.in_file))
             fname, _ = os.path.splitext(fname)
+            ext = INTERMEDIATE_FORMATS[self.inputs.output_type]
             return '-volume-all {0} -roi {1} -label {2}'.format(
-                        os.path.join(cwd, fname + '_volume_all.nii.gz'),
-                        os.path.join(cwd, fname + '_volume_all_roi.nii.gz'),
-                        os.path.join(cwd, fname + '_volume_all_label.nii.gz'))
+                        os.path.join(cwd, fname + '_volume_all' + ext),
+                        os.path.join(cwd, fname + '_volume_all_roi' + ext),
+                        os.path.join(cwd, fname + '_volume_all_label' + ext))
         if name == 'metric':
             return ' '.join(self._format_metric_arg(v) for v in value)
         return super(CiftiSeparate, self)._format_arg(name, spec, value)
@@ -254,9 +260,10 @@ class CiftiSeparate(wb.WBCommand):
             fname, _ = os.path.splitext(os.path.basename(self.inputs.in_file))
             fname, _ = os.path.splitext(fname)
 
-            outputs['volume_all_out'] = os.path.join(cwd, fname + '_volume_all.nii.gz')
-            outputs['volume_all_roi_out'] = os.path.join(cwd, fname + '_volume_all_roi.nii.gz')
-            outputs['volume_all_label_out'] = os.path.join(cwd, fname + '_volume_all_label.nii.gz')
+            ext = INTERMEDIATE_FORMATS[self.inputs.output_type]
+            outputs['volume_all_out'] = os.path.join(cwd, fname + '_volume_all' + ext)
+            outputs['volume_all_roi_out'] = os.path.join(cwd, fname + '_volume_all_roi' + ext)
+            outputs['volume_all_label_out'] = os.path.join(cwd, fname + '_volume_all_label' + ext)
 
         if isdefined(self.inputs.metric):
             for structure in self.metric_files:
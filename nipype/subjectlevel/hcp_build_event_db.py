@@ -0,0 +1,46 @@
+# Builds the cohort event database used by glm.designs.lookup_events
+#
+# Walks HCP1200 once and stores the names, onsets and durations of every
+# subject x task x direction under the trial, block and hcp event models in a
+# SQLite file. Point the pipelines at it with --event_db (or HCP_EVENT_DB) and
+# subjectinfo nodes read their events from it instead of from dartfs. Rerunning
+# the builder only extracts runs that are missing or failed previously.
+
+import os
+import sys
+import argparse
+
+package_directory = '../libraries/'
+
+if package_directory not in sys.path:
+    sys.path.insert(0, package_directory)
+
+from glm.eventdb import EVENT_MODELS, build_event_db, find_subjects
+
+data_dir = os.path.abspath('/dartfs/rc/lab/D/DBIC/DBIC/archive/HCP/HCP1200/')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="HCP cohort event database builder")
+    parser.add_argument('--subject_ids', nargs='*', default=None,
+                        help="Subject IDs. Must match HCP directory names. Defaults to all subjects in HCP1200")
+    parser.add_argument('--tasks', nargs='*',
+                        default=['EMOTION', 'GAMBLING', 'SOCIAL', 'LANGUAGE', 'RELATIONAL', 'MOTOR', 'WM'],
+                        help='Must match HCP task labels which are all capitalized. See default for options.')
+    parser.add_argument('--directions', nargs='*', default=['LR','RL'],
+                        help='Phase encoding direction')
+    parser.add_argument('--models', nargs='*', default=list(EVENT_MODELS), choices=EVENT_MODELS,
+                        help='Event models to extract')
+    parser.add_argument('--db', type=str, required=True, help='SQLite database to create or update')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Re-extract runs that are already in the database')
+    parser.add_argument('--n_cpus', type=int, default=int(os.getenv('SLURM_CPUS_PER_TASK',default='1')),
+                        help='Number of CPUs available for computation')
+
+    args = parser.parse_args()
+
+    subject_ids = args.subject_ids or find_subjects(data_dir)
+
+    n_rows = build_event_db(args.db, subject_ids, args.tasks, args.directions, models=args.models,
+                            n_procs=args.n_cpus, overwrite=args.overwrite)
+
+    print('%d runs extracted into %s' % (n_rows, os.path.abspath(args.db)))
@@ -0,0 +1,36 @@
+# Builds the HCP1200 file index used by IndexedDataGrabber and glm.designs
+#
+# Lists every directory under <subject>/MNINonLinear (by default) once and stores
+# the listings in a SQLite file. Pass it to the pipelines with --file_index (or
+# HCP_FILE_INDEX) and datasource templates are resolved from it instead of
+# globbing dartfs for every iterable. Rebuild it when subjects are added.
+
+import os
+import sys
+import argparse
+
+package_directory = '../libraries/'
+
+if package_directory not in sys.path:
+    sys.path.insert(0, package_directory)
+
+from glm.fileindex import build_file_index
+
+data_dir = os.path.abspath('/dartfs/rc/lab/D/DBIC/DBIC/archive/HCP/HCP1200/')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="HCP1200 file index builder")
+    parser.add_argument('--subject_ids', nargs='*', default=None,
+                        help="Subject IDs. Must match HCP directory names. Defaults to all subjects in HCP1200")
+    parser.add_argument('--prefixes', nargs='*', default=['MNINonLinear'],
+                        help='Subdirectories of each subject directory to index')
+    parser.add_argument('--index', type=str, required=True, help='Index file to write')
+    parser.add_argument('--n_threads', type=int, default=16,
+                        help='Number of directories listed concurrently')
+
+    args = parser.parse_args()
+
+    n_dirs = build_file_index(args.index, data_dir, prefixes=args.prefixes,
+                              subject_ids=args.subject_ids, n_threads=args.n_threads)
+
+    print('%d directories indexed into %s' % (n_dirs, os.path.abspath(args.index)))
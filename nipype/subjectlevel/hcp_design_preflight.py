@@ -0,0 +1,52 @@
+# Design-only pre-flight for the hcp_* pipelines
+#
+# Builds the convolved task design of every subject x task x direction, computes
+# the VIFs and efficiencies of the contrasts of interest and writes a manifest
+# with one accept/reject row per run. No imaging data is read, so this takes
+# seconds per subject rather than a full preprocessing and FILMGLS pass. Pass the
+# manifest to the pipelines with --manifest and only accepted runs are scheduled.
+#
+# See glm/preflight.py for how the design is approximated.
+
+import os
+import sys
+import argparse
+from collections import Counter
+
+package_directory = '../libraries/'
+
+if package_directory not in sys.path:
+    sys.path.insert(0, package_directory)
+
+from glm.preflight import run_preflight
+
+TR = 0.72
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="HCP design pre-flight")
+    parser.add_argument('--subject_ids', nargs='*', help="Subject ID. Must match HCP directory name")
+    parser.add_argument('--tasks', nargs='*',
+                        default=['EMOTION', 'GAMBLING', 'SOCIAL', 'LANGUAGE', 'RELATIONAL', 'MOTOR', 'WM'],
+                        help='Must match HCP task labels which are all capitalized. See default for options.')
+    parser.add_argument('--directions', nargs='*', default=['LR','RL'],
+                        help='Phase encoding direction')
+    parser.add_argument('--events', choices=['trial', 'block', 'hcp'], default='trial',
+                        help=('Event model to screen. trial for hcp_single_trials_w_confounds, block for '
+                              'hcp_single_blocks_w_confounds_grayordinate, hcp for hcp_glm_grayord'))
+    parser.add_argument('--max_vif', type=float, default=10.,
+                        help='Reject runs where any contrast of interest has a larger VIF')
+    parser.add_argument('--min_efficiency', type=float, default=None,
+                        help='Reject runs where any contrast of interest has a smaller efficiency')
+    parser.add_argument('--manifest', type=str, required=True, help='Output manifest csv')
+    parser.add_argument('--n_cpus', type=int, default=int(os.getenv('SLURM_CPUS_PER_TASK',default='1')),
+                        help='Number of CPUs available for computation')
+
+    args = parser.parse_args()
+
+    rows = run_preflight(args.subject_ids, args.tasks, args.directions, args.manifest,
+                         n_procs=args.n_cpus, events=args.events, TR=TR,
+                         max_vif=args.max_vif, min_efficiency=args.min_efficiency)
+
+    counts = Counter(row['status'] for row in rows)
+    print('%d runs accepted, %d rejected. Manifest written to %s'
+          % (counts['accept'], counts['reject'], os.path.abspath(args.manifest)))
@@ -41,9 +41,9 @@ from builtins import range
 import os  # system functions
 import sys
 import argparse
+import itertools
 import numpy as np
 
-import nipype.interfaces.io as nio  # Data i/o
 import nipype.interfaces.fsl as fsl  # fsl
 import nipype.pipeline.engine as pe  # pypeline engine
 import nipype.interfaces.utility as util  # utility
@@ -60,12 +60,16 @@ if package_directory not in sys.path:
 
 import nipype_ext.workbench as wb
 import nipype_ext.vifs as vifs
+from nipype_ext.io import IndexedDataGrabber, CompressingDataSink, set_intermediate_format
+import nipype_ext.cifti as cifti
 
 #from glm.preproc import preproc_surf_motion_csf
-from glm.preproc import preproc_surf_hcp
+from glm.preproc import preproc_surf_hcp, preproc_surf_hcp_stages
+from glm.preprocstore import fill_preproc_store
 from glm.designs import select_trials
+from glm.preflight import accepted_runs, accepted_sessions, synchronized_iterables
 #from glm.utils import assemble_csf_motion_confounds_mat, merge_trial_vifs
-from glm.utils import merge_trial_vifs
+from glm.utils import merge_trial_vifs, store_cohort_vifs, compact_cohort_vifs
 
 fsl.FSLCommand.set_default_output_type('NIFTI_GZ')
 
@@ -74,6 +78,30 @@ data_dir = os.path.abspath('/dartfs/rc/lab/D/DBIC/DBIC/archive/HCP/HCP1200/')
 hpcutoff = 200
 TR = 0.72
 
+# normalize volume intensities in one in-process node instead of the FSL chain
+native_intnorm = False
+# highpass filter in process (multithreaded, no separate mean pass) instead of fslmaths -bptf
+native_highpass = False
+# scale and filter the dtseries in process instead of round tripping through nifti
+native_cifti = False
+# additional spatial smoothing sigma (mm) on top of the 2mm FWHM HCP already applied, or None for
+# none. For a total FWHM of fwhm use np.sqrt(fwhm**2 - 2**2) / (2*np.sqrt(2*np.log(2)))
+spatialSmoothingSigma = None
+# with spatial smoothing, smooth with a per subject sparse matrix instead of wb_command -cifti-smoothing
+native_smoothing = False
+# write the merged statistic maps and res4 in one in-process node instead of wb_command per contrast
+native_assembly = False
+# without native_assembly, create the per contrast dense CIFTIs in process from cached brain models
+native_dense = False
+# merge the per contrast CIFTIs by streaming one map at a time instead of with wb_command -cifti-merge
+native_merge = False
+# write the second level CIFTI templates from the copes' header alone instead of with wb_command -cifti-math
+native_math = False
+# dilate the cortex metrics with a cached nearest vertex map instead of wb_command -metric-dilate
+native_dilate = False
+# split the dtseries for FILMGLS in process instead of with wb_command -cifti-separate
+native_separate = False
+
 # ########################## #
 # Run specific configuration #
 # ########################## #
@@ -83,7 +111,7 @@ infosource = pe.Node(
     interface=util.IdentityInterface(fields=['subject_id','task','direction']), name="infosource")
 
 datasource = pe.Node(
-    interface=nio.DataGrabber(
+    interface=IndexedDataGrabber(
         infields=['subject_id', 'task', 'direction'], 
         outfields=['func_vol', 'func_surf', 
                    'surf_left', 'shape_left', 
@@ -114,7 +142,7 @@ datasource.inputs.sort_filelist = True
 
 
 datasink = pe.Node(
-    interface=nio.DataSink(),
+    interface=CompressingDataSink(),
     name="datasink")
 
 datasink.inputs.regexp_substitutions = [
@@ -122,14 +150,29 @@ datasink.inputs.regexp_substitutions = [
     # if you change results.X to anything else other than results, modify this accordingly
     (r'results/([\w\/]+)\/_direction_(LR|RL)_subject_id_(\d+)_task_(\w+)', r'results/\4/\3/\2/\1'),  # Creates directories like 'subj/task/direction'
     (r'_direction_(LR|RL)_subject_id_(\d+)_task_(\w+)', r'\3/\2/\1'),  # Creates directories like 'subj/task/direction'
-    (r'tfMRI_.*_[LR][LR]_dtype_thresh.nii.gz', r'nifti_mask.nii.gz'),
+    # the mask is uncompressed with --intermediate_format NIFTI until the datasink compresses it
+    (r'tfMRI_.*_[LR][LR]_dtype_thresh\.nii(\.gz)?$', r'nifti_mask.nii\1'),
 ]
 
 
 # ###################### #
 # Preprocessing Workflow #
 # ###################### #
-preproc = preproc_surf_hcp(hpcutoff, TR)
+preproc_kwargs = dict(spatialSmoothingSigma=spatialSmoothingSigma,
+                      native_intnorm=native_intnorm,
+                      native_highpass=native_highpass,
+                      native_cifti=native_cifti,
+                      native_smoothing=native_smoothing)
+preproc = preproc_surf_hcp(hpcutoff, TR, **preproc_kwargs)
+
+# datasource outputs feeding preproc and preproc outputs feeding modelfit
+preproc_inputs = [('func_vol', 'func_vol'),
+                  ('func_surf', 'func_surf'),
+                  ('surf_left', 'surf_left'),
+                  ('surf_right', 'surf_right'),
+                  ('motion', 'motion'),
+                  ('seg', 'seg')]
+preproc_outputs = [('outputspec.func', 'inputspec.func')]
 
 # ########################## #
 # firstlvl modeling workflow #
@@ -138,11 +181,11 @@ preproc = preproc_surf_hcp(hpcutoff, TR)
 # task specific event configuration
 
 def subjectinfo(subject_id, task, direction):
-    from glm.designs import hcp_events
+    from glm.designs import lookup_events
     from nipype.interfaces.base import Bunch
     from copy import deepcopy
 
-    names, onsets, dur = hcp_events(subject_id, task, direction)
+    names, onsets, dur = lookup_events(subject_id, task, direction, 'hcp')
 
     output = [Bunch(conditions=names,
                     onsets=deepcopy(onsets),
@@ -200,18 +243,27 @@ vifestimate = pe.Node(
 modelgen = pe.Node(
     interface=fsl.FEATModel(),
     name='modelgen')
-splitcifti = pe.Node(
-    interface=wb.CiftiSeparate(
-        volume_all = True,
-        metric = ['CORTEX_LEFT', 'CORTEX_RIGHT']),
-    name='splitcifti')
+if native_separate:
+    splitcifti = pe.Node(
+        interface=cifti.CiftiSeparate(
+            volume_all = True,
+            metric = ['CORTEX_LEFT', 'CORTEX_RIGHT'],
+            num_threads = 4),
+        name='splitcifti',
+        n_procs=4)
+else:
+    splitcifti = pe.Node(
+        interface=wb.CiftiSeparate(
+            volume_all = True,
+            metric = ['CORTEX_LEFT', 'CORTEX_RIGHT']),
+        name='splitcifti')
 lsurfdilate = pe.Node(
-    interface=wb.MetricDilate(
+    interface=(cifti.MetricDilate if native_dilate else wb.MetricDilate)(
         distance=50,
         nearest=True),
     name='lsurfdilate')
 rsurfdilate = pe.Node(
-    interface=wb.MetricDilate(
+    interface=(cifti.MetricDilate if native_dilate else wb.MetricDilate)(
         distance=50,
         nearest=True),
     name='rsurfdilate')
@@ -230,31 +282,33 @@ RSurf_modelestimate = pe.Node(
     name='rsurfmodelestimate')
 
 cifticreatedensecope = pe.MapNode(
-    interface=wb.CiftiCreateDenseTimeseries(),
+    interface=cifti.CiftiCreateDenseTimeseries() if native_dense else wb.CiftiCreateDenseTimeseries(),
     iterfield=['left_metric', 'right_metric', 'volume'],
     name='cifticreatedensecope')
 
 cifticreatedensevarcope = pe.MapNode(
-    interface=wb.CiftiCreateDenseTimeseries(),
+    interface=cifti.CiftiCreateDenseTimeseries() if native_dense else wb.CiftiCreateDenseTimeseries(),
     iterfield=['left_metric', 'right_metric', 'volume'],
     name='cifticreatedensevarcope')
 
 cifticreatedenseres4 = pe.Node(
-    interface=wb.CiftiCreateDenseTimeseries(),
+    # second level reads res4 by the wb_command name
+    interface=(cifti.CiftiCreateDenseTimeseries(out_file='dense_cifti.dtseries.nii') if native_dense
+               else wb.CiftiCreateDenseTimeseries()),
     name='cifticreatedenseres4')
 
 cifticreatedensetstats = pe.MapNode(
-    interface=wb.CiftiCreateDenseTimeseries(),
+    interface=cifti.CiftiCreateDenseTimeseries() if native_dense else wb.CiftiCreateDenseTimeseries(),
     iterfield=['left_metric', 'right_metric', 'volume'],
     name='cifticreatedenseres4')
 
 cifticreatedensetstat = pe.MapNode(
-    interface=wb.CiftiCreateDenseTimeseries(),
+    interface=cifti.CiftiCreateDenseTimeseries() if native_dense else wb.CiftiCreateDenseTimeseries(),
     iterfield=['left_metric', 'right_metric', 'volume'],
     name='cifticreatedensetstat')
 
 cifticreatedensezstat = pe.MapNode(
-    interface=wb.CiftiCreateDenseTimeseries(),
+    interface=cifti.CiftiCreateDenseTimeseries() if native_dense else wb.CiftiCreateDenseTimeseries(),
     iterfield=['left_metric', 'right_metric', 'volume'],
     name='cifticreatedensezstat')
 
@@ -279,19 +333,19 @@ sortcopes_node = pe.Node(util.Function(input_names=['files'],
 
 # these merge all copes within a run across conditions
 copemerge = pe.Node(
-    interface=wb.CiftiMerge(),
+    interface=cifti.CiftiMerge() if native_merge else wb.CiftiMerge(),
     name="copemerge")
 
 varcopemerge = pe.Node(
-    interface=wb.CiftiMerge(),
+    interface=cifti.CiftiMerge() if native_merge else wb.CiftiMerge(),
     name="varcopemerge")
 
 tstatmerge = pe.Node(
-    interface=wb.CiftiMerge(),
+    interface=cifti.CiftiMerge() if native_merge else wb.CiftiMerge(),
     name="tstatmerge")
 
 zstatmerge = pe.Node(
-    interface=wb.CiftiMerge(),
+    interface=cifti.CiftiMerge() if native_merge else wb.CiftiMerge(),
     name="zstatmerge")
 
 modelfit.connect([
@@ -334,65 +388,92 @@ modelfit.connect([
     (modelgen, RSurf_modelestimate, [('design_file', 'design_file'),
                                      ('con_file', 'tcon_file')]),
 
-    # reassemble and merge copes
-    (vol_modelestimate, cifticreatedensecope, [('copes', 'volume')]),
-    (splitcifti, cifticreatedensecope, [('volume_all_label_out', 'volume_label')]),
-    (inputnode_modelfit, cifticreatedensecope, [('shape_left', 'left_roi'),
-                                                ('shape_right', 'right_roi')]),
-    (LSurf_modelestimate, cifticreatedensecope, [('copes', 'left_metric')]),
-    (RSurf_modelestimate, cifticreatedensecope, [('copes', 'right_metric')]),
-
-    (cifticreatedensecope, copemerge, [('out_file', 'cifti')]),
-
-    # reassemble and merge varcopes
-    (vol_modelestimate, cifticreatedensevarcope, [('varcopes', 'volume')]),
-    (splitcifti, cifticreatedensevarcope, [('volume_all_label_out', 'volume_label')]),
-    (inputnode_modelfit, cifticreatedensevarcope, [('shape_left', 'left_roi'),
-                                                   ('shape_right', 'right_roi')]),
-    (LSurf_modelestimate, cifticreatedensevarcope, [('varcopes', 'left_metric')]),
-    (RSurf_modelestimate, cifticreatedensevarcope, [('varcopes', 'right_metric')]),
-
-    (cifticreatedensevarcope, varcopemerge, [('out_file', 'cifti')]),
-
-    # reassemble and merge zstat
-    (vol_modelestimate, cifticreatedensezstat, [('zstats', 'volume')]),
-    (splitcifti, cifticreatedensezstat, [('volume_all_label_out', 'volume_label')]),
-    (inputnode_modelfit, cifticreatedensezstat, [('shape_left', 'left_roi'),
-                                                   ('shape_right', 'right_roi')]),
-    (LSurf_modelestimate, cifticreatedensezstat, [('zstats', 'left_metric')]),
-    (RSurf_modelestimate, cifticreatedensezstat, [('zstats', 'right_metric')]),
-
-    (cifticreatedensezstat, zstatmerge, [('out_file', 'cifti')]),
-
-    # reassemble and merge tstat
-    (vol_modelestimate, cifticreatedensetstat, [('tstats', 'volume')]),
-    (splitcifti, cifticreatedensetstat, [('volume_all_label_out', 'volume_label')]),
-    (inputnode_modelfit, cifticreatedensetstat, [('shape_left', 'left_roi'),
-                                                   ('shape_right', 'right_roi')]),
-    (LSurf_modelestimate, cifticreatedensetstat, [('tstats', 'left_metric')]),
-    (RSurf_modelestimate, cifticreatedensetstat, [('tstats', 'right_metric')]),
-
-    (cifticreatedensetstat, tstatmerge, [('out_file', 'cifti')]),
-
-    # reassemble res4
-    (vol_modelestimate, cifticreatedenseres4, [('residual4d', 'volume')]),
-    (splitcifti, cifticreatedenseres4, [('volume_all_label_out', 'volume_label')]),
-    (inputnode_modelfit, cifticreatedenseres4, [('shape_left', 'left_roi'),
-                                               ('shape_right', 'right_roi')]),
-    (LSurf_modelestimate, cifticreatedenseres4, [('residual4d', 'left_metric')]),
-    (RSurf_modelestimate, cifticreatedenseres4, [('residual4d', 'right_metric')]),
-
-
     (subjectinfo_node, vifestimate, [('contrast_names','contrast_names')]),
     (modelgen, vifestimate, [('design_file','design_matrix')]),
 ])
 
+if native_assembly:
+    ciftistatmaps = pe.Node(
+        interface=cifti.CiftiStatMaps(),
+        name='ciftistatmaps')
+
+    modelfit.connect([
+        (vol_modelestimate, ciftistatmaps, [('results_dir', 'volume_dir')]),
+        (LSurf_modelestimate, ciftistatmaps, [('results_dir', 'left_dir')]),
+        (RSurf_modelestimate, ciftistatmaps, [('results_dir', 'right_dir')]),
+        (splitcifti, ciftistatmaps, [('volume_all_label_out', 'volume_label')]),
+        (inputnode_modelfit, ciftistatmaps, [('shape_left', 'left_roi'),
+                                             ('shape_right', 'right_roi')]),
+    ])
+
+    # modelfit outputs of the merged maps and res4, by results.firstlevel folder
+    statmaps = [('copes', 'ciftistatmaps.copes'),
+                ('zstat', 'ciftistatmaps.zstats'),
+                ('tstat', 'ciftistatmaps.tstats'),
+                ('varcopes', 'ciftistatmaps.varcopes'),
+                ('res4', 'ciftistatmaps.res4')]
+else:
+    modelfit.connect([
+        # reassemble and merge copes
+        (vol_modelestimate, cifticreatedensecope, [('copes', 'volume')]),
+        (splitcifti, cifticreatedensecope, [('volume_all_label_out', 'volume_label')]),
+        (inputnode_modelfit, cifticreatedensecope, [('shape_left', 'left_roi'),
+                                                    ('shape_right', 'right_roi')]),
+        (LSurf_modelestimate, cifticreatedensecope, [('copes', 'left_metric')]),
+        (RSurf_modelestimate, cifticreatedensecope, [('copes', 'right_metric')]),
+
+        (cifticreatedensecope, copemerge, [('out_file', 'cifti')]),
+
+        # reassemble and merge varcopes
+        (vol_modelestimate, cifticreatedensevarcope, [('varcopes', 'volume')]),
+        (splitcifti, cifticreatedensevarcope, [('volume_all_label_out', 'volume_label')]),
+        (inputnode_modelfit, cifticreatedensevarcope, [('shape_left', 'left_roi'),
+                                                       ('shape_right', 'right_roi')]),
+        (LSurf_modelestimate, cifticreatedensevarcope, [('varcopes', 'left_metric')]),
+        (RSurf_modelestimate, cifticreatedensevarcope, [('varcopes', 'right_metric')]),
+
+        (cifticreatedensevarcope, varcopemerge, [('out_file', 'cifti')]),
+
+        # reassemble and merge zstat
+        (vol_modelestimate, cifticreatedensezstat, [('zstats', 'volume')]),
+        (splitcifti, cifticreatedensezstat, [('volume_all_label_out', 'volume_label')]),
+        (inputnode_modelfit, cifticreatedensezstat, [('shape_left', 'left_roi'),
+                                                       ('shape_right', 'right_roi')]),
+        (LSurf_modelestimate, cifticreatedensezstat, [('zstats', 'left_metric')]),
+        (RSurf_modelestimate, cifticreatedensezstat, [('zstats', 'right_metric')]),
+
+        (cifticreatedensezstat, zstatmerge, [('out_file', 'cifti')]),
+
+        # reassemble and merge tstat
+        (vol_modelestimate, cifticreatedensetstat, [('tstats', 'volume')]),
+        (splitcifti, cifticreatedensetstat, [('volume_all_label_out', 'volume_label')]),
+        (inputnode_modelfit, cifticreatedensetstat, [('shape_left', 'left_roi'),
+                                                       ('shape_right', 'right_roi')]),
+        (LSurf_modelestimate, cifticreatedensetstat, [('tstats', 'left_metric')]),
+        (RSurf_modelestimate, cifticreatedensetstat, [('tstats', 'right_metric')]),
+
+        (cifticreatedensetstat, tstatmerge, [('out_file', 'cifti')]),
+
+        # reassemble res4
+        (vol_modelestimate, cifticreatedenseres4, [('residual4d', 'volume')]),
+        (splitcifti, cifticreatedenseres4, [('volume_all_label_out', 'volume_label')]),
+        (inputnode_modelfit, cifticreatedenseres4, [('shape_left', 'left_roi'),
+                                                   ('shape_right', 'right_roi')]),
+        (LSurf_modelestimate, cifticreatedenseres4, [('residual4d', 'left_metric')]),
+        (RSurf_modelestimate, cifticreatedenseres4, [('residual4d', 'right_metric')]),
+    ])
+
+    statmaps = [('copes', 'copemerge.out_file'),
+                ('zstat', 'zstatmerge.out_file'),
+                ('tstat', 'tstatmerge.out_file'),
+                ('varcopes', 'varcopemerge.out_file'),
+                ('res4', 'cifticreatedenseres4.out_file')]
+
 
 # actually running the first level scripts
 firstlevel = pe.Workflow(name='firstlevel')
 firstlevel.connect(
-    [(preproc, modelfit, [('nii2cifti.out_file', 'inputspec.func'),
-                         ]),
+    [(preproc, modelfit, preproc_outputs),
 ])
 
 
@@ -414,7 +495,7 @@ infosource2 = pe.Node(
     interface=util.IdentityInterface(fields=['subject_id','task']), name="infosource")
 
 datasource2a = pe.Node(
-    interface=nio.DataGrabber(
+    interface=IndexedDataGrabber(
         infields=['subject_id', 'task'],
         outfields=['surf_left', 'shape_left',
                    'surf_right', 'shape_right']),
@@ -432,7 +513,7 @@ datasource2a.inputs.template_args = {'surf_left': [['subject_id','subject_id']],
 datasource2a.inputs.sort_filelist = True
 
 datasource2b = pe.Node(
-    interface=nio.DataGrabber(
+    interface=IndexedDataGrabber(
         infields=['subject_id', 'task', 'direction'],
         outfields=['cope', 'varcope', 'mask', 'res', 'dof']),
     iterables=('direction', ['LR', 'RL']),
@@ -458,7 +539,7 @@ join_datasource2b = pe.JoinNode(
     name='joindatasource2b')
 
 datasink2 = pe.Node(
-    interface=nio.DataSink(),
+    interface=CompressingDataSink(),
     name="datasink")
 
 datasink2.inputs.regexp_substitutions = [
@@ -593,7 +674,8 @@ def selectFirstVol(x):
         return [('vol1', f'{x} -select 1 1')]
 
 ciftisplit = pe.MapNode(
-    interface=wb.CiftiMath(expression='vol1'),
+    interface=(cifti.CiftiMath(expression='vol1', header_only=True) if native_math
+               else wb.CiftiMath(expression='vol1')),
     iterfield='in_vars',
     name='ciftisplit')
 
@@ -676,24 +758,14 @@ l1pipeline.connect([
     (infosource, firstlevel, [('subject_id', 'modelfit.inputspec.subject_id'),
                              ('task','modelfit.inputspec.task'),
                              ('direction','modelfit.inputspec.direction')]),
-    (datasource, firstlevel, [
-        ('func_vol', 'preproc.inputspec.func_vol'),
-        ('func_surf', 'preproc.inputspec.func_surf'),
-        ('surf_left', 'preproc.inputspec.surf_left'),
-        ('surf_right', 'preproc.inputspec.surf_right'),
-        ('motion', 'preproc.inputspec.motion'),
-        ('seg', 'preproc.inputspec.seg'),
+    (datasource, firstlevel, [(src, 'preproc.inputspec.' + dst) for src, dst in preproc_inputs] + [
         ('surf_left', 'modelfit.inputspec.surf_left'),
         ('shape_left', 'modelfit.inputspec.shape_left'),
         ('surf_right', 'modelfit.inputspec.surf_right'),
         ('shape_right', 'modelfit.inputspec.shape_right')]),
     (firstlevel, datasink, [
-        ('preproc.threshold.out_file', 'results.firstlevel.@mask'),
-        ('modelfit.copemerge.out_file', 'results.firstlevel.copes'),
-        ('modelfit.zstatmerge.out_file', 'results.firstlevel.zstat'),
-        ('modelfit.tstatmerge.out_file', 'results.firstlevel.tstat'),
-        ('modelfit.varcopemerge.out_file', 'results.firstlevel.varcopes'),
-        ('modelfit.cifticreatedenseres4.out_file', 'results.firstlevel.res4'),
+        ('preproc.outputspec.mask', 'results.firstlevel.@mask')] +
+        [('modelfit.' + src, 'results.firstlevel.' + folder) for folder, src in statmaps] + [
         ('modelfit.volmodelestimate.dof_file', 'results.firstlevel.@dof'),
         ('modelfit.vifestimate.vif_file', 'results.firstlevel.@vif'),
         ('modelfit.level1design.fsf_files', 'results.firstlevel.@fsf_files'),
@@ -754,12 +826,46 @@ if __name__ == '__main__':
                         help='scratch directory where temporary files should be stored')
     parser.add_argument('--n_cpus', type=int, default=int(os.getenv('SLURM_CPUS_PER_TASK',default='1')),
                         help='Number of CPUs available for computation')
+    parser.add_argument('--manifest', type=str, default=None,
+                        help='Manifest written by hcp_design_preflight.py. Only accepted runs are processed')
+    parser.add_argument('--vif_store', type=str, default=None,
+                        help='Also collect the VIFs of all runs in this cohort table (.parquet or .npz)')
+    parser.add_argument('--event_db', type=str, default=os.getenv('HCP_EVENT_DB'),
+                        help='Event database written by hcp_build_event_db.py. Defaults to $HCP_EVENT_DB')
+    parser.add_argument('--file_index', type=str, default=os.getenv('HCP_FILE_INDEX'),
+                        help='HCP1200 file index written by hcp_build_file_index.py. Defaults to $HCP_FILE_INDEX')
+    parser.add_argument('--preproc_store', type=str, default=os.getenv('HCP_PREPROC_STORE'),
+                        help='Store of preprocessing stages shared between pipelines. Stages missing from it are '
+                             'computed into it first. Defaults to $HCP_PREPROC_STORE')
+    parser.add_argument('--intermediate_format', choices=['NIFTI_GZ', 'NIFTI'], default='NIFTI_GZ',
+                        help='Format of the images nodes write to scratch. NIFTI avoids compressing and '
+                             'decompressing every intermediate run; results are compressed either way')
+    parser.add_argument('--compress_threads', type=int, default=1,
+                        help='Threads compressing each image stored in the results directory')
 
     args = parser.parse_args()
 
-    infosource.iterables = [('subject_id', args.subject_ids),
-                            ('task', args.tasks),
-                            ('direction', args.directions)]
+    # subjectinfo nodes run in their own processes and pick the database up from the environment
+    if args.event_db:
+        os.environ['HCP_EVENT_DB'] = os.path.abspath(args.event_db)
+
+    # resolve datasource templates (and E-Prime globs) from the file index rather than dartfs
+    if args.file_index:
+        os.environ['HCP_FILE_INDEX'] = os.path.abspath(args.file_index)
+        datasource.inputs.index_file = os.path.abspath(args.file_index)
+        datasource2a.inputs.index_file = os.path.abspath(args.file_index)
+
+    if args.manifest:
+        runs = accepted_runs(args.manifest, args.subject_ids, args.tasks, args.directions)
+        if not runs:
+            sys.exit('No accepted runs in %s' % args.manifest)
+        infosource.iterables = synchronized_iterables(runs)
+        infosource.synchronize = True
+    else:
+        runs = list(itertools.product(args.subject_ids, args.tasks, args.directions))
+        infosource.iterables = [('subject_id', args.subject_ids),
+                                ('task', args.tasks),
+                                ('direction', args.directions)]
 
     SCRATCH_DIR = args.scratch
     l1pipeline.base_dir = os.path.abspath(SCRATCH_DIR + '/workingdir')
@@ -770,6 +876,34 @@ if __name__ == '__main__':
     }
 
     datasink.inputs.base_directory = os.path.abspath(args.out)
+    datasink.inputs.num_threads = args.compress_threads
+    set_intermediate_format(l1pipeline, args.intermediate_format)
+
+    if args.preproc_store:
+        # compute the preprocessing stages that aren't stored yet, then read every stage from the store
+        store = os.path.abspath(args.preproc_store)
+        fill_preproc_store(store, preproc_surf_hcp_stages(hpcutoff, TR, **preproc_kwargs),
+                           datasource, preproc_inputs, runs,
+                           base_dir=os.path.abspath(SCRATCH_DIR + '/workingdir'), n_procs=args.n_cpus)
+
+        firstlevel.disconnect([(preproc, modelfit, preproc_outputs)])
+        firstlevel.remove_nodes([preproc])
+        preproc = preproc_surf_hcp(hpcutoff, TR, store=store, **preproc_kwargs)
+        firstlevel.connect([(preproc, modelfit, preproc_outputs)])
+
+    if args.vif_store:
+        cohortvifs = pe.Node(
+            interface=util.Function(input_names=['vif_file', 'subject_id', 'task', 'direction', 'store'],
+                                    output_names=['store'],
+                                    function=store_cohort_vifs),
+            name='cohortvifs')
+        cohortvifs.inputs.store = os.path.abspath(args.vif_store)
+        l1pipeline.connect([
+            (infosource, cohortvifs, [('subject_id', 'subject_id'),
+                                      ('task', 'task'),
+                                      ('direction', 'direction')]),
+            (firstlevel, cohortvifs, [('modelfit.vifestimate.vif_file', 'vif_file')])
+        ])
 
     l1pipeline.write_graph()
 
@@ -778,9 +912,20 @@ if __name__ == '__main__':
     else:
         outgraph = l1pipeline.run()
 
+    if args.vif_store:
+        compact_cohort_vifs(os.path.abspath(args.vif_store))
 
-    infosource2.iterables = [('subject_id', args.subject_ids),
-                            ('task', args.tasks)]
+
+    if args.manifest:
+        # datasource2b always pulls both directions, so only keep sessions where both were run
+        sessions = accepted_sessions(args.manifest, args.subject_ids, args.tasks)
+        if not sessions:
+            sys.exit('No subject/task with both directions accepted in %s' % args.manifest)
+        infosource2.iterables = synchronized_iterables(sessions, fields=('subject_id', 'task'))
+        infosource2.synchronize = True
+    else:
+        infosource2.iterables = [('subject_id', args.subject_ids),
+                                 ('task', args.tasks)]
 
     l2pipeline.base_dir = os.path.abspath(SCRATCH_DIR + '/workingdir')
     l2pipeline.config = {
@@ -793,6 +938,8 @@ if __name__ == '__main__':
     # by l1pipeline
     datasource2b.inputs.base_directory = os.path.join(os.path.abspath(args.out),'results')
     datasink2.inputs.base_directory = os.path.abspath(args.out)
+    datasink2.inputs.num_threads = args.compress_threads
+    set_intermediate_format(l2pipeline, args.intermediate_format)
 
     l2pipeline.write_graph()
 
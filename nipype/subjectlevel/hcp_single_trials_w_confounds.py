@@ -18,9 +18,9 @@ from builtins import range
 import os  # system functions
 import sys
 import argparse
+import itertools
 import numpy as np
 
-import nipype.interfaces.io as nio  # Data i/o
 import nipype.interfaces.fsl as fsl  # fsl
 import nipype.pipeline.engine as pe  # pypeline engine
 import nipype.interfaces.utility as util  # utility
@@ -36,10 +36,13 @@ if package_directory not in sys.path:
     sys.path.insert(0, package_directory)
     
 import nipype_ext.vifs as vifs
+from nipype_ext.io import IndexedDataGrabber, CompressingDataSink, set_intermediate_format
 
-from glm.preproc import preproc_vol_motion_csf
+from glm.preproc import preproc_vol_motion_csf, preproc_vol_motion_csf_stages
+from glm.preprocstore import fill_preproc_store
 from glm.designs import select_trials
-from glm.utils import assemble_csf_motion_confounds_mat, merge_trial_vifs
+from glm.preflight import accepted_runs, synchronized_iterables
+from glm.utils import build_confounds, merge_trial_vifs, store_cohort_vifs, compact_cohort_vifs
 
 fsl.FSLCommand.set_default_output_type('NIFTI_GZ')
 
@@ -48,6 +51,18 @@ data_dir = os.path.abspath('/dartfs/rc/lab/D/DBIC/DBIC/archive/HCP/HCP1200/')
 hpcutoff = 200
 TR = 0.72
 
+# normalize volume intensities in one in-process node instead of the FSL chain
+native_intnorm = False
+# highpass filter in process (multithreaded, no separate mean pass) instead of fslmaths -bptf
+native_highpass = False
+# build each subject's CSF mask once and reuse it across runs (see glm.cache)
+cached_csf = False
+# detect motion and intensity spikes in the intnorm node instead of ArtifactDetect (needs native_intnorm)
+native_art = False
+# confound expansions (see glm.utils.build_confounds). These give the 24 motion parameters
+# and CSF, plus one spike regressor per ART outlier
+confound_options = dict(squares=True, derivatives=False, fd_threshold=None)
+
 # ########################## #
 # Run specific configuration #
 # ########################## #
@@ -57,7 +72,7 @@ infosource = pe.Node(
 
 
 datasource = pe.Node(
-    interface=nio.DataGrabber(
+    interface=IndexedDataGrabber(
         infields=['subject_id', 'task', 'direction'], outfields=['func', 'seg', 'motion']),
     name='datasource')
 datasource.inputs.base_directory = data_dir
@@ -73,7 +88,7 @@ datasource.inputs.sort_filelist = True
 
 
 datasink = pe.Node(
-    interface=nio.DataSink(),
+    interface=CompressingDataSink(),
     name="datasink")
 
 datasink.inputs.regexp_substitutions = [
@@ -84,7 +99,20 @@ datasink.inputs.regexp_substitutions = [
 # ###################### #
 # Preprocessing Workflow #
 # ###################### #
-preproc = preproc_vol_motion_csf(hpcutoff, TR)
+preproc_kwargs = dict(native_intnorm=native_intnorm,
+                      native_highpass=native_highpass,
+                      cached_csf=cached_csf,
+                      native_art=native_art)
+preproc = preproc_vol_motion_csf(hpcutoff, TR, **preproc_kwargs)
+
+# datasource outputs feeding preproc and preproc outputs feeding modelfit
+preproc_inputs = [('func', 'func'),
+                  ('motion', 'motion'),
+                  ('seg', 'seg')]
+preproc_outputs = [('outputspec.func', 'inputspec.func'),
+                   ('outputspec.outliers', 'inputspec.outliers'),
+                   ('outputspec.csf', 'inputspec.csf'),
+                   ('outputspec.motion', 'inputspec.motion')]
 
 
 # ########################## #
@@ -94,11 +122,11 @@ preproc = preproc_vol_motion_csf(hpcutoff, TR)
 # task specific event configuration
 
 def subjectinfo(subject_id, task, direction):
-    from glm.designs import trial_events
+    from glm.designs import lookup_events
     from nipype.interfaces.base import Bunch
     from copy import deepcopy
     
-    names, onsets, dur = trial_events(subject_id, task, direction)
+    names, onsets, dur = lookup_events(subject_id, task, direction, 'trial')
     
     output = [Bunch(conditions=names,
                     onsets=deepcopy(onsets),
@@ -135,11 +163,14 @@ contrastselect_node = pe.Node(util.Function(input_names=['contrast_names'],
                         name='contrastselect_node')
                         
     
-assembleconfounds_node = pe.MapNode(util.Function(input_names=['motion','csf'],
-                                                  output_names=['confounds'],
-                                                  function=assemble_csf_motion_confounds_mat),
-                                       iterfield=['motion','csf'],
+assembleconfounds_node = pe.MapNode(util.Function(input_names=['motion','csf','outliers','squares',
+                                                               'derivatives','fd_threshold'],
+                                                  output_names=['confounds','confounds_npy'],
+                                                  function=build_confounds),
+                                       iterfield=['motion','csf','outliers'],
                                        name='assembleconfounds_node')
+for option, value in confound_options.items():
+    setattr(assembleconfounds_node.inputs, option, value)
     
 # design and contrast configurations
 
@@ -178,11 +209,11 @@ modelfit.connect([
                                            ('direction','direction')]),
     (subjectinfo_node, contrastselect_node, [('contrast_names','contrast_names')]),
         
-    (inputnode_modelfit, designspec, [('func', 'functional_runs'),
-                                     ('outliers','outlier_files')]),
+    (inputnode_modelfit, designspec, [('func', 'functional_runs')]),
     (subjectinfo_node, designspec, [('subject_info','subject_info')]),
     (inputnode_modelfit, assembleconfounds_node, [('csf','csf'),
-                                                 ('motion','motion')]),
+                                                 ('motion','motion'),
+                                                 ('outliers','outliers')]),
     (assembleconfounds_node, designspec, [('confounds', 'realignment_parameters')]),
     
     (designspec, level1design, [('session_info', 'session_info')]),
@@ -204,10 +235,7 @@ modelfit.connect([
 # actually running the first level scripts
 firstlevel = pe.Workflow(name='firstlevel')
 firstlevel.connect(
-    [(preproc, modelfit, [('highpass.out_file', 'inputspec.func'),
-                          ('spikedetection.outlier_files', 'inputspec.outliers'),
-                          ('compute_csf_ts.out_file', 'inputspec.csf'),
-                          ('inputspec.motion', 'inputspec.motion')]),
+    [(preproc, modelfit, preproc_outputs),
 ])
 
 
@@ -234,10 +262,7 @@ l1pipeline.connect([
     (infosource, firstlevel, [('subject_id', 'modelfit.inputspec.subject_id'),
                               ('task','modelfit.inputspec.task'),
                               ('direction','modelfit.inputspec.direction')]),
-    (datasource, firstlevel, [
-        ('func', 'preproc.inputspec.func'),
-        ('motion', 'preproc.inputspec.motion'),
-        ('seg', 'preproc.inputspec.seg')]),
+    (datasource, firstlevel, [(src, 'preproc.inputspec.' + dst) for src, dst in preproc_inputs]),
     (firstlevel, datasink, [
         ('modelfit.vifestimate.vif_file', 'results.@vif'),
         ('modelfit.copemerge.merged_file', 'results.@copes'),
@@ -263,12 +288,45 @@ if __name__ == '__main__':
                         help='scratch directory where temporary files should be stored')
     parser.add_argument('--n_cpus', type=int, default=int(os.getenv('SLURM_CPUS_PER_TASK',default='1')),
                         help='Number of CPUs available for computation')
+    parser.add_argument('--manifest', type=str, default=None,
+                        help='Manifest written by hcp_design_preflight.py. Only accepted runs are processed')
+    parser.add_argument('--vif_store', type=str, default=None,
+                        help='Also collect the VIFs of all runs in this cohort table (.parquet or .npz)')
+    parser.add_argument('--event_db', type=str, default=os.getenv('HCP_EVENT_DB'),
+                        help='Event database written by hcp_build_event_db.py. Defaults to $HCP_EVENT_DB')
+    parser.add_argument('--file_index', type=str, default=os.getenv('HCP_FILE_INDEX'),
+                        help='HCP1200 file index written by hcp_build_file_index.py. Defaults to $HCP_FILE_INDEX')
+    parser.add_argument('--preproc_store', type=str, default=os.getenv('HCP_PREPROC_STORE'),
+                        help='Store of preprocessing stages shared between pipelines. Stages missing from it are '
+                             'computed into it first. Defaults to $HCP_PREPROC_STORE')
+    parser.add_argument('--intermediate_format', choices=['NIFTI_GZ', 'NIFTI'], default='NIFTI_GZ',
+                        help='Format of the images nodes write to scratch. NIFTI avoids compressing and '
+                             'decompressing every intermediate run; results are compressed either way')
+    parser.add_argument('--compress_threads', type=int, default=1,
+                        help='Threads compressing each image stored in the results directory')
 
     args = parser.parse_args()
 
-    infosource.iterables = [('subject_id', args.subject_ids),
-                            ('task', args.tasks), 
-                            ('direction', args.directions)]
+    # subjectinfo nodes run in their own processes and pick the database up from the environment
+    if args.event_db:
+        os.environ['HCP_EVENT_DB'] = os.path.abspath(args.event_db)
+
+    # resolve datasource templates (and E-Prime globs) from the file index rather than dartfs
+    if args.file_index:
+        os.environ['HCP_FILE_INDEX'] = os.path.abspath(args.file_index)
+        datasource.inputs.index_file = os.path.abspath(args.file_index)
+
+    if args.manifest:
+        runs = accepted_runs(args.manifest, args.subject_ids, args.tasks, args.directions)
+        if not runs:
+            sys.exit('No accepted runs in %s' % args.manifest)
+        infosource.iterables = synchronized_iterables(runs)
+        infosource.synchronize = True
+    else:
+        runs = list(itertools.product(args.subject_ids, args.tasks, args.directions))
+        infosource.iterables = [('subject_id', args.subject_ids),
+                                ('task', args.tasks),
+                                ('direction', args.directions)]
 
     SCRATCH_DIR = args.scratch
     l1pipeline.base_dir = os.path.abspath(SCRATCH_DIR + '/workingdir')
@@ -279,6 +337,34 @@ if __name__ == '__main__':
     }
 
     datasink.inputs.base_directory = os.path.abspath(args.out)
+    datasink.inputs.num_threads = args.compress_threads
+    set_intermediate_format(l1pipeline, args.intermediate_format)
+
+    if args.preproc_store:
+        # compute the preprocessing stages that aren't stored yet, then read every stage from the store
+        store = os.path.abspath(args.preproc_store)
+        fill_preproc_store(store, preproc_vol_motion_csf_stages(hpcutoff, TR, **preproc_kwargs),
+                           datasource, preproc_inputs, runs,
+                           base_dir=os.path.abspath(SCRATCH_DIR + '/workingdir'), n_procs=args.n_cpus)
+
+        firstlevel.disconnect([(preproc, modelfit, preproc_outputs)])
+        firstlevel.remove_nodes([preproc])
+        preproc = preproc_vol_motion_csf(hpcutoff, TR, store=store, **preproc_kwargs)
+        firstlevel.connect([(preproc, modelfit, preproc_outputs)])
+
+    if args.vif_store:
+        cohortvifs = pe.Node(
+            interface=util.Function(input_names=['vif_file', 'subject_id', 'task', 'direction', 'store'],
+                                    output_names=['store'],
+                                    function=store_cohort_vifs),
+            name='cohortvifs')
+        cohortvifs.inputs.store = os.path.abspath(args.vif_store)
+        l1pipeline.connect([
+            (infosource, cohortvifs, [('subject_id', 'subject_id'),
+                                      ('task', 'task'),
+                                      ('direction', 'direction')]),
+            (firstlevel, cohortvifs, [('modelfit.vifestimate.vif_file', 'vif_file')])
+        ])
 
     l1pipeline.write_graph()    
     
@@ -286,3 +372,6 @@ if __name__ == '__main__':
         outgraph = l1pipeline.run(plugin='MultiProc', plugin_args={'n_procs':args.n_cpus})
     else:
         outgraph = l1pipeline.run()
+
+    if args.vif_store:
+        compact_cohort_vifs(os.path.abspath(args.vif_store))